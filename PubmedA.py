@@ -15,8 +15,10 @@ class PubmedA:
         return PubmedA(pmid, title, journal,
                              year, abstract_text, mesh_major)
 
+    # score is the retrieval score of the article for the query that found it, if any
     def __init__(self, pmid: str, title: str, journal: str,
-                 year: str, abstract_text: str, mesh_major: List[str]):
+                 year: str, abstract_text: str, mesh_major: List[str], score: float = None):
+        self.score = score
         self.journal = journal
         self.mesh_major = mesh_major
         self.year = year
@@ -10,6 +10,8 @@ import csv
 import subprocess
 from sklearn import metrics as m
 
+import interchange
+
 """
     for QU we are doing f1 score on concepts
     for IR we are doing f1 score on document ids
@@ -157,10 +159,29 @@ def eval_score(predicted, actual):
     return (f1,precision,recall)
 
 
+# Reads either the IR stage file (.jsonl, see interchange.py) or the xml it can be exported to
 def get_generated_dict(file_location, mode="concepts"):
     dict = {}
     no_concepts = 0
     no_pmids = 0
+    if file_location.endswith(".jsonl"):
+        records = list(interchange.read_records(file_location))
+        print(f"{len(records)} {mode} found")
+        for record in records:
+            qid = record['id']
+            if mode=="concepts":
+                if record['entities'] == []:
+                    no_concepts +=1
+                    print(f"NO CONCEPTS QUESTION = {qid}")
+                dict[qid] = record['entities']
+            elif mode=="pubmed_ids":
+                result_pmids = interchange.result_pmids(record)
+                if(result_pmids == []):
+                    no_pmids +=1
+                dict[qid] = result_pmids
+            elif mode =="type":
+                dict[qid] = (record['type'],record['question'])
+        return dict,no_concepts,no_pmids
     with open(file_location, "r") as xml_file:
         fileTree = ET.parse(xml_file)
         if fileTree:
@@ -293,9 +314,9 @@ def print_qu_ir_results(EVALUATING = False, TESTING = False):
     if TESTING:
         generated_xml = "tmp/debugging/generated_ir.xml"
     elif EVALUATING:
-        generated_xml = "tmp/ir/output/bioasq_qa_EVAL.xml"
+        generated_xml = "tmp/ir/output/bioasq_qa_EVAL.jsonl"
     else:
-        generated_xml= "tmp/ir/output/bioasq_qa.xml"
+        generated_xml= "tmp/ir/output/bioasq_qa.jsonl"
     print("Getting golden data")
     gold_concepts, gold_pubmed_ids, gold_question_types = get_gold_dicts(golden_dataset)
     print(f"\033[31mNum gold concepts: {len(gold_concepts)}, pmids: {len(gold_pubmed_ids)}, types: {len(gold_question_types)}\033[0m")
@@ -0,0 +1,533 @@
+"""
+benchmark.py measures the speed and accuracy of parts of the QA system on the evaluation questions.
+    python benchmark.py classifier   fp32 question type classifier against its dynamically quantized int8 version
+    python benchmark.py onnx         PyTorch question type classifier against its ONNX Runtime export: label parity
+                                     and logit differences, then latency. Exits with status 1 if any label differs.
+    python benchmark.py cascade      BERT alone against the lexical cascade with BERT fallback, over a range of
+                                     thresholds: fraction of questions short-circuited and accuracy delta
+    python benchmark.py search       per-query Whoosh search latency with a new searcher for every query against
+                                     one SearcherSession for the whole run
+    python benchmark.py batch-search batch_search throughput on the QU stage file with 1 to N processes, checking
+                                     that every run writes the same IR stage file as the serial one
+    python benchmark.py bm25         Whoosh against the NumPy BM25 backend (python bm25.py): top-5 overlap and latency,
+                                     then OR queries with and without MaxScore. Exits with status 1 if MaxScore
+                                     changes any result.
+    python benchmark.py dense        recall@k of the gold BioASQ documents and p50/p99 latency for Whoosh, the dense
+                                     retriever at several nprobe and their fusion, and recall@k of the IVF search
+                                     against exact search
+    python benchmark.py rerank       recall@k of the gold BioASQ documents in the Whoosh top k against the Whoosh top
+                                     --depth reranked by late interaction, and the latency of the reranking
+    python benchmark.py shards       an index in one piece against a sharded build of the same articles
+                                     (build_index.py --shard-by): same top k and score differences, then latency with
+                                     the shards searched serially and in parallel. Exits with status 1 if any top k
+                                     differs other than in the order of equal scores.
+
+Accuracy is measured against the gold question types in master_golden.json. Batch throughput is the time to classify
+the whole evaluation csv in one call, and the per-question latency is the time to classify one question at a time,
+as the live mode does.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+EVALUATION_CSV = "testing_datasets/evaluation_input.csv"
+GOLDEN_JSON = "testing_datasets/Task8BGoldenEnriched/master_golden.json"
+QU_STAGE_FILE = "tmp/ir/input/bioasq_qa_EVAL.jsonl"
+
+# {question id: gold type}
+def load_gold_types(golden_file=GOLDEN_JSON):
+    with open(golden_file, "r") as file:
+        return {question['id']: question['type'] for question in json.load(file)['questions']}
+
+# Call fn once to warm up and then repeats more times. Returns the last result and the seconds each timed call took.
+def timed_runs(fn, repeats=3):
+    result = fn()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+def accuracy(ids, labels, gold):
+    scored = [(label, gold[id]) for id, label in zip(ids, labels) if id in gold]
+    if not scored:
+        return float('nan')
+    return sum(label == gold_label for label, gold_label in scored) / len(scored)
+
+def print_latencies(name, seconds):
+    milliseconds = np.array(seconds) * 1000
+    print(f"\033[95m  {name:<24} p50 {np.percentile(milliseconds, 50):8.2f} ms   p99 {np.percentile(milliseconds, 99):8.2f} ms\033[0m")
+
+
+# Batch and per-question timings and accuracy of one question type classifier
+def measure_classifier(name, classify, df, gold, repeats=3, single_questions=100):
+    labels, seconds = timed_runs(lambda: classify(df), repeats)
+    single = []
+    for ind in df.index[:single_questions]:
+        row = df.loc[[ind]]
+        start = time.perf_counter()
+        classify(row)
+        single.append(time.perf_counter() - start)
+    print(f"\033[95m{name}: accuracy {accuracy(df['ID'], labels, gold):.2%}, "
+          f"{len(df) / min(seconds):.1f} questions/s in batch\033[0m")
+    print_latencies("one question at a time", single)
+    return labels
+
+def benchmark_classifier(data_folder='data_modules', csv_file=EVALUATION_CSV, golden_file=GOLDEN_JSON, repeats=3, threads=None):
+    import startup
+    import question_understanding
+    df = pd.read_csv(csv_file, sep=',', header=0)
+    gold = load_gold_types(golden_file)
+    device, tokenizer, model = startup.load_classifier(data_folder, threads=threads)
+    print(f"\033[95m{len(df)} questions on {device}\033[0m")
+    fp32_labels = measure_classifier("fp32", lambda rows: question_understanding.predict_types(rows, device, tokenizer, model),
+                                     df, gold, repeats)
+    if device.type != 'cpu':
+        print("\033[95mDynamic int8 quantization only runs on the CPU, skipping it\033[0m")
+        return
+    _, _, quantized = startup.load_classifier(data_folder, threads=threads, quantize=True)
+    int8_labels = measure_classifier("dynamic int8", lambda rows: question_understanding.predict_types(rows, device, tokenizer, quantized),
+                                     df, gold, repeats)
+    agreement = sum(a == b for a, b in zip(fp32_labels, int8_labels)) / len(df)
+    print(f"\033[95mint8 agrees with fp32 on {agreement:.2%} of the questions\033[0m")
+
+# The classifier's logits for every question of the dataframe, in input order
+def classifier_logits(df, device, tokenizer, model):
+    import torch
+    import question_understanding
+    encoded_tokens, attention_mask = question_understanding.preprocess(df, tokenizer)
+    logits = {}
+    with torch.no_grad():
+        for positions, token_tensor, mask_tensor in question_understanding.feed_generator(device, encoded_tokens, attention_mask):
+            batch_logits = model(token_tensor, token_type_ids=None, attention_mask=mask_tensor)[0].cpu().numpy()
+            logits.update(zip(positions, batch_logits))
+    return np.array([logits[position] for position in sorted(logits)])
+
+# Returns True if the ONNX export predicts the same label as PyTorch for every question
+def benchmark_onnx(data_folder='data_modules', csv_file=EVALUATION_CSV, golden_file=GOLDEN_JSON, repeats=3, threads=None):
+    import startup
+    import question_understanding
+    df = pd.read_csv(csv_file, sep=',', header=0)
+    gold = load_gold_types(golden_file)
+    device, tokenizer, model = startup.load_classifier(data_folder, threads=threads)
+    onnx_device, _, onnx_model = startup.load_classifier(data_folder, threads=threads, backend='onnx')
+
+    torch_logits = classifier_logits(df, device, tokenizer, model)
+    onnx_logits = classifier_logits(df, onnx_device, tokenizer, onnx_model)
+    mismatches = [id for id, a, b in zip(df['ID'], torch_logits.argmax(-1), onnx_logits.argmax(-1)) if a != b]
+    print(f"\033[95mLabel parity: {len(df) - len(mismatches)}/{len(df)} questions agree, "
+          f"max |logit difference| {np.abs(torch_logits - onnx_logits).max():.2e}\033[0m")
+    for id in mismatches:
+        print(f"\033[91m  labels differ for {id}\033[0m")
+
+    print(f"\033[95m{len(df)} questions, PyTorch on {device}, ONNX Runtime on {onnx_device}\033[0m")
+    measure_classifier("PyTorch", lambda rows: question_understanding.predict_types(rows, device, tokenizer, model),
+                       df, gold, repeats)
+    measure_classifier("ONNX Runtime", lambda rows: question_understanding.predict_types(rows, onnx_device, tokenizer, onnx_model),
+                       df, gold, repeats)
+    return not mismatches
+
+def benchmark_cascade(data_folder='data_modules', csv_file=EVALUATION_CSV, golden_file=GOLDEN_JSON, repeats=3,
+                      thresholds=(0.7, 0.8, 0.9, 0.95, 0.99)):
+    import startup
+    import question_understanding
+    import question_type_cascade
+    df = pd.read_csv(csv_file, sep=',', header=0)
+    gold = load_gold_types(golden_file)
+    cascade = question_type_cascade.load_cascade()
+    if cascade is None:
+        return
+    device, tokenizer, model = startup.load_classifier(data_folder)
+    bert_labels, bert_seconds = timed_runs(lambda: question_understanding.predict_types(df, device, tokenizer, model), repeats)
+    bert_accuracy = accuracy(df['ID'], bert_labels, gold)
+    print(f"\033[95mBERT alone: accuracy {bert_accuracy:.2%}, {min(bert_seconds):.2f}s for {len(df)} questions\033[0m")
+    for threshold in thresholds:
+        cascade = question_type_cascade.CascadeClassifier(cascade.model, threshold=threshold)
+        confident = cascade.predict(list(df['Question']))
+        short_circuited = [(id, label) for id, label in zip(df['ID'], confident) if label is not None]
+        labels, seconds = timed_runs(lambda: question_understanding.predict_types(df, device, tokenizer, model, cascade=cascade), repeats)
+        cascade_accuracy = accuracy(df['ID'], labels, gold)
+        print(f"\033[95mthreshold {threshold:.2f}: {len(short_circuited) / len(df):6.1%} short-circuited "
+              f"(cascade accuracy on them {accuracy([id for id, _ in short_circuited], [label for _, label in short_circuited], gold):.2%}), "
+              f"overall accuracy {cascade_accuracy:.2%} ({cascade_accuracy - bert_accuracy:+.2%}), "
+              f"{min(seconds):.2f}s for {len(df)} questions\033[0m")
+
+# The queries QU generated for the evaluation questions if the QU stage file is there, otherwise the questions themselves
+def load_queries(csv_file=EVALUATION_CSV, qu_stage_file=QU_STAGE_FILE):
+    import os
+    import interchange
+    if os.path.isfile(qu_stage_file):
+        return [record['query'] or record['question'] for record in interchange.read_records(qu_stage_file)]
+    print(f"\033[95mNo QU stage file at {qu_stage_file}, searching for the questions themselves\033[0m")
+    return list(pd.read_csv(csv_file, sep=',', header=0)['Question'])
+
+def benchmark_search(data_folder='data_modules', index_var='full_index', csv_file=EVALUATION_CSV, repeats=3):
+    import startup
+    import information_retrieval
+    queries = load_queries(csv_file)
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    print(f"\033[95m{len(queries)} queries on {index_var}\033[0m")
+
+    def per_query(session):
+        pmids, seconds = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results = information_retrieval.search(indexer, parser, query, batch_mode=True, session=session)
+            seconds.append(time.perf_counter() - start)
+            pmids.append([result.pmid for result in results])
+        return pmids, seconds
+
+    # the first pass warms the OS page cache for both
+    per_query(None)
+    timings = {}
+    for name, use_session in (("searcher per query", None), ("SearcherSession", session)):
+        seconds = []
+        for _ in range(repeats):
+            pmids, run_seconds = per_query(use_session)
+            seconds.extend(run_seconds)
+        timings[name] = (pmids, seconds)
+        print_latencies(name, seconds)
+    (fresh_pmids, fresh_seconds), (session_pmids, session_seconds) = timings.values()
+    session.close()
+    print(f"\033[95mSearcherSession: {np.mean(fresh_seconds) / np.mean(session_seconds):.2f}x faster per query on average, "
+          f"same results for {sum(a == b for a, b in zip(fresh_pmids, session_pmids))}/{len(queries)} queries\033[0m")
+
+# The records of a stage file without the progress output, for comparing runs
+def stage_records(path):
+    import interchange
+    return list(interchange.read_records(path))
+
+def benchmark_batch_search(data_folder='data_modules', index_var='full_index', qu_stage_file=QU_STAGE_FILE,
+                           processes=(1, 2, 4, 8), output_dir="tmp/benchmark/"):
+    import os
+    import startup
+    import information_retrieval
+    import interchange
+    if not os.path.isfile(qu_stage_file):
+        print(f"\033[91mRun QU in batch mode first, {qu_stage_file} is needed\033[0m")
+        return False
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    num_questions = interchange.count_records(qu_stage_file)
+    serial = None
+    same = True
+    for n in processes:
+        output_file = f"{output_dir}ir_{n}_processes.jsonl"
+        start = time.perf_counter()
+        information_retrieval.batch_search(qu_stage_file, output_file, indexer, parser, session=session, processes=n)
+        seconds = time.perf_counter() - start
+        records = stage_records(output_file)
+        if serial is None:
+            serial = (seconds, records)
+        identical = records == serial[1]
+        same = same and identical
+        print(f"\033[95m{n} processes: {num_questions / seconds:.1f} queries/s, {serial[0] / seconds:.2f}x the first run, "
+              f"{'same output' if identical else 'DIFFERENT OUTPUT'}\033[0m")
+    session.close()
+    return same
+
+def benchmark_bm25(data_folder='data_modules', index_var='full_index', csv_file=EVALUATION_CSV, repeats=3, k=5):
+    import startup
+    import information_retrieval
+    from whoosh.qparser import OrGroup, QueryParser
+    queries = load_queries(csv_file)
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    engine = startup.load_bm25(data_folder, index_var)
+    if engine is None:
+        print("\033[91mBuild the BM25 postings first with python bm25.py\033[0m")
+        session.close()
+        return False
+    print(f"\033[95m{len(queries)} queries on {index_var}\033[0m")
+
+    def per_query(search):
+        pmids, seconds = [], []
+        for query in queries:
+            start = time.perf_counter()
+            pmids.append(search(query))
+            seconds.append(time.perf_counter() - start)
+        return pmids, seconds
+
+    def timed(name, search):
+        # the first pass warms the OS page cache
+        per_query(search)
+        seconds = []
+        for _ in range(repeats):
+            pmids, run_seconds = per_query(search)
+            seconds.extend(run_seconds)
+        print_latencies(name, seconds)
+        return pmids, seconds
+
+    def whoosh_search(query):
+        return [result.pmid for result in information_retrieval.search(indexer, parser, query, max_results=k,
+                                                                       batch_mode=True, session=session, hydrate=False)]
+
+    def bm25_search(query):
+        return [result.pmid for result in information_retrieval.search(indexer, parser, query, max_results=k,
+                                                                       batch_mode=True, session=session, hydrate=False,
+                                                                       engine=engine)]
+
+    supported = sum(engine.search_query(parser.parse(query), k) is not None for query in queries)
+    print(f"\033[95m{supported}/{len(queries)} queries are scored by BM25, the rest fall back to Whoosh\033[0m")
+    whoosh_pmids, whoosh_seconds = timed("Whoosh", whoosh_search)
+    bm25_pmids, bm25_seconds = timed("BM25", bm25_search)
+    overlap = [len(set(a) & set(b)) / max(len(a), len(b), 1) for a, b in zip(whoosh_pmids, bm25_pmids)]
+    print(f"\033[95mBM25: {np.mean(whoosh_seconds) / np.mean(bm25_seconds):.2f}x faster per query on average, "
+          f"same top {k} for {sum(a == b for a, b in zip(whoosh_pmids, bm25_pmids))}/{len(queries)} queries, "
+          f"mean overlap {np.mean(overlap):.3f}\033[0m")
+
+    # OR queries are where MaxScore skips work; the plain parser ANDs the terms
+    or_parser = QueryParser("abstract_text", schema=information_retrieval.pubmed_schema(), group=OrGroup)
+    parsed = [or_parser.parse(query) for query in queries]
+    results = {}
+    for name, max_score in (("BM25 OR, exhaustive", False), ("BM25 OR, MaxScore", True)):
+        seconds = []
+        for _ in range(repeats + 1):
+            pmids, run_seconds = [], []
+            for query in parsed:
+                start = time.perf_counter()
+                pmids.append(engine.search_query(query, k, max_score=max_score))
+                run_seconds.append(time.perf_counter() - start)
+            seconds.extend(run_seconds)
+        # drop the warm-up pass
+        seconds = seconds[len(parsed):]
+        results[name] = pmids
+        print_latencies(name, seconds)
+    exhaustive, pruned = results.values()
+    same = sum(a == b for a, b in zip(exhaustive, pruned))
+    print(f"\033[95mMaxScore: same results for {same}/{len(parsed)} OR queries\033[0m")
+    session.close()
+    return same == len(parsed)
+
+# {question id: [gold PMIDs]}
+def load_gold_documents(golden_file=GOLDEN_JSON):
+    import ast
+    with open(golden_file, "r") as file:
+        questions = json.load(file)['questions']
+    gold = {}
+    for question in questions:
+        # some questions have the list itself, others its repr
+        documents = question.get('documents') or []
+        if isinstance(documents, str):
+            documents = ast.literal_eval(documents)
+        gold[question['id']] = [url.rsplit('/', 1)[-1] for url in documents]
+    return gold
+
+def benchmark_dense(data_folder='data_modules', index_var='full_index', csv_file=EVALUATION_CSV, golden_file=GOLDEN_JSON,
+                    qu_stage_file=QU_STAGE_FILE, k=10, nprobes=(4, 16, 64)):
+    import os
+    import startup
+    import information_retrieval
+    import interchange
+    df = pd.read_csv(csv_file, sep=',', header=0)
+    gold = load_gold_documents(golden_file)
+    df = df[df['ID'].isin(gold.keys())]
+    records = {}
+    if os.path.isfile(qu_stage_file):
+        records = {record['id']: record for record in interchange.read_records(qu_stage_file)}
+    questions = [(id, question, (records.get(id) or {}).get('query') or question) for id, question in zip(df['ID'], df['Question'])]
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    dense = startup.load_dense(data_folder, index_var, mode='fuse')
+    if dense is None:
+        print("\033[91mBuild the dense index first with python dense_retrieval.py embed and ivf\033[0m")
+        session.close()
+        return
+    print(f"\033[95m{len(questions)} questions with gold documents, {len(dense.index)} embedded articles\033[0m")
+    # the questions are embedded once, so the dense latencies below are those of the index alone
+    embed_seconds = []
+    vectors = []
+    for _, question, _ in questions:
+        start = time.perf_counter()
+        vectors.append(dense.embedder.encode([question])[0])
+        embed_seconds.append(time.perf_counter() - start)
+    print_latencies("embedding the question", embed_seconds)
+
+    def measure(name, search):
+        found, seconds = [], []
+        for n, question in enumerate(questions):
+            start = time.perf_counter()
+            found.append([pmid for pmid, _ in search(n, question)])
+            seconds.append(time.perf_counter() - start)
+        recall = np.mean([len(set(pmids) & set(gold[id])) / len(gold[id]) for pmids, (id, _, _) in zip(found, questions)
+                          if gold[id]])
+        print(f"\033[95m  {name:<24} recall@{k} {recall:.3f}\033[0m")
+        print_latencies(name, seconds)
+        return found
+
+    def whoosh(n, question):
+        return [[result.pmid, result.score] for result in information_retrieval.search(
+            indexer, parser, question[2], max_results=k, batch_mode=True, session=session, hydrate=False)]
+    measure("Whoosh", whoosh)
+    exact = measure("dense, exact", lambda n, question: dense.index.search_vector(vectors[n], k, None))
+    for nprobe in nprobes:
+        found = measure(f"dense, nprobe {nprobe}", lambda n, question: dense.index.search_vector(vectors[n], k, nprobe))
+        print(f"\033[95m  nprobe {nprobe}: recall@{k} against exact search "
+              f"{np.mean([len(set(a) & set(b)) / max(len(b), 1) for a, b in zip(found, exact)]):.3f}\033[0m")
+
+    # through search as the system runs it, fusing dense.depth results from each side; this includes embedding the
+    # question
+    def fused(n, question):
+        return [[result.pmid, result.score] for result in information_retrieval.search(
+            indexer, parser, question[2], max_results=k, batch_mode=True, session=session, hydrate=False, dense=dense,
+            question=question[1])]
+    measure(f"fused, nprobe {dense.nprobe}", fused)
+    session.close()
+
+def benchmark_rerank(data_folder='data_modules', index_var='full_index', csv_file=EVALUATION_CSV, golden_file=GOLDEN_JSON,
+                     qu_stage_file=QU_STAGE_FILE, k=5, depth=100):
+    import os
+    import startup
+    import information_retrieval
+    import interchange
+    df = pd.read_csv(csv_file, sep=',', header=0)
+    gold = load_gold_documents(golden_file)
+    df = df[df['ID'].isin(gold.keys())]
+    records = {}
+    if os.path.isfile(qu_stage_file):
+        records = {record['id']: record for record in interchange.read_records(qu_stage_file)}
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    ranker = startup.load_reranker(data_folder, index_var, depth=depth)
+    if ranker is None:
+        print("\033[91mBuild the token store first with python reranker.py\033[0m")
+        session.close()
+        return
+    print(f"\033[95m{len(df)} questions with gold documents, {len(ranker.store)} articles in the token store\033[0m")
+
+    def recall(found):
+        return np.mean([len(set(pmids) & set(gold[id])) / len(gold[id]) for id, pmids in zip(df['ID'], found) if gold[id]])
+
+    top_k, reranked, seconds = [], [], []
+    for id, question in zip(df['ID'], df['Question']):
+        query = (records.get(id) or {}).get('query') or question
+        hits = [[result.pmid, result.score] for result in information_retrieval.search(
+            indexer, parser, query, max_results=depth, batch_mode=True, session=session, hydrate=False)]
+        top_k.append([pmid for pmid, _ in hits[:k]])
+        start = time.perf_counter()
+        reranked.append([pmid for pmid, _ in ranker.rerank(question, hits, k)])
+        seconds.append(time.perf_counter() - start)
+    print(f"\033[95m  Whoosh top {k:<16} recall@{k} {recall(top_k):.3f}\033[0m")
+    print(f"\033[95m  top {depth} reranked{'':<8} recall@{k} {recall(reranked):.3f}\033[0m")
+    print_latencies("reranking", seconds)
+    session.close()
+
+def benchmark_shards(data_folder='data_modules', index_var='full_index', sharded_var='sharded_index',
+                     csv_file=EVALUATION_CSV, repeats=3, k=10, processes=(1, None)):
+    import startup
+    import information_retrieval
+    queries = load_queries(csv_file)
+    indexer, parser, session = startup.load_index(data_folder, index_var)
+    print(f"\033[95m{len(queries)} queries on {index_var} and {sharded_var}\033[0m")
+
+    def per_query(indexer, session):
+        hits, seconds = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results = information_retrieval.search(indexer, parser, query, max_results=k, batch_mode=True,
+                                                   session=session, hydrate=False)
+            seconds.append(time.perf_counter() - start)
+            hits.append([(result.pmid, result.score) for result in results])
+        return hits, seconds
+
+    def timed(name, indexer, session):
+        # the first pass warms the OS page cache and starts the shard workers
+        hits, _ = per_query(indexer, session)
+        seconds = []
+        for _ in range(repeats):
+            _, run_seconds = per_query(indexer, session)
+            seconds.extend(run_seconds)
+        print_latencies(name, seconds)
+        return hits, seconds
+
+    # results can only differ in the order of articles that score the same
+    def same_ranking(a, b):
+        return a == b or (len(a) == len(b) and all(abs(x[1] - y[1]) < 1e-6 for x, y in zip(a, b))
+                          and {pmid for pmid, score in a if score > a[-1][1] + 1e-6} ==
+                          {pmid for pmid, score in b if score > b[-1][1] + 1e-6})
+
+    single_hits, single_seconds = timed("one index", indexer, session)
+    session.close()
+    same = True
+    for n in processes:
+        sharded, _, sharded_session = startup.load_index(data_folder, sharded_var, shard_processes=n)
+        name = "shards, serial" if n == 1 else f"shards, {sharded.processes} processes"
+        sharded_hits, sharded_seconds = timed(name, sharded, sharded_session)
+        identical = sum([x[0] for x in a] == [y[0] for y in b] for a, b in zip(single_hits, sharded_hits))
+        consistent = sum(same_ranking(a, b) for a, b in zip(single_hits, sharded_hits))
+        score_diff = max([0.0] + [abs(x[1] - y[1]) for a, b in zip(single_hits, sharded_hits) for x, y in zip(a, b)])
+        print(f"\033[95m{name}: {np.mean(single_seconds) / np.mean(sharded_seconds):.2f}x the speed of one index, "
+              f"same top {k} for {identical}/{len(queries)} queries, the same but for ties for {consistent}, "
+              f"max score difference {score_diff:.2e}\033[0m")
+        same = same and consistent == len(queries)
+        sharded_session.close()
+        sharded.close()
+    return same
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Benchmarks for the BioASQ question answering system')
+    subparsers = arg_parser.add_subparsers(dest='benchmark', required=True)
+    classifier_parser = subparsers.add_parser('classifier', help='fp32 against dynamic int8 question type classifier')
+    classifier_parser.add_argument('--csv', default=EVALUATION_CSV)
+    classifier_parser.add_argument('--repeats', type=int, default=3)
+    classifier_parser.add_argument('--threads', type=int, default=None)
+    onnx_parser = subparsers.add_parser('onnx', help='PyTorch against ONNX Runtime question type classifier')
+    onnx_parser.add_argument('--csv', default=EVALUATION_CSV)
+    onnx_parser.add_argument('--repeats', type=int, default=3)
+    onnx_parser.add_argument('--threads', type=int, default=None)
+    cascade_parser = subparsers.add_parser('cascade', help='BERT against the question type cascade with BERT fallback')
+    cascade_parser.add_argument('--csv', default=EVALUATION_CSV)
+    cascade_parser.add_argument('--repeats', type=int, default=3)
+    search_parser = subparsers.add_parser('search', help='a searcher per query against one SearcherSession')
+    search_parser.add_argument('--csv', default=EVALUATION_CSV)
+    search_parser.add_argument('--index', default='full_index')
+    search_parser.add_argument('--repeats', type=int, default=3)
+    batch_search_parser = subparsers.add_parser('batch-search', help='batch_search throughput with 1 to N processes')
+    batch_search_parser.add_argument('--index', default='full_index')
+    batch_search_parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    bm25_parser = subparsers.add_parser('bm25', help='Whoosh against the NumPy BM25 backend')
+    bm25_parser.add_argument('--csv', default=EVALUATION_CSV)
+    bm25_parser.add_argument('--index', default='full_index')
+    bm25_parser.add_argument('--repeats', type=int, default=3)
+    dense_parser = subparsers.add_parser('dense', help='recall@k and latency of dense retrieval and its fusion with Whoosh')
+    dense_parser.add_argument('--csv', default=EVALUATION_CSV)
+    dense_parser.add_argument('--index', default='full_index')
+    dense_parser.add_argument('--k', type=int, default=10)
+    dense_parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    rerank_parser = subparsers.add_parser('rerank', help='recall@k with and without the late interaction reranker')
+    rerank_parser.add_argument('--csv', default=EVALUATION_CSV)
+    rerank_parser.add_argument('--index', default='full_index')
+    rerank_parser.add_argument('--k', type=int, default=5)
+    rerank_parser.add_argument('--depth', type=int, default=100)
+    shards_parser = subparsers.add_parser('shards', help='an index in one piece against the same index in shards')
+    shards_parser.add_argument('--csv', default=EVALUATION_CSV)
+    shards_parser.add_argument('--index', default='full_index')
+    shards_parser.add_argument('--sharded-index', default='sharded_index')
+    shards_parser.add_argument('--k', type=int, default=10)
+    shards_parser.add_argument('--repeats', type=int, default=3)
+    args = arg_parser.parse_args()
+    if args.benchmark == 'classifier':
+        benchmark_classifier(csv_file=args.csv, repeats=args.repeats, threads=args.threads)
+    elif args.benchmark == 'onnx':
+        if not benchmark_onnx(csv_file=args.csv, repeats=args.repeats, threads=args.threads):
+            sys.exit(1)
+    elif args.benchmark == 'cascade':
+        benchmark_cascade(csv_file=args.csv, repeats=args.repeats)
+    elif args.benchmark == 'search':
+        benchmark_search(index_var=args.index, csv_file=args.csv, repeats=args.repeats)
+    elif args.benchmark == 'batch-search':
+        if not benchmark_batch_search(index_var=args.index, processes=args.processes):
+            sys.exit(1)
+    elif args.benchmark == 'bm25':
+        if not benchmark_bm25(index_var=args.index, csv_file=args.csv, repeats=args.repeats):
+            sys.exit(1)
+    elif args.benchmark == 'dense':
+        benchmark_dense(index_var=args.index, csv_file=args.csv, k=args.k, nprobes=args.nprobe)
+    elif args.benchmark == 'rerank':
+        benchmark_rerank(index_var=args.index, csv_file=args.csv, k=args.k, depth=args.depth)
+    elif args.benchmark == 'shards':
+        if not benchmark_shards(index_var=args.index, sharded_var=args.sharded_index, csv_file=args.csv, k=args.k,
+                                repeats=args.repeats):
+            sys.exit(1)
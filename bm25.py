@@ -0,0 +1,270 @@
+"""
+bm25.py is a BM25 retrieval backend on memory-mapped NumPy arrays, for information_retrieval.search to use instead of
+Whoosh's pure python scoring loop (set retrieval_backend = 'bm25' in qa_system.py).
+    It is built from an existing Whoosh index and scores exactly as Whoosh's BM25F does on it: the same analyzed terms
+    (queries are still parsed by the Whoosh QueryParser), the same idf, the same average field length and the same
+    one-byte field lengths, so both return the same articles.
+
+    An index is a directory of flat arrays, all memory mapped:
+        terms.bin, term_offsets.npy   the sorted terms of the field, as utf-8, and where each one starts
+        postings_start.npy            where the postings of each term start in docs.bin and tfs.bin
+        docs.bin, tfs.bin             document numbers (uint32) and term frequencies (uint16) of every posting
+        idf.npy, max_impact.npy       idf of every term and the highest score it gives any document
+        doc_lengths.npy               the field length of every document, one byte as Whoosh stores it
+        length_table.npy              the field length each of the 256 byte values stands for
+        pmids.npy                     the PMID of every document number, -1 for deleted documents
+        meta.json                     field, document count, average field length, K1, B and the generation of the
+                                      Whoosh index it was built from
+    Postings are kept at 6 bytes each rather than block compressed, so a term's postings are a plain slice of the file.
+    Document numbers are only those of the index generation the postings were built from, since a commit to the
+    index, like build_index.py update, can delete documents and renumber the rest, so once the index has changed the
+    postings have to be built again (startup.load_bm25 does not use them until they are).
+
+    Queries that are one term, or an AND (Whoosh's default) or OR of plain terms, are scored here; anything else, such
+    as phrases or negations, returns None and is left to Whoosh. AND queries intersect the postings of the terms
+    rarest first. OR queries use MaxScore: once the best possible score of the terms not scored yet cannot reach the
+    k-th best score so far, those terms only add to the documents already found, and documents that can no longer
+    reach the top k are dropped.
+
+    python bm25.py [--index data_modules/index/full_index] [--output data_modules/bm25/full_index]
+builds the index. python benchmark.py bm25 compares it with Whoosh.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+BM25_FOLDER = f"data_modules{os.path.sep}bm25"
+
+class BM25Index:
+    name = 'bm25'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as meta:
+            meta = json.load(meta)
+        self.field = meta['field']
+        self.avgdl = meta['avgdl']
+        self.K1 = meta['K1']
+        self.B = meta['B']
+        # None for postings built before the generation was recorded
+        self.generation = meta.get('generation')
+        self.term_blob = np.memmap(os.path.join(path, "terms.bin"), dtype=np.uint8, mode='r')
+        self.term_offsets = np.load(os.path.join(path, "term_offsets.npy"), mmap_mode='r')
+        self.starts = np.load(os.path.join(path, "postings_start.npy"), mmap_mode='r')
+        self.idf = np.load(os.path.join(path, "idf.npy"), mmap_mode='r')
+        self.max_impact = np.load(os.path.join(path, "max_impact.npy"), mmap_mode='r')
+        self.docs = np.memmap(os.path.join(path, "docs.bin"), dtype='<u4', mode='r')
+        self.tfs = np.memmap(os.path.join(path, "tfs.bin"), dtype='<u2', mode='r')
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode='r')
+        self.length_table = np.load(os.path.join(path, "length_table.npy"))
+        self.pmids = np.load(os.path.join(path, "pmids.npy"), mmap_mode='r')
+
+    def _term(self, n):
+        return bytes(self.term_blob[self.term_offsets[n]:self.term_offsets[n + 1]])
+
+    # The number of a term, by binary search over the sorted terms, or None if no document has it
+    def term_id(self, term):
+        key = term.encode('utf-8') if isinstance(term, str) else term
+        lo, hi = 0, len(self.term_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_offsets) - 1 and self._term(lo) == key:
+            return lo
+        return None
+
+    def postings(self, term_id):
+        start, end = self.starts[term_id], self.starts[term_id + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+    # The BM25 score term_id gives each of docs, written as whoosh.scoring.bm25 computes it
+    def scores(self, term_id, docs, tfs):
+        tf = tfs.astype(np.float64)
+        fl = self.length_table[self.doc_lengths[docs]]
+        return self.idf[term_id] * ((tf * (self.K1 + 1)) / (tf + self.K1 * ((1 - self.B) + self.B * fl / self.avgdl)))
+
+    # The documents with every term, and their scores
+    def _conjunctive(self, term_ids):
+        term_ids = sorted(term_ids, key=lambda t: self.starts[t + 1] - self.starts[t])
+        docs, tfs = self.postings(term_ids[0])
+        docs = np.asarray(docs)
+        total = self.scores(term_ids[0], docs, tfs)
+        for term_id in term_ids[1:]:
+            term_docs, term_tfs = self.postings(term_id)
+            if len(docs) == 0 or len(term_docs) == 0:
+                return docs[:0], total[:0]
+            positions = np.minimum(np.searchsorted(term_docs, docs), len(term_docs) - 1)
+            found = term_docs[positions] == docs
+            docs, total, positions = docs[found], total[found], positions[found]
+            total = total + self.scores(term_id, docs, term_tfs[positions])
+        return docs, total
+
+    # The documents with any of the terms and their scores, with MaxScore pruning if max_score is set.
+    # The terms are added in order of their highest score, so the sums are the same with and without pruning.
+    def _disjunctive(self, term_ids, k, max_score=True):
+        term_ids = sorted(term_ids, key=lambda t: -self.max_impact[t])
+        # remaining[i] is the most the terms from i on can add to a document's score
+        remaining = np.append(np.cumsum([self.max_impact[t] for t in term_ids][::-1])[::-1], 0.0)
+        docs = np.empty(0, dtype=np.int64)
+        total = np.empty(0, dtype=np.float64)
+        threshold = -np.inf
+        for i, term_id in enumerate(term_ids):
+            term_docs, term_tfs = self.postings(term_id)
+            if len(term_docs) == 0:
+                continue
+            if max_score and len(docs) >= k and remaining[i] < threshold:
+                # no document that has none of the terms so far can make the top k any more
+                docs = docs[total + remaining[i] >= threshold]
+                total = total[total + remaining[i] >= threshold]
+                positions = np.minimum(np.searchsorted(term_docs, docs), len(term_docs) - 1)
+                found = term_docs[positions] == docs
+                total[found] += self.scores(term_id, docs[found], term_tfs[positions[found]])
+            else:
+                docs, inverse = np.unique(np.concatenate([docs, term_docs]), return_inverse=True)
+                total = np.bincount(inverse, weights=np.concatenate([total, self.scores(term_id, term_docs, term_tfs)]),
+                                    minlength=len(docs))
+            if len(total) >= k:
+                threshold = total[np.argpartition(-total, k - 1)[k - 1]]
+        return docs, total
+
+    # The k best documents as [[pmid, score], ...], best first, ties broken by document number as Whoosh does
+    def _top(self, docs, total, k):
+        if len(total) > k:
+            kth = total[np.argpartition(-total, k - 1)[k - 1]]
+            keep = np.flatnonzero(total >= kth)
+            docs, total = docs[keep], total[keep]
+        order = np.lexsort((docs, -total))[:k]
+        return [[str(self.pmids[doc]), float(score)] for doc, score in zip(docs[order], total[order])]
+
+    # Score analyzed terms; conjunctive requires every term, like Whoosh's default AND grouping
+    def search_terms(self, terms, k=5, conjunctive=True, max_score=True):
+        term_ids = [self.term_id(term) for term in terms]
+        if conjunctive and None in term_ids:
+            return []
+        term_ids = [term_id for term_id in term_ids if term_id is not None]
+        if not term_ids:
+            return []
+        if conjunctive:
+            docs, total = self._conjunctive(term_ids)
+        else:
+            docs, total = self._disjunctive(term_ids, k, max_score)
+        return self._top(docs, total, k)
+
+    # Search a query parsed by Whoosh. Returns None for queries this backend does not score.
+    def search_query(self, parsed_query, limit=5, max_score=True):
+        terms, conjunctive = query_terms(parsed_query, self.field)
+        if terms is None:
+            return None
+        return self.search_terms(terms, limit, conjunctive, max_score)
+
+
+# (terms, conjunctive) for a parsed Whoosh query made of plain terms on field, (None, None) for any other query
+def query_terms(parsed_query, field):
+    from whoosh import query
+    if parsed_query is query.NullQuery:
+        return [], True
+    if isinstance(parsed_query, query.Term):
+        subqueries, conjunctive = [parsed_query], True
+    elif isinstance(parsed_query, (query.And, query.Or)):
+        subqueries, conjunctive = parsed_query.subqueries, isinstance(parsed_query, query.And)
+    else:
+        return None, None
+    if not all(type(subquery) is query.Term and subquery.fieldname == field and subquery.boost == 1.0
+               for subquery in subqueries):
+        return None, None
+    return [subquery.text for subquery in subqueries], conjunctive
+
+# The BM25 index for an index, or None if it has not been built
+def open_bm25(path):
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    return BM25Index(path)
+
+
+# The generation of the Whoosh index in index_dir, which every commit to it changes, or None if it is sharded
+def index_generation(index_dir, indexname='pubmed_articles'):
+    from whoosh import index
+    import sharded_index
+    if sharded_index.is_sharded(index_dir):
+        return None
+    return index.open_dir(index_dir, indexname=indexname).latest_generation()
+
+# Build a BM25 index from the postings, field lengths and statistics of a field of a Whoosh index
+def build_from_whoosh(indexer, path, field='abstract_text'):
+    from whoosh.scoring import BM25F
+    from whoosh.util.numeric import byte_to_length, length_to_byte
+    os.makedirs(path, exist_ok=True)
+    started = time.perf_counter()
+    with indexer.searcher() as searcher:
+        reader = searcher.reader()
+        generation = reader.generation()
+        doc_count = reader.doc_count_all()
+        print(f"\033[95mReading the field lengths and PMIDs of {doc_count} documents\033[0m")
+        doc_lengths = np.zeros(doc_count, dtype=np.uint8)
+        pmids = np.full(doc_count, -1, dtype=np.int64)
+        for docnum in range(doc_count):
+            if reader.is_deleted(docnum):
+                continue
+            doc_lengths[docnum] = length_to_byte(reader.doc_field_length(docnum, field, 0))
+            pmids[docnum] = int(reader.stored_fields(docnum)['pmid'])
+        np.save(os.path.join(path, "doc_lengths.npy"), doc_lengths)
+        np.save(os.path.join(path, "pmids.npy"), pmids)
+        length_table = np.array([byte_to_length(n) for n in range(256)], dtype=np.float64)
+        np.save(os.path.join(path, "length_table.npy"), length_table)
+
+        weighting = BM25F()
+        avgdl = searcher.avg_field_length(field) or 1
+        term_offsets, starts, idfs, max_impacts = [0], [0], [], []
+        previous = None
+        with open(os.path.join(path, "terms.bin"), "wb") as terms_file, \
+             open(os.path.join(path, "docs.bin"), "wb") as docs_file, \
+             open(os.path.join(path, "tfs.bin"), "wb") as tfs_file:
+            for n, term in enumerate(reader.lexicon(field), 1):
+                if previous is not None and term <= previous:
+                    raise ValueError(f"The lexicon of {field} is not sorted at {term!r}")
+                previous = term
+                items = list(reader.postings(field, term).items_as("frequency"))
+                docs = np.array([docnum for docnum, _ in items], dtype='<u4')
+                tfs = np.minimum(np.array([frequency for _, frequency in items]), 65535).astype('<u2')
+                idf = searcher.idf(field, term)
+                tf = tfs.astype(np.float64)
+                fl = length_table[doc_lengths[docs]]
+                impact = idf * ((tf * (weighting.K1 + 1)) / (tf + weighting.K1 * ((1 - weighting.B) + weighting.B * fl / avgdl)))
+                terms_file.write(term)
+                docs.tofile(docs_file)
+                tfs.tofile(tfs_file)
+                term_offsets.append(term_offsets[-1] + len(term))
+                starts.append(starts[-1] + len(docs))
+                idfs.append(idf)
+                max_impacts.append(impact.max() if len(impact) else 0.0)
+                if n % 100000 == 0:
+                    print(f"\033[95m{n} terms, {starts[-1]} postings ({time.perf_counter() - started:.0f}s)\033[0m")
+        np.save(os.path.join(path, "term_offsets.npy"), np.array(term_offsets, dtype=np.int64))
+        np.save(os.path.join(path, "postings_start.npy"), np.array(starts, dtype=np.int64))
+        np.save(os.path.join(path, "idf.npy"), np.array(idfs, dtype=np.float64))
+        np.save(os.path.join(path, "max_impact.npy"), np.array(max_impacts, dtype=np.float64))
+        with open(os.path.join(path, "meta.json"), "w") as meta:
+            json.dump({'field': field, 'doc_count': doc_count, 'avgdl': avgdl, 'K1': weighting.K1, 'B': weighting.B,
+                       'generation': generation}, meta)
+    print(f"\033[95mWrote {len(idfs)} terms and {starts[-1]} postings to {path} in {time.perf_counter() - started:.0f}s\033[0m")
+
+
+if __name__ == "__main__":
+    from whoosh import index
+    arg_parser = argparse.ArgumentParser(description='Build the NumPy BM25 index from the Whoosh index')
+    arg_parser.add_argument('--index', default=f"data_modules{os.path.sep}index{os.path.sep}full_index")
+    arg_parser.add_argument('--index-name', default='pubmed_articles')
+    arg_parser.add_argument('--output', default=f"{BM25_FOLDER}{os.path.sep}full_index")
+    arg_parser.add_argument('--field', default='abstract_text')
+    args = arg_parser.parse_args()
+    import sharded_index
+    if sharded_index.is_sharded(args.index):
+        # the postings are numbered by Whoosh document number, which is only unique within an index in one piece
+        arg_parser.error(f"{args.index} is sharded, build the postings from an index in one piece")
+    build_from_whoosh(index.open_dir(args.index, indexname=args.index_name), args.output, field=args.field)
@@ -0,0 +1,251 @@
+"""
+build_index.py builds the pubmed_articles Whoosh index from the PubMed baseline and update files
+(https://ftp.ncbi.nlm.nih.gov/pubmed/), with the same schema information_retrieval.py searches.
+    python build_index.py build  data/baseline/*.xml.gz [--index data_modules/index/full_index] [--docstore ...]
+    python build_index.py update data/updatefiles/*.xml.gz [--index ...] [--docstore ...]
+    python build_index.py build  data/baseline/*.xml.gz --shard-by pmid|year [--bounds ...] [--shards 8]
+
+The files are parsed in a pool of processes with lxml iterparse, so no file is ever held in memory as a whole, and
+the parsed articles are written through a Whoosh writer that indexes in --procs processes. With --multisegment each of
+them leaves its own segment instead of merging them all into one at the end; --optimize merges every segment into one
+and --no-merge leaves the small segments of earlier commits alone.
+
+update applies update files in order on an existing index: every article in them replaces the article with the same
+PMID and every <DeleteCitation> PMID is removed. Each update file is committed on its own, so an interrupted update
+can be started again from the file it stopped at.
+
+With --docstore the article text goes to a document store (see docstore.py) and the index only stores PMIDs. Such an
+index can only be updated with its store. Updating an index that stores the text with --docstore copies the text of
+every article already in it to a new store first.
+
+With --shard-by pmid or year the index is built as shards (see sharded_index.py), split at the PMIDs or years given
+with --bounds, or, for PMIDs, into --shards ranges of the same size up to --max-pmid. Each shard is an index of its
+own and update finds the shards on its own.
+"""
+import argparse
+import glob
+import gzip
+import multiprocessing
+import os
+import re
+import time
+
+from lxml import etree as ET
+
+INDEX_NAME = 'pubmed_articles'
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+def _text(element):
+    return "".join(element.itertext()).strip() if element is not None else None
+
+# The year of publication of an article: its PubDate year, or the first year in a free text MedlineDate
+def _year(article):
+    year = article.find("Journal/JournalIssue/PubDate/Year")
+    if year is not None and year.text:
+        return int(year.text)
+    medline_date = _text(article.find("Journal/JournalIssue/PubDate/MedlineDate"))
+    match = re.search(r"\d{4}", medline_date or "")
+    return int(match.group()) if match else None
+
+# The fields of a <PubmedArticle>, with the names of the index schema
+def article_fields(element):
+    citation = element.find("MedlineCitation")
+    article = citation.find("Article")
+    abstract = [_text(part) for part in article.findall("Abstract/AbstractText")]
+    # the headings that are a major topic of the article, on their own or through one of their qualifiers
+    mesh_major = [_text(heading.find("DescriptorName")) for heading in citation.findall("MeshHeadingList/MeshHeading")
+                  if heading.find("DescriptorName").get("MajorTopicYN") == "Y"
+                  or any(qualifier.get("MajorTopicYN") == "Y" for qualifier in heading.findall("QualifierName"))]
+    return {'pmid': citation.find("PMID").text,
+            'title': _text(article.find("ArticleTitle")),
+            'journal': _text(article.find("Journal/Title")),
+            'year': _year(article),
+            'abstract_text': " ".join(part for part in abstract if part) or None,
+            'mesh_major': mesh_major}
+
+# Parse one PubMed xml file. Returns (path, [article fields], [PMIDs to delete]).
+def parse_file(path):
+    articles = []
+    deleted = []
+    for _, element in ET.iterparse(_open(path), events=("end",), tag=("PubmedArticle", "DeleteCitation")):
+        if element.tag == "PubmedArticle":
+            try:
+                articles.append(article_fields(element))
+            except AttributeError as e:
+                print(f"\033[91mSkipping a malformed article in {path}: {e}\033[0m")
+        else:
+            deleted.extend(pmid.text for pmid in element.findall("PMID"))
+        # free the parsed elements as we go
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return path, articles, deleted
+
+# The document to add to the index for the fields of an article. Whoosh cannot index a missing value and needs
+# mesh_major as a string, so the list itself is only stored.
+def index_document(fields, store_text):
+    document = {name: value for name, value in fields.items() if value is not None and name != 'mesh_major'}
+    document['mesh_major'] = ";".join(fields['mesh_major'])
+    if store_text:
+        document['_stored_mesh_major'] = fields['mesh_major']
+    return document
+
+
+# PMID bounds that split 1 to max_pmid into shards ranges of the same size
+def pmid_bounds(shards, max_pmid):
+    return [max_pmid * n // shards for n in range(1, shards)]
+
+
+# Builds or updates an index, or every shard of a sharded index given a layout (a sharded_index.ShardLayout).
+# An existing sharded index keeps its own layout.
+class IndexBuilder:
+    def __init__(self, index_dir, docstore_dir=None, procs=1, limitmb=256, multisegment=False, create=False, layout=None):
+        from whoosh import index
+        import information_retrieval
+        import sharded_index
+        if not create and sharded_index.is_sharded(index_dir):
+            layout = sharded_index.ShardLayout.load(index_dir)
+        elif layout is not None:
+            layout.save(index_dir)
+        elif sharded_index.is_sharded(index_dir):
+            # an index built in one piece where a sharded one was
+            os.remove(os.path.join(index_dir, sharded_index.SHARDS_FILE))
+        self.layout = layout
+        index_dirs = layout.shard_dirs(index_dir) if layout is not None else [index_dir]
+        self.indexers = []
+        for shard_dir in index_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+            if create or not index.exists_in(shard_dir, indexname=INDEX_NAME):
+                self.indexers.append(index.create_in(shard_dir, information_retrieval.pubmed_schema(store_text=docstore_dir is None),
+                                                     indexname=INDEX_NAME))
+            else:
+                self.indexers.append(index.open_dir(shard_dir, indexname=INDEX_NAME))
+        # an existing index keeps storing the text if it was built that way
+        self.store_text = self.indexers[0].schema['abstract_text'].stored
+        if not self.store_text and docstore_dir is None:
+            raise ValueError(f"{index_dir} keeps the article text in a document store, give it with --docstore")
+        self.docstore_dir = docstore_dir
+        self.create = create
+        if not create and docstore_dir is not None and not os.path.isfile(os.path.join(docstore_dir, "meta.json")):
+            # a store that only had the updated articles would hide the text of all the others
+            if not self.store_text:
+                raise ValueError(f"There is no document store at {docstore_dir} and {index_dir} does not store the "
+                                 f"article text to build one from")
+            import docstore
+            docstore.build_from_index(sharded_index.open_index(index_dir, INDEX_NAME, processes=1), docstore_dir)
+        self.writer_args = {'procs': procs, 'limitmb': limitmb}
+        if procs > 1:
+            self.writer_args['multisegment'] = multisegment
+
+    # The generation of the index, as sharded_index.index_generation gives it
+    def generation(self):
+        if self.layout is not None:
+            return [indexer.latest_generation() for indexer in self.indexers]
+        return self.indexers[0].latest_generation()
+
+    # The shard an article goes to, and the shards an article with a PMID may already be in
+    def _shard_of(self, fields):
+        return self.layout.shard_of(fields) if self.layout is not None else 0
+
+    def _shards_of_pmid(self, pmid):
+        return self.layout.shards_of_pmid(pmid) if self.layout is not None else [0]
+
+    # Parse the files in parse_procs processes and apply them to the index, and the document store, in order.
+    # With commit_each_file every file is committed on its own, otherwise all of them are committed together.
+    def run(self, files, parse_procs, commit_each_file=False, merge=True, optimize=False):
+        import docstore
+        store = None
+        if self.docstore_dir is not None:
+            store = docstore.DocStoreWriter(self.docstore_dir, append=not self.create)
+        started = time.perf_counter()
+        articles = 0
+        # a writer for every shard written to since the last commit
+        writers = {}
+
+        def writer(shard):
+            if shard not in writers:
+                writers[shard] = self.indexers[shard].writer(**self.writer_args)
+            return writers[shard]
+
+        def commit():
+            for shard_writer in writers.values():
+                shard_writer.commit(merge=merge, optimize=optimize)
+            writers.clear()
+
+        try:
+            with multiprocessing.get_context('spawn').Pool(parse_procs) as pool:
+                # imap keeps the files in order, which matters for update files
+                for n, (path, parsed, deleted) in enumerate(pool.imap(parse_file, files), 1):
+                    for pmid in deleted:
+                        for shard in self._shards_of_pmid(pmid):
+                            writer(shard).delete_by_term('pmid', pmid)
+                        if store is not None:
+                            store.delete(pmid)
+                    for fields in parsed:
+                        if not self.create:
+                            # an article in an update file replaces the version already in the index, which may be in
+                            # another shard if the index is split by year
+                            for shard in self._shards_of_pmid(fields['pmid']):
+                                writer(shard).delete_by_term('pmid', fields['pmid'])
+                        writer(self._shard_of(fields)).add_document(**index_document(fields, self.store_text))
+                        if store is not None:
+                            store.add(fields)
+                    articles += len(parsed)
+                    print(f"\033[95m[{n}/{len(files)}] {path}: {len(parsed)} articles, {len(deleted)} deletions "
+                          f"({articles / (time.perf_counter() - started):.0f} articles/s)\033[0m")
+                    if commit_each_file:
+                        commit()
+                        if store is not None:
+                            store.generation = self.generation()
+                            store.close()
+                            store = docstore.DocStoreWriter(self.docstore_dir, append=True)
+        except BaseException:
+            # an interrupted run leaves the document store as it was after the last file it committed
+            if store is not None:
+                store.discard()
+            raise
+        if writers:
+            print("\033[95mCommitting the index...\033[0m")
+            commit()
+        if store is not None:
+            store.generation = self.generation()
+            store.close()
+        counts = [indexer.doc_count() for indexer in self.indexers]
+        print(f"\033[95m{articles} articles indexed in {time.perf_counter() - started:.0f}s, {sum(counts)} in the index"
+              + (f" ({', '.join(str(count) for count in counts)} in its shards)" if len(counts) > 1 else "") + "\033[0m")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Build or update the PubMed index')
+    arg_parser.add_argument('mode', choices=['build', 'update'])
+    arg_parser.add_argument('files', nargs='+', help='PubMed xml or xml.gz files, or glob patterns for them')
+    arg_parser.add_argument('--index', default=f"data_modules{os.path.sep}index{os.path.sep}full_index")
+    arg_parser.add_argument('--docstore', default=None, help='write the article text to a document store at this path')
+    arg_parser.add_argument('--parse-procs', type=int, default=max(1, os.cpu_count() // 2))
+    arg_parser.add_argument('--procs', type=int, default=max(1, os.cpu_count() // 2), help='indexing processes')
+    arg_parser.add_argument('--limitmb', type=int, default=256, help='memory per indexing process')
+    arg_parser.add_argument('--multisegment', action='store_true', help='leave one segment per indexing process')
+    arg_parser.add_argument('--no-merge', action='store_true', help='do not merge small segments on commit')
+    arg_parser.add_argument('--optimize', action='store_true', help='merge every segment into one on commit')
+    arg_parser.add_argument('--shard-by', choices=['pmid', 'year'], default=None, help='build the index as shards')
+    arg_parser.add_argument('--bounds', type=int, nargs='+', default=None, help='the PMIDs or years the shards start at')
+    arg_parser.add_argument('--shards', type=int, default=8, help='number of PMID range shards without --bounds')
+    arg_parser.add_argument('--max-pmid', type=int, default=40000000, help='the end of the last PMID range')
+    args = arg_parser.parse_args()
+    # update files are applied in the order of their names, which is the order PubMed publishes them in
+    files = sorted(path for pattern in args.files for path in (glob.glob(pattern) or [pattern]))
+    layout = None
+    if args.shard_by is not None:
+        import sharded_index
+        if args.bounds is None and args.shard_by == 'year':
+            arg_parser.error("--shard-by year needs --bounds")
+        layout = sharded_index.ShardLayout(args.shard_by, args.bounds or pmid_bounds(args.shards, args.max_pmid))
+    try:
+        builder = IndexBuilder(args.index, docstore_dir=args.docstore, procs=args.procs, limitmb=args.limitmb,
+                               multisegment=args.multisegment, create=args.mode == 'build', layout=layout)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    builder.run(files, args.parse_procs, commit_each_file=args.mode == 'update', merge=not args.no_merge,
+                optimize=args.optimize)
@@ -0,0 +1,183 @@
+"""
+cache.py is a two-level cache: an in-memory LRU in front of an sqlite file that persists across runs.
+    Every cache carries a version string built from the files its values depend on (model checkpoints, index
+    segments). When those files change the version changes, and everything stored under the old version is dropped,
+    so a stale answer can never be served after the checkpoint or the index is replaced.
+
+AnswerCache stores reader answers keyed on the normalized question, its predicted type and the PMIDs of the passages read.
+SearchCache stores the PMIDs and scores a Whoosh query found, keyed on the parsed query and the number of results.
+"""
+import collections
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# A short hash of the name, size and modification time of every file under the given paths
+def fingerprint(paths):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file in files:
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            digest.update(f"{file}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+# Hash any json serializable key into a fixed size string
+def make_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class TwoTierCache:
+    # the lookup counters, which add_counts adds to another cache's
+    COUNTERS = ('memory_hits', 'disk_hits', 'misses')
+
+    # version_paths are the files the cached values depend on; they are re-checked at most every version_check_interval seconds
+    def __init__(self, path, version_paths=(), capacity=1024, version_check_interval=30):
+        self.path = path
+        self.version_paths = list(version_paths)
+        self.capacity = capacity
+        self.version_check_interval = version_check_interval
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        self.version = None
+        self._check_version(force=True)
+
+    # Drop every entry if the files the cache depends on have changed since the entries were written
+    def _check_version(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.version_checked < self.version_check_interval:
+            return
+        self.version_checked = now
+        version = fingerprint(self.version_paths)
+        if version == self.version:
+            return
+        stored = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        if stored is None or stored[0] != version:
+            if stored is not None:
+                print(f"\033[95mModel or index changed, clearing {self.path}\033[0m")
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+            self.db.commit()
+        self.memory.clear()
+        self.version = version
+
+    def get(self, key):
+        with self.lock:
+            self._check_version()
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            row = self.db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._check_version()
+            self._remember(key, value)
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (key, json.dumps(value)))
+            self.db.commit()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hit_ratio = (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'hit_ratio': hit_ratio}
+
+    def counts(self):
+        with self.lock:
+            return {name: getattr(self, name) for name in self.COUNTERS}
+
+    # Add the counts of another cache to these, like those of the same cache in a worker process
+    def add_counts(self, counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def print_stats(self, name="Cache"):
+        stats = self.stats()
+        print(f"\033[95m{name}: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, "
+              f"{stats['misses']} misses ({stats['hit_ratio']:.1%} hit ratio)\033[0m")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Lower case and collapse whitespace and trailing punctuation so trivially different spellings of a question share answers
+def normalize_question(question):
+    return re.sub(r"\s+", " ", str(question)).strip().rstrip("?.! ").lower()
+
+
+# Reader answers keyed on the normalized question, its predicted type, the PMIDs of the passages read and the model
+# and index versions. ENTRY_FORMAT is part of the key so entries written in an older layout are never read back.
+class AnswerCache(TwoTierCache):
+    ENTRY_FORMAT = 'passages'
+
+    def answer_key(self, question, type, pmids):
+        return make_key(normalize_question(question), type, [str(pmid) for pmid in pmids], self.version, self.ENTRY_FORMAT)
+
+
+# Search results keyed on the parsed query, so queries that only differ in case, punctuation or word endings the
+# stemmer removes share an entry, max_results, the retrieval backend and the index version. Every entry remembers how long its search took, and
+# every hit adds that to saved_seconds.
+class SearchCache(TwoTierCache):
+    COUNTERS = TwoTierCache.COUNTERS + ('saved_seconds',)
+
+    def __init__(self, path, version_paths=(), capacity=4096, version_check_interval=30):
+        super().__init__(path, version_paths, capacity, version_check_interval)
+        self.saved_seconds = 0.0
+
+    # text is the question a dense retriever embedded, if one took part in the search
+    def search_key(self, parsed_query, max_results, backend='whoosh', text=None):
+        if text is not None:
+            return make_key(str(parsed_query), max_results, backend, text, self.version)
+        return make_key(str(parsed_query), max_results, backend, self.version)
+
+    # [[pmid, score], ...] for a cached search, None otherwise
+    def get_hits(self, key):
+        value = self.get(key)
+        if value is None:
+            return None
+        with self.lock:
+            self.saved_seconds += value['seconds']
+        return value['hits']
+
+    def put_hits(self, key, hits, seconds):
+        self.put(key, {'hits': hits, 'seconds': seconds})
+
+    def stats(self):
+        return dict(super().stats(), saved_seconds=self.saved_seconds)
+
+    def print_stats(self, name="Search cache"):
+        super().print_stats(name)
+        print(f"\033[95m{name}: {self.saved_seconds:.2f}s of searching saved\033[0m")
@@ -0,0 +1,311 @@
+"""
+dense_retrieval.py finds abstracts by the meaning of the question rather than by its keywords, for the questions
+the entity queries of QU miss. It runs on the CPU with nothing but NumPy and the encoder, and is used alone or fused
+with the Whoosh (or BM25) results in information_retrieval.search (set dense_mode in qa_system.py).
+
+    The title and abstract of every article are embedded offline, a chunk at a time, with a transformers encoder
+    (mean pooled and normalized, so the inner product is the cosine similarity) and appended to a file of float16
+    vectors. The vectors are then clustered with spherical k-means into an IVF index whose lists are written one
+    after the other, so probing a list is one slice of a memory-mapped file.
+
+    A dense index is a directory of:
+        vectors.f16, pmids.i64            the embeddings, in the order they were made, and the PMID of each of them
+        progress.json                     how far the embedding got, so an interrupted run goes on from there
+        ivf_vectors.f16, ivf_pmids.npy    the same embeddings and PMIDs, grouped by list
+        centroids.npy, list_offsets.npy   the centroid of every list and where each list starts
+        meta.json                         the encoder, the dimension, the number of vectors and the number of lists
+    A search embeds the question, scores it against the centroids and scans the nprobe closest lists.
+
+    python dense_retrieval.py embed [--index data_modules/index/full_index] [--docstore ...] [--output data_modules/dense/full_index]
+    python dense_retrieval.py ivf   [--output data_modules/dense/full_index] [--nlist N]
+build the index. python benchmark.py dense measures recall@k and latency.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+DENSE_FOLDER = f"data_modules{os.path.sep}dense"
+# a PubMedBERT sentence encoder fine-tuned for search on MS MARCO
+DEFAULT_MODEL = 'pritamdeka/S-PubMedBert-MS-MARCO'
+# the k of reciprocal rank fusion; 60 is the value of the original paper
+RRF_K = 60
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# The text of an article that is embedded
+def document_text(fields):
+    return " ".join(part for part in (fields.get('title'), fields.get('abstract_text')) if part)
+
+
+# Embeds text with a transformers encoder on the CPU
+class Embedder:
+    def __init__(self, model_name=DEFAULT_MODEL, max_length=256, batch_size=32, threads=None):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        if threads:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.model_name = model_name
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).eval()
+        self.dim = self.model.config.hidden_size
+
+    # float32 embeddings of texts, one row each
+    def encode(self, texts):
+        # batches of texts of about the same length waste less time on padding
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        with self.torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                rows = order[start:start + self.batch_size]
+                batch = self.tokenizer([texts[row] for row in rows], padding=True, truncation=True,
+                                       max_length=self.max_length, return_tensors='pt')
+                hidden = self.model(**batch)[0]
+                mask = batch['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+                vectors[rows] = ((hidden * mask).sum(1) / mask.sum(1).clamp(min=1)).numpy()
+        return normalize(vectors)
+
+    # The float32 embeddings of the tokens of every text, without padding and special tokens, one (tokens, dim)
+    # array per text. Used by reranker.py.
+    def encode_tokens(self, texts):
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        tokens = [None] * len(texts)
+        with self.torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                rows = order[start:start + self.batch_size]
+                batch = self.tokenizer([texts[row] for row in rows], padding=True, truncation=True,
+                                       max_length=self.max_length, return_tensors='pt', return_special_tokens_mask=True)
+                keep = (batch.pop('special_tokens_mask') == 0) & (batch['attention_mask'] == 1)
+                hidden = self.model(**batch)[0].numpy()
+                for n, row in enumerate(rows):
+                    tokens[row] = normalize(hidden[n][keep[n].numpy()])
+        return tokens
+
+
+# Embed documents (dicts of stored fields) into the dense index at path, chunk_size documents at a time.
+# The vectors and PMIDs are appended after every chunk, and progress.json records how many documents have been read,
+# so running it again after an interruption goes on from the last complete chunk.
+def embed_documents(documents, path, embedder, chunk_size=4096):
+    os.makedirs(path, exist_ok=True)
+    vectors_path, pmids_path = os.path.join(path, "vectors.f16"), os.path.join(path, "pmids.i64")
+    progress_path = os.path.join(path, "progress.json")
+    progress = {'read': 0, 'embedded': 0, 'model': embedder.model_name, 'dim': embedder.dim}
+    if os.path.isfile(progress_path):
+        with open(progress_path, "r") as progress_file:
+            progress = json.load(progress_file)
+        if progress['model'] != embedder.model_name:
+            raise ValueError(f"{path} was embedded with {progress['model']}, not {embedder.model_name}")
+        print(f"\033[95mGoing on from document {progress['read']}\033[0m")
+    # drop anything written after the last complete chunk
+    for file_path, row_bytes in ((vectors_path, embedder.dim * 2), (pmids_path, 8)):
+        with open(file_path, "ab") as file:
+            file.truncate(progress['embedded'] * row_bytes)
+    started = time.perf_counter()
+    documents = itertools.islice(documents, progress['read'], None)
+    with open(vectors_path, "ab") as vectors_file, open(pmids_path, "ab") as pmids_file:
+        while True:
+            chunk = list(itertools.islice(documents, chunk_size))
+            if not chunk:
+                break
+            chunk_texts = [(int(fields['pmid']), document_text(fields)) for fields in chunk]
+            chunk_texts = [(pmid, text) for pmid, text in chunk_texts if text]
+            if chunk_texts:
+                vectors = embedder.encode([text for _, text in chunk_texts])
+                vectors.astype('<f2').tofile(vectors_file)
+                np.array([pmid for pmid, _ in chunk_texts], dtype='<i8').tofile(pmids_file)
+                vectors_file.flush()
+                pmids_file.flush()
+            progress['read'] += len(chunk)
+            progress['embedded'] += len(chunk_texts)
+            with open(progress_path + ".partial", "w") as progress_file:
+                json.dump(progress, progress_file)
+            os.replace(progress_path + ".partial", progress_path)
+            print(f"\033[95m{progress['read']} documents read, {progress['embedded']} embedded "
+                  f"({len(chunk) / (time.perf_counter() - started):.0f} documents/s)\033[0m")
+            started = time.perf_counter()
+    return progress
+
+# The embeddings of a dense index as a (count, dim) float16 memmap, and their PMIDs
+def _embeddings(path):
+    with open(os.path.join(path, "progress.json"), "r") as progress_file:
+        progress = json.load(progress_file)
+    count, dim = progress['embedded'], progress['dim']
+    vectors = np.memmap(os.path.join(path, "vectors.f16"), dtype='<f2', mode='r', shape=(count, dim))
+    pmids = np.memmap(os.path.join(path, "pmids.i64"), dtype='<i8', mode='r', shape=(count,))
+    return progress, vectors, pmids
+
+# The best centroid for every row of vectors, chunk_size rows at a time
+def assign(vectors, centroids, chunk_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+# k unit centroids for unit vectors data (float32), by spherical k-means. Empty clusters are given a random point.
+def spherical_kmeans(data, k, iterations=20, rng=None):
+    rng = rng if rng is not None else np.random.RandomState(0)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for iteration in range(iterations):
+        assignments = assign(data, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        order = np.argsort(assignments, kind='stable')
+        filled = np.flatnonzero(counts)
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(data[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[filled], axis=0)
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+# Cluster the embeddings of the dense index at path into nlist lists (sqrt of the number of vectors by default),
+# training k-means on train_size of them (64 per list by default), and write the IVF files
+def build_ivf(path, nlist=None, train_size=None, iterations=20, seed=0, chunk_size=65536):
+    progress, vectors, pmids = _embeddings(path)
+    count = len(vectors)
+    if count == 0:
+        raise ValueError(f"No embeddings in {path}, run python dense_retrieval.py embed first")
+    nlist = min(count, nlist or max(1, int(np.sqrt(count))))
+    train_size = min(count, train_size or 64 * nlist)
+    rng = np.random.RandomState(seed)
+    started = time.perf_counter()
+    print(f"\033[95mTraining {nlist} lists on {train_size} of {count} vectors\033[0m")
+    sample = np.asarray(vectors[np.sort(rng.choice(count, train_size, replace=False))], dtype=np.float32)
+    centroids = spherical_kmeans(sample, nlist, iterations, rng)
+    del sample
+    print(f"\033[95mAssigning the vectors to their lists ({time.perf_counter() - started:.0f}s)\033[0m")
+    assignments = assign(vectors, centroids, chunk_size)
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+    with open(os.path.join(path, "ivf_vectors.f16.partial"), "wb") as ivf_file:
+        for start in range(0, count, chunk_size):
+            np.asarray(vectors[order[start:start + chunk_size]], dtype='<f2').tofile(ivf_file)
+    np.save(os.path.join(path, "ivf_pmids.npy"), np.asarray(pmids[order]))
+    np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+    np.save(os.path.join(path, "list_offsets.npy"), offsets)
+    os.replace(os.path.join(path, "ivf_vectors.f16.partial"), os.path.join(path, "ivf_vectors.f16"))
+    with open(os.path.join(path, "meta.json"), "w") as meta:
+        json.dump({'model': progress['model'], 'dim': progress['dim'], 'count': count, 'nlist': nlist}, meta)
+    print(f"\033[95mWrote {nlist} lists of {count} vectors to {path} in {time.perf_counter() - started:.0f}s\033[0m")
+
+
+# The IVF index of a dense index directory
+class DenseIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as meta:
+            meta = json.load(meta)
+        self.model_name = meta['model']
+        self.count = meta['count']
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "list_offsets.npy"))
+        self.vectors = np.memmap(os.path.join(path, "ivf_vectors.f16"), dtype='<f2', mode='r',
+                                 shape=(meta['count'], meta['dim']))
+        self.pmids = np.load(os.path.join(path, "ivf_pmids.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return self.count
+
+    # The k nearest vectors to a unit vector as [[pmid, score], ...], best first, scanning the nprobe lists with the
+    # closest centroids, or every vector if nprobe is None
+    def search_vector(self, vector, k=10, nprobe=16, chunk_size=65536):
+        vector = np.asarray(vector, dtype=np.float32)
+        if nprobe is None or nprobe >= len(self.centroids):
+            ranges = [(start, min(start + chunk_size, self.count)) for start in range(0, self.count, chunk_size)]
+        else:
+            lists = np.sort(np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe])
+            ranges = [(self.offsets[n], self.offsets[n + 1]) for n in lists if self.offsets[n + 1] > self.offsets[n]]
+        rows, scores = [], []
+        for start, end in ranges:
+            range_scores = np.asarray(self.vectors[start:end], dtype=np.float32) @ vector
+            if len(range_scores) > k:
+                best = np.argpartition(-range_scores, k - 1)[:k]
+                rows.append(best + start)
+                scores.append(range_scores[best])
+            else:
+                rows.append(np.arange(start, end))
+                scores.append(range_scores)
+        if not rows:
+            return []
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        order = np.lexsort((rows, -scores))[:k]
+        return [[str(self.pmids[row]), float(score)] for row, score in zip(rows[order], scores[order])]
+
+
+# Dense retrieval as information_retrieval.search uses it: the question is embedded and searched for in the index.
+# With fuse=True the depth best articles are fused with as many lexical results, otherwise they replace them.
+class DenseRetriever:
+    def __init__(self, index, embedder, nprobe=16, fuse=True, depth=50):
+        self.index = index
+        self.embedder = embedder
+        self.nprobe = nprobe
+        self.fuse = fuse
+        self.depth = depth
+        # part of the search cache key, so results made with other settings are not reused
+        self.name = f"dense:{nprobe}:{depth}" + (":rrf" if fuse else "")
+
+    def search(self, text, k):
+        return self.index.search_vector(self.embedder.encode([text])[0], k, self.nprobe)
+
+    # What a worker process needs to open the same retriever (see open_dense)
+    def args(self):
+        return self.index.path, self.nprobe, self.fuse, self.depth
+
+# Reciprocal rank fusion of rankings ([[pmid, score], ...] lists, best first): every article scores the sum of
+# 1 / (k + rank) over the rankings it is in. Returns the limit best as [[pmid, fused score], ...].
+def fuse(rankings, limit, k=RRF_K):
+    scores = {}
+    for ranking in rankings:
+        for rank, (pmid, _) in enumerate(ranking, 1):
+            scores[pmid] = scores.get(pmid, 0.0) + 1.0 / (k + rank)
+    # sorted() is stable, so ties keep the order the articles were first seen in
+    return [[pmid, score] for pmid, score in sorted(scores.items(), key=lambda item: -item[1])[:limit]]
+
+# The dense retriever for an index, or None if its IVF index has not been built
+def open_dense(path, nprobe=16, fuse=True, depth=50, threads=None):
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    index = DenseIndex(path)
+    # questions have to be embedded with the encoder the articles were
+    return DenseRetriever(index, Embedder(index.model_name, threads=threads), nprobe=nprobe, fuse=fuse, depth=depth)
+
+# The stored fields of every article, from the document store if there is one, otherwise from the index
+def source_documents(index_dir, index_name='pubmed_articles', docstore_dir=None):
+    if docstore_dir is not None:
+        import docstore
+        yield from docstore.DocStore(docstore_dir)
+        return
+    import sharded_index
+    with sharded_index.open_index(index_dir, index_name, processes=1).searcher() as searcher:
+        yield from searcher.documents()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Build the dense retrieval index')
+    arg_parser.add_argument('mode', choices=['embed', 'ivf'])
+    arg_parser.add_argument('--index', default=f"data_modules{os.path.sep}index{os.path.sep}full_index")
+    arg_parser.add_argument('--index-name', default='pubmed_articles')
+    arg_parser.add_argument('--docstore', default=None, help='read the articles from this document store')
+    arg_parser.add_argument('--output', default=f"{DENSE_FOLDER}{os.path.sep}full_index")
+    arg_parser.add_argument('--model', default=DEFAULT_MODEL)
+    arg_parser.add_argument('--chunk-size', type=int, default=4096)
+    arg_parser.add_argument('--batch-size', type=int, default=32)
+    arg_parser.add_argument('--threads', type=int, default=None)
+    arg_parser.add_argument('--nlist', type=int, default=None, help='number of IVF lists, sqrt of the vectors by default')
+    arg_parser.add_argument('--iterations', type=int, default=20)
+    args = arg_parser.parse_args()
+    if args.mode == 'embed':
+        embedder = Embedder(args.model, batch_size=args.batch_size, threads=args.threads)
+        embed_documents(source_documents(args.index, args.index_name, args.docstore), args.output, embedder,
+                        chunk_size=args.chunk_size)
+    else:
+        build_ivf(args.output, nlist=args.nlist, iterations=args.iterations)
@@ -0,0 +1,217 @@
+"""
+docstore.py is a document store for the PubMed articles, keyed by PMID, kept outside the Whoosh index.
+    The index only has to store the PMID of every article (see information_retrieval.pubmed_schema), which keeps its
+    segments small, and the title, journal, year, MeSH headings and abstract of the articles a query found are read
+    from here when they are needed.
+
+    A store is a directory with three files:
+        docs.dat     every article as json, one after the other, each compressed with zlib if the store is compressed
+        docs.idx.npy (pmid, offset, length) for every article, sorted by PMID
+        meta.json    the number of articles, whether they are compressed and the generation of the index (see
+                     sharded_index.index_generation) the store holds the articles of
+    Both docs.dat and docs.idx.npy are memory mapped, so opening a store reads nothing but meta.json and a lookup is a
+    binary search in the index followed by one slice of the data file.
+
+    python docstore.py [--index data_modules/index/full_index] [--output data_modules/docstore/full_index] [--no-compress]
+builds the store from the stored fields of an existing index. build_index.py writes it while it builds an index.
+"""
+import argparse
+import array
+import json
+import mmap
+import os
+import zlib
+
+import numpy as np
+
+import PubmedA
+
+DOCSTORE_FOLDER = f"data_modules{os.path.sep}docstore"
+INDEX_DTYPE = np.dtype([('pmid', '<i8'), ('offset', '<i8'), ('length', '<i4')])
+FIELDS = ('pmid', 'title', 'journal', 'year', 'abstract_text', 'mesh_major')
+
+# Writes a store one article at a time. The store is only complete once close() has written its index; until then,
+# and after discard(), the last complete store at path stays as it was. A new store is written to docs.dat.partial.
+# With append=True the articles are added to an existing store: new versions of its articles replace the old ones and
+# delete() removes articles. The old records stay in docs.dat, only the index stops pointing at them.
+class DocStoreWriter:
+    def __init__(self, path, compress=True, append=False):
+        self.path = path
+        # the generation of the index the store is written for, set once the index is committed
+        self.generation = None
+        self.previous = None
+        if append and os.path.isfile(os.path.join(path, "meta.json")):
+            with open(os.path.join(path, "meta.json"), "r") as meta:
+                compress = json.load(meta)['compressed']
+            self.previous = np.load(os.path.join(path, "docs.idx.npy"))
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+        if self.previous is not None:
+            self.data_path = os.path.join(path, "docs.dat")
+            self.data = open(self.data_path, "ab")
+        else:
+            self.data_path = os.path.join(path, "docs.dat.partial")
+            self.data = open(self.data_path, "wb")
+        # where the records of the last complete store end
+        self.start = self.data.tell()
+        self.pmids = array.array('q')
+        self.offsets = array.array('q')
+        self.lengths = array.array('i')
+        self.deleted = set()
+
+    # fields is a dict with the keys of FIELDS, like the stored fields of an index document
+    def add(self, fields):
+        record = json.dumps({field: fields.get(field) for field in FIELDS}, separators=(',', ':')).encode('utf-8')
+        if self.compress:
+            record = zlib.compress(record)
+        self.pmids.append(int(fields['pmid']))
+        self.deleted.discard(int(fields['pmid']))
+        self.offsets.append(self.data.tell())
+        self.lengths.append(len(record))
+        self.data.write(record)
+
+    def delete(self, pmid):
+        self.deleted.add(int(pmid))
+
+    def close(self):
+        self.data.close()
+        index = np.empty(len(self.pmids), dtype=INDEX_DTYPE)
+        index['pmid'] = np.frombuffer(self.pmids, dtype='<i8')
+        index['offset'] = np.frombuffer(self.offsets, dtype='<i8')
+        index['length'] = np.frombuffer(self.lengths, dtype='<i4')
+        if self.previous is not None:
+            index = np.concatenate([self.previous, index])
+        index = index[np.argsort(index['pmid'], kind='stable')]
+        # an article added twice keeps its last version
+        if len(index):
+            index = index[np.append(index['pmid'][1:] != index['pmid'][:-1], True)]
+        if self.deleted:
+            index = index[~np.isin(index['pmid'], np.fromiter(self.deleted, dtype='<i8'))]
+        with open(os.path.join(self.path, "docs.idx.npy.partial"), "wb") as index_file:
+            np.save(index_file, index)
+        with open(os.path.join(self.path, "meta.json.partial"), "w") as meta:
+            json.dump({'count': len(index), 'compressed': self.compress, 'generation': self.generation}, meta)
+        # readers that have the store open keep the old index until they open it again
+        if self.previous is None:
+            os.replace(self.data_path, os.path.join(self.path, "docs.dat"))
+        os.replace(os.path.join(self.path, "docs.idx.npy.partial"), os.path.join(self.path, "docs.idx.npy"))
+        os.replace(os.path.join(self.path, "meta.json.partial"), os.path.join(self.path, "meta.json"))
+        print(f"\033[95mWrote {len(index)} articles to {self.path}\033[0m")
+
+    # Drop what was written, leaving the last complete store in place
+    def discard(self):
+        self.data.close()
+        if self.previous is None:
+            os.remove(self.data_path)
+        else:
+            with open(self.data_path, "ab") as data:
+                data.truncate(self.start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class DocStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as meta:
+            meta = json.load(meta)
+        self.compressed = meta['compressed']
+        # None for stores written before the generation was recorded
+        self.generation = meta.get('generation')
+        self.index = np.load(os.path.join(path, "docs.idx.npy"), mmap_mode='r')
+        self.pmids = self.index['pmid']
+        self.file = open(os.path.join(path, "docs.dat"), "rb")
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if meta['count'] else b""
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def _position(self, pmid):
+        try:
+            pmid = int(pmid)
+        except (TypeError, ValueError):
+            return None
+        position = np.searchsorted(self.pmids, pmid)
+        if position < len(self.pmids) and self.pmids[position] == pmid:
+            return position
+        return None
+
+    def __contains__(self, pmid):
+        return self._position(pmid) is not None
+
+    def _fields_at(self, position):
+        offset, length = int(self.index['offset'][position]), int(self.index['length'][position])
+        record = self.data[offset:offset + length]
+        if self.compressed:
+            record = zlib.decompress(record)
+        return json.loads(record)
+
+    # The stored fields of an article, or None if the store does not have it
+    def fields(self, pmid):
+        position = self._position(pmid)
+        if position is None:
+            return None
+        return self._fields_at(position)
+
+    # The stored fields of every article, in PMID order
+    def __iter__(self):
+        for position in range(len(self.pmids)):
+            yield self._fields_at(position)
+
+    def get(self, pmid, score=None):
+        fields = self.fields(pmid)
+        if fields is None:
+            return None
+        return PubmedA.PubmedA(**fields, score=score)
+
+    # {pmid: PubmedA} for the PMIDs the store has
+    def get_many(self, pmids):
+        articles = {}
+        for pmid in pmids:
+            article = self.get(pmid)
+            if article is not None:
+                articles[pmid] = article
+        return articles
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+
+# The store for an index, or None if it has not been built
+def open_docstore(path):
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    return DocStore(path)
+
+# Build a store from the stored fields of every document in a Whoosh index
+def build_from_index(indexer, path, compress=True):
+    print(f"\033[95mCopying the stored articles of the index to {path}\033[0m")
+    import sharded_index
+    with indexer.searcher() as searcher, DocStoreWriter(path, compress=compress) as writer:
+        writer.generation = sharded_index.index_generation(indexer)
+        for n, fields in enumerate(searcher.documents(), 1):
+            writer.add(fields)
+            if n % 100000 == 0:
+                print(f"\033[95m{n} articles\033[0m")
+
+
+if __name__ == "__main__":
+    import sharded_index
+    arg_parser = argparse.ArgumentParser(description='Build the PubMed document store from the index')
+    arg_parser.add_argument('--index', default=f"data_modules{os.path.sep}index{os.path.sep}full_index")
+    arg_parser.add_argument('--index-name', default='pubmed_articles')
+    arg_parser.add_argument('--output', default=f"{DOCSTORE_FOLDER}{os.path.sep}full_index")
+    arg_parser.add_argument('--no-compress', action='store_true')
+    args = arg_parser.parse_args()
+    build_from_index(sharded_index.open_index(args.index, args.index_name, processes=1), args.output,
+                     compress=not args.no_compress)
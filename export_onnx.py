@@ -0,0 +1,46 @@
+"""
+export_onnx.py converts the question type classifier in data_modules/model to ONNX so that it can be run with
+ONNX Runtime instead of PyTorch (set classifier_backend = 'onnx' in qa_system.py).
+    python export_onnx.py [--model data_modules/model] [--output data_modules/model/classifier.onnx]
+
+The batch and sequence axes of the graph are dynamic, so the exported model takes the same dynamically padded batches
+as the PyTorch one. python benchmark.py onnx checks that both predict the same labels and compares their latency.
+"""
+import argparse
+import os
+
+import torch
+from transformers import BertTokenizerFast, BertForSequenceClassification
+
+import question_understanding
+
+def export_classifier(model_dir, output_file, opset_version=11):
+    print(f"\033[95mExporting {model_dir} to {output_file}\033[0m")
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    model = BertForSequenceClassification.from_pretrained(model_dir, cache_dir=None)
+    model.eval()
+    # two questions of different lengths, so the traced graph sees a padded batch
+    encoded = tokenizer(["Is metformin used to treat type 2 diabetes?", "List drugs for asthma."],
+                        padding=True, return_tensors='pt')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          (encoded['input_ids'], encoded['attention_mask']),
+                          output_file,
+                          input_names=question_understanding.ONNX_INPUT_NAMES,
+                          output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'logits': {0: 'batch'}},
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+    print(f"\033[95mWrote {output_file}\033[0m")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Export the question type classifier to ONNX')
+    arg_parser.add_argument('--model', default=f"data_modules{os.path.sep}model")
+    arg_parser.add_argument('--output', default=question_understanding.ONNX_CLASSIFIER_FILE)
+    arg_parser.add_argument('--opset', type=int, default=11)
+    args = arg_parser.parse_args()
+    export_classifier(args.model, args.output, opset_version=args.opset)
@@ -1,94 +1,313 @@
 # Based on code from https://github.com/masonnlp/bioasqir
 
-from whoosh import index
 from whoosh.fields import Schema, TEXT, IDLIST, ID, NUMERIC
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.qparser import QueryParser
 import lxml.etree as ET
+import collections
+import multiprocessing
 import os
+import threading
+import time
+from contextlib import contextmanager
 
 import PubmedA
+import dense_retrieval
+import interchange
+import sharded_index
+from manifest import ProgressManifest
+
+# This is the schema of the pubmed_articles index.
+# An index with a document store next to it (see docstore.py) only needs to store the PMID, so store_text=False
+# leaves the text of the other fields out of its segments.
+def pubmed_schema(store_text=True):
+    return Schema(
+        pmid=ID(stored=True),
+        title=TEXT(stored=store_text),
+        journal=TEXT(stored=store_text),
+        mesh_major=IDLIST(stored=store_text),
+        year=NUMERIC(stored=store_text),
+        abstract_text=TEXT(stored=store_text, analyzer=StemmingAnalyzer()))
+
+# Keeps one searcher, and so one set of open segment readers, over the index for a whole batch or for as long as the
+# system runs, instead of opening them again for every query. Whether the index has changed on disk is checked at
+# most every check_interval seconds, and the searcher is refreshed when it has.
+# use() is a context manager like indexer.searcher() and lets one thread at a time use the searcher.
+class SearcherSession:
+    def __init__(self, indexer, check_interval=1.0):
+        self.indexer = indexer
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.searcher = indexer.searcher()
+        self.checked = time.monotonic()
+
+    @contextmanager
+    def use(self):
+        with self.lock:
+            if time.monotonic() - self.checked >= self.check_interval:
+                if not self.searcher.up_to_date():
+                    print("\033[95mThe index has changed, refreshing the searcher\033[0m")
+                    self.searcher = self.searcher.refresh()
+                self.checked = time.monotonic()
+            yield self.searcher
+
+    def close(self):
+        with self.lock:
+            self.searcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# A searcher to use in a with block: the session's if there is one, otherwise a new one
+def _searcher(indexer, session=None):
+    return session.use() if session is not None else indexer.searcher()
+
+# Build the PubmedA for the stored fields of an index document
+def article_from_fields(fields, score=None):
+    return PubmedA.PubmedA(fields.get('pmid'),
+                 fields.get('title'),
+                 fields.get('journal'),
+                 fields.get('year'),
+                 fields.get('abstract_text'),
+                 fields.get('mesh_major'), # medical subject headings, keywords
+                 score=score)
 
 # Here we receive input of the form (id, question, type, entities, query).
 # We use this input to query the PubMed database index which has been specially indexed to improve query times.
-def search(indexer, parser, query, max_results = 5, batch_mode=False):
+# With a SearcherSession the query runs on its searcher instead of opening a new one.
+# With a cache.SearchCache a query that has been run before is not run again.
+# With a docstore.DocStore the articles are read from it rather than from the fields stored in the index.
+# With an engine (bm25.BM25Index) the query is scored by it rather than by Whoosh, unless it is a kind of query the
+# engine leaves to Whoosh.
+# With a dense retriever (dense_retrieval.DenseRetriever) the question, or the query if no question is given, is also
+# searched for by its embedding, and its results are fused with the lexical ones or used instead of them.
+# With a reranker (reranker.Reranker) reranker.depth articles are retrieved and the max_results that match the question
+# best by late interaction are kept.
+# Articles that are not read from the index are read back by PMID, or, with hydrate=False, returned with only their
+# PMIDs and scores set.
+def search(indexer, parser, query, max_results = 5, batch_mode=False, session=None, cache=None, hydrate=True, docstore=None,
+           engine=None, dense=None, question=None, reranker=None):
     print("\033[95mSearching....\033[0m")
-    res = []
     if batch_mode:
         q = parser.parse(query)
     else:
+        question = question or query[1]
         q = parser.parse(query[4])
-    with indexer.searcher() as s:
-        results = s.search(q, limit=max_results)
-        for result in results:
-            pa = PubmedA.PubmedA(result.get('pmid'),
-                         result.get('title'),
-                         result.get('journal'),
-                         result.get('year'),
-                         result.get('abstract_text'),
-                         result.get('mesh_major')) # medical subject headings, keywords
-            res.append(pa)
-    return res
-
-#Query the the PubMed index with every query generated in the QU module, writing the result articles fetched by query to a file every <write_buffer_size> iterations 
-def batch_search(input_file, output_file, indexer, parser, write_buffer_size=500):
-    fileTree = ET.parse(output_file)
-    if fileTree:
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        root = fileTree.getroot()
-        # get all questions from the output file and parse in batch format
-        questions = root.findall('Q')
-        index = 1
-        num_questions = str((len(questions)))
-        print(f"\033[95m{num_questions} questions found\033[0m")
-        for question in questions:
-            # Question ID and question processing tags
-            qid = question.get("id")
-            qp = question.find("QP")
-            # safeguard for malformed query
-            if qp.find("Query").text:
-                query = qp.find("Query").text
-            else:
-                print("\033[95mNo query found, using original question\033[0m")
-                query = question.text
-            print(f"\033[95m{query} [{index}/{num_questions}]\033[0m")
-            # use search method to find a result
-            results = search(indexer,parser,query,batch_mode=True)
-            if results:
-                print("\033[95mResults found.\033[0m")
-                ir = question.find("IR")
-                # create subelements for each result
-                for result in results:
-                    query_used = ET.SubElement(ir, "QueryUsed")
-                    query_used.text = query
-                    result_tag = ET.SubElement(ir, "Result")
-                    result_tag.set("PMID", result.pmid)
-                    journal = ET.SubElement(result_tag, "Journal")
-                    journal.text = result.journal
-                    year = ET.SubElement(result_tag, "Year")
-                    try:
-                        year.text = result.year
-                    except:
-                        pass
-                    title = ET.SubElement(result_tag, "Title")
-                    title.text = result.title
-                    abstract = ET.SubElement(result_tag, "Abstract")
-                    abstract.text = result.abstract_text
-                    # tags
-                    for mesh in result.mesh_major:
-                        mesh_major = ET.SubElement(result_tag, "MeSH")
-                        mesh_major.text = mesh
-                tree = ET.ElementTree(root)
-                # save current progress to file every n documents (controlled by write_buffer_size)
-                if(index % write_buffer_size-1 == 0):   
-                    print(f"\033[95mWriting data to {output_file}\033[0m")
-                    tree.write(output_file, pretty_print=True)
-            else:
-                print("\033[95mNo results\033[0m")
-            index=index+1
-        print(f"\033[95mWriting data to {output_file}\033[0m")
-        tree.write(output_file, pretty_print=True)
-    else:
-        print(f"\033[95mError loading {input_file}\033[0m")
+    text = (question or query) if dense is not None or reranker is not None else None
+    hits = None
+    articles = {}
+    if cache is not None:
+        backend = engine.name if engine is not None else 'whoosh'
+        if dense is not None:
+            backend += "+" + dense.name
+        if reranker is not None:
+            backend += "+" + reranker.name
+        key = cache.search_key(q, max_results, backend, text)
+        hits = cache.get_hits(key)
+    if hits is None:
+        start = time.perf_counter()
+        # the reranker picks the max_results best of the limit articles retrieved for it
+        limit = max(max_results, reranker.depth) if reranker is not None else max_results
+        # fusion looks deeper into both rankings than the results it returns
+        depth = max(limit, dense.depth) if dense is not None and dense.fuse else limit
+        if dense is None or dense.fuse:
+            if engine is not None:
+                hits = engine.search_query(q, depth)
+            if hits is None:
+                with _searcher(indexer, session) as s:
+                    results = s.search(q, limit=depth)
+                    hits = [[result['pmid'], result.score] for result in results]
+                    # without a document store the articles are stored in the index and at hand already
+                    if docstore is None and dense is None and reranker is None:
+                        articles = {result['pmid']: article_from_fields(result) for result in results}
+        if dense is not None:
+            dense_hits = dense.search(text, depth)
+            hits = dense_retrieval.fuse([hits, dense_hits], limit) if dense.fuse else dense_hits
+        if reranker is not None:
+            hits = reranker.rerank(text, hits, max_results)
+        if cache is not None:
+            cache.put_hits(key, hits, time.perf_counter() - start)
+    missing = [pmid for pmid, _ in hits if pmid not in articles]
+    if hydrate and missing:
+        articles.update(fetch_articles(indexer, missing, session, docstore))
+    return [PubmedA.PubmedA(**dict(vars(articles[pmid]), score=score)) if pmid in articles
+            else PubmedA.PubmedA(pmid, None, None, None, None, [], score=score)
+            for pmid, score in hits]
 
+# The articles for the given PMIDs, as {pmid: PubmedA}, from docstore if given and otherwise from the fields stored in
+# the index, which PMIDs the store does not have are read from as well if it stores the text. PMIDs that are not there
+# are left out.
+# The batch stage files only reference articles by PMID, and this is where their text comes from.
+def fetch_articles(indexer, pmids, session=None, docstore=None):
+    articles = {}
+    if docstore is not None:
+        articles = docstore.get_many(pmids)
+        pmids = [pmid for pmid in pmids if pmid not in articles] if indexer.schema['abstract_text'].stored else []
+        if not pmids:
+            return articles
+    with _searcher(indexer, session) as s:
+        for pmid in pmids:
+            fields = s.document(pmid=pmid)
+            if fields:
+                articles[pmid] = article_from_fields(fields)
+    return articles
 
+# Add the <QueryUsed> and <Result> elements for every retrieved article to the IR element of a question
+def results_to_xml(ir, query, results):
+    # create subelements for each result
+    for result in results:
+        query_used = ET.SubElement(ir, "QueryUsed")
+        query_used.text = query
+        result_tag = ET.SubElement(ir, "Result")
+        result_tag.set("PMID", result.pmid)
+        journal = ET.SubElement(result_tag, "Journal")
+        journal.text = result.journal
+        year = ET.SubElement(result_tag, "Year")
+        try:
+            year.text = result.year
+        except:
+            pass
+        title = ET.SubElement(result_tag, "Title")
+        title.text = result.title
+        abstract = ET.SubElement(result_tag, "Abstract")
+        abstract.text = result.abstract_text
+        # tags
+        for mesh in result.mesh_major:
+            mesh_major = ET.SubElement(result_tag, "MeSH")
+            mesh_major.text = mesh
+
+# The query batch_search runs for a QU record
+def record_query(record):
+    # safeguard for malformed query
+    if record['query']:
+        return record['query']
+    print("\033[95mNo query found, using original question\033[0m")
+    return record['question']
+
+# Search for one query of a batch and return the "ir" entry of its record (see interchange.py), or None for a question
+# that has already been searched
+def search_entry(indexer, parser, query, session=None, cache=None, engine=None, dense=None, question=None,
+                 reranker=None):
+    if query is None:
+        return None
+    results = search(indexer,parser,query,batch_mode=True,session=session,cache=cache,hydrate=False,engine=engine,
+                     dense=dense,question=question,reranker=reranker)
+    return interchange.ir_entry(query, results)
+
+# Every worker process of a parallel batch_search opens the index and keeps its own searcher for all of its queries.
+# cache_args are the path and version paths of the parent's SearchCache, engine_path the path of its BM25 index and
+# dense_args and reranker_args those of its dense retriever and reranker (their args()), which every worker opens as
+# well.
+_worker = {}
+
+# The directory an index was opened from
+def index_folder(indexer):
+    if isinstance(indexer, sharded_index.ShardedIndex):
+        return indexer.path
+    return indexer.storage.folder
+
+def _init_search_worker(index_dir, index_name, fieldname, cache_args=None, engine_path=None, dense_args=None,
+                        reranker_args=None):
+    # a worker searches the shards of a sharded index one after the other, as a pool worker cannot start a pool
+    indexer = sharded_index.open_index(index_dir, index_name, processes=1)
+    _worker['indexer'] = indexer
+    _worker['parser'] = QueryParser(fieldname, schema=pubmed_schema())
+    _worker['session'] = SearcherSession(indexer)
+    _worker['cache'] = None
+    if cache_args is not None:
+        import cache
+        _worker['cache'] = cache.SearchCache(*cache_args)
+    _worker['engine'] = None
+    if engine_path is not None:
+        import bm25
+        _worker['engine'] = bm25.BM25Index(engine_path)
+    _worker['dense'] = None
+    if dense_args is not None:
+        path, nprobe, fuse, depth = dense_args
+        # one torch thread per worker, the workers already fill the cores
+        _worker['dense'] = dense_retrieval.open_dense(path, nprobe=nprobe, fuse=fuse, depth=depth, threads=1)
+    _worker['reranker'] = None
+    if reranker_args is not None:
+        import reranker
+        path, depth = reranker_args
+        _worker['reranker'] = reranker.open_reranker(path, depth=depth, threads=1)
+
+# The entry of a query, with what the worker's cache counted while searching it, which the parent adds to its own
+def _search_in_worker(task):
+    query, question = task
+    cache = _worker['cache']
+    before = cache.counts() if cache is not None else None
+    entry = search_entry(_worker['indexer'], _worker['parser'], query, _worker['session'], cache, _worker['engine'],
+                         _worker['dense'], question, _worker['reranker'])
+    if cache is None:
+        return entry, None
+    return entry, {name: value - before[name] for name, value in cache.counts().items()}
+
+#Query the the PubMed index with every query generated in the QU module, reading the QU stage file input_file and
+# writing the IR stage file output_file (see interchange.py), flushed every <write_buffer_size> questions.
+# Every searched question is recorded in a progress manifest next to output_file, so a run that is interrupted
+# only searches the questions it had not reached when it is started again.
+# With processes > 1 the queries are spread over that many worker processes, each with its own searcher, and their
+# results are written in input order, so the output is the same as searching one query at a time. Otherwise all
+# the queries run on one searcher, session's if given. Queries found in cache (a cache.SearchCache) are not run again,
+# and engine, if given, scores the queries instead of Whoosh. dense, if given, searches for the questions by their
+# embeddings as well and reranker reranks the results (see search).
+def batch_search(input_file, output_file, indexer, parser, write_buffer_size=500, session=None, processes=1,
+                 queries_per_task=8, cache=None, engine=None, dense=None, reranker=None):
+    if not os.path.isfile(input_file):
+        print(f"\033[95mError loading {input_file}\033[0m")
+        return
+    if session is None and processes <= 1:
+        with SearcherSession(indexer) as session:
+            return batch_search(input_file, output_file, indexer, parser, write_buffer_size, session, cache=cache,
+                                engine=engine, dense=dense, reranker=reranker)
+    manifest = ProgressManifest(output_file + ".ir_progress.jsonl")
+    num_questions = interchange.count_records(input_file)
+    print(f"\033[95m{num_questions} questions found\033[0m")
+    # The records are read once, as their queries are handed out, and wait in handed_out for their results.
+    # With a pool the queries are handed out on its task thread, so this has to be thread safe.
+    handed_out = collections.deque()
+
+    def queries():
+        for record in interchange.read_records(input_file):
+            handed_out.append(record)
+            yield (None, None) if manifest.is_done(record['id']) else (record_query(record), record['question'])
+    pool = None
+    if processes > 1:
+        print(f"\033[95mSearching with {processes} processes\033[0m")
+        # the parent may hold TensorFlow and torch threads, which are not fork safe
+        pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_search_worker,
+                                                         initargs=(index_folder(indexer), indexer.indexname, parser.fieldname,
+                                                                   (cache.path, cache.version_paths) if cache is not None else None,
+                                                                   engine.path if engine is not None else None,
+                                                                   dense.args() if dense is not None else None,
+                                                                   reranker.args() if reranker is not None else None))
+        entries = pool.imap(_search_in_worker, queries(), chunksize=queries_per_task)
+    else:
+        entries = ((search_entry(indexer, parser, query, session, cache, engine, dense, question, reranker), None)
+                   for query, question in queries())
+    try:
+        with interchange.StageWriter(output_file, flush_every=write_buffer_size) as writer:
+            for index, (ir, counts) in enumerate(entries, 1):
+                if counts is not None:
+                    cache.add_counts(counts)
+                record = handed_out.popleft()
+                qid = record['id']
+                if ir is None:
+                    ir = manifest.get(qid)
+                    print(f"\033[95m{ir['query']} [{index}/{num_questions}] (already searched)\033[0m")
+                else:
+                    print(f"\033[95m{ir['query']} [{index}/{num_questions}]\033[0m")
+                    print("\033[95mResults found.\033[0m" if ir['results'] else "\033[95mNo results\033[0m")
+                    manifest.mark_done(qid, ir)
+                writer.write(dict(record, ir=ir))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print(f"\033[95mWrote data to {output_file}\033[0m")
+    manifest.complete()
+    if cache is not None:
+        cache.print_stats()
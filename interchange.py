@@ -0,0 +1,127 @@
+"""
+interchange.py is the file format the batch stages hand questions to each other in.
+    A stage file is JSON lines, one compact record per question, in input order:
+        {"id": ..., "question": ..., "type": ..., "entities": [...], "query": ...,
+         "ir": {"query": <query used>, "results": [{"pmid": ..., "score": ...}, ...]}}
+    QU writes the records with "ir": null and IR fills it in. Retrieved articles are referenced by PMID only; the
+    stages that need the abstract text look it up in the index (information_retrieval.fetch_articles), so the text is
+    never copied into the stage files.
+
+    Next to every stage file is <file>.idx, a json map from question id to the byte offset of its record, so a single
+    question can be read without scanning the file. Files are written and read one record at a time.
+
+export_xml writes the old <Input><Q>... xml, with the abstracts filled in, for tools that still expect it.
+"""
+import json
+import os
+
+# Writes the records of a stage file one at a time and its offset index on close. The file is written under a
+# temporary name and only renamed into place once it is complete.
+class StageWriter:
+    def __init__(self, path, flush_every=500):
+        self.path = path
+        self.flush_every = flush_every
+        self.offsets = {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path + ".partial", "wb")
+
+    def write(self, record):
+        self.offsets[str(record['id'])] = self.file.tell()
+        self.file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b"\n")
+        if len(self.offsets) % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+        with open(self.path + ".idx.partial", "w") as index_file:
+            json.dump(self.offsets, index_file, separators=(',', ':'))
+        os.replace(self.path + ".partial", self.path)
+        os.replace(self.path + ".idx.partial", self.path + ".idx")
+
+    # Drop what was written, leaving the last complete file in place
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + ".partial")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+# The number of records in a stage file
+def count_records(path):
+    if os.path.isfile(path + ".idx"):
+        with open(path + ".idx", "r") as index_file:
+            return len(json.load(index_file))
+    return sum(1 for _ in read_records(path))
+
+# Yield the records of a stage file in order
+def read_records(path):
+    with open(path, "rb") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+# Random access to the records of a stage file through its offset index
+class StageReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".idx", "r") as index_file:
+            self.offsets = json.load(index_file)
+        self.file = open(path, "rb")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, id):
+        return str(id) in self.offsets
+
+    def get(self, id):
+        offset = self.offsets.get(str(id))
+        if offset is None:
+            return None
+        self.file.seek(offset)
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+
+
+def qu_record(id, question, type, entities):
+    return {'id': str(id), 'question': question, 'type': type, 'entities': list(entities),
+            'query': ' '.join(entities), 'ir': None}
+
+# The "ir" field of a record. results are PubmedA objects; only their PMIDs and scores are kept.
+def ir_entry(query, results):
+    return {'query': query, 'results': [{'pmid': result.pmid, 'score': result.score} for result in results]}
+
+def result_pmids(record):
+    if not record.get('ir'):
+        return []
+    return [result['pmid'] for result in record['ir']['results']]
+
+
+# Write the stage file at path as the QU/IR xml that batch_search used to write. fetch_articles(pmids) returns
+# {pmid: PubmedA} for the abstracts; without it the <Result> elements only carry their PMIDs.
+def export_xml(path, xml_file, fetch_articles=None):
+    from lxml import etree as ET
+    import question_understanding
+    import information_retrieval
+    import PubmedA
+    root = ET.Element("Input")
+    for record in read_records(path):
+        q = question_understanding.qu_element(root, record['id'], record['question'], record['type'], record['entities'])
+        if not record.get('ir'):
+            continue
+        pmids = result_pmids(record)
+        articles = fetch_articles(pmids) if fetch_articles is not None else {}
+        results = [articles.get(pmid) or PubmedA.PubmedA(pmid, None, None, None, None, []) for pmid in pmids]
+        information_retrieval.results_to_xml(q.find("IR"), record['ir']['query'], results)
+    os.makedirs(os.path.dirname(xml_file) or '.', exist_ok=True)
+    ET.ElementTree(root).write(xml_file, pretty_print=True)
+    print(f"\033[95mWrote {xml_file}\033[0m")
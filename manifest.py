@@ -0,0 +1,58 @@
+"""
+manifest.py records which questions a batch stage has finished, so an interrupted batch run can pick up where it stopped.
+    A manifest is an append-only file with one json line per finished question: its id and whatever the stage needs to
+    rebuild that question's output without redoing the work. Lines are flushed as soon as they are written, so at most
+    the question that was in flight is lost if the process dies. A half written last line is ignored when reading.
+    Once a stage has finished every question its manifest is removed, so the next run starts from scratch.
+"""
+import collections
+import json
+import os
+import threading
+
+class ProgressManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = collections.OrderedDict()
+        complete_last_line = True
+        if os.path.isfile(path):
+            with open(path, "r") as manifest_file:
+                for line in manifest_file:
+                    complete_last_line = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the process died while writing this line
+                        continue
+                    self.done[entry['id']] = entry.get('payload')
+            if self.done:
+                print(f"\033[95mResuming from {path}: {len(self.done)} questions already done\033[0m")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, "a")
+        if not complete_last_line:
+            # start the next entry on its own line
+            self.file.write("\n")
+
+    def is_done(self, id):
+        return str(id) in self.done
+
+    def get(self, id):
+        return self.done.get(str(id))
+
+    def mark_done(self, id, payload=None):
+        with self.lock:
+            self.done[str(id)] = payload
+            self.file.write(json.dumps({'id': str(id), 'payload': payload}) + "\n")
+            self.file.flush()
+
+    # The stage finished every question: forget the progress so the next run does the work again
+    def complete(self):
+        with self.lock:
+            self.file.close()
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
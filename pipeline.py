@@ -0,0 +1,271 @@
+"""
+pipeline.py runs the whole system in batch mode as a streaming pipeline rather than one stage at a time.
+    QU runs on the calling thread and IR and QA each in a worker thread of their own. QU and IR hand questions to the
+    next stage as python tuples through bounded queues, so the three stages overlap in time. The QA stage sends
+    questions to the reader service in small chunks as soon as they arrive, so the first answers are ready while later
+    questions are still being classified.
+    The QU/IR stage file (see interchange.py) is no longer needed to pass data between the stages and is only
+    written when asked for.
+    Every answered question is recorded, with its QU and IR output, in <output_dir>pipeline_progress.jsonl. When an
+    interrupted run is started again the questions found there skip all three stages, and their recorded answers are
+    merged with the new ones in the order of the input csv.
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import shutil
+import threading
+
+import pandas as pd
+
+import interchange
+import question_understanding
+import information_retrieval
+import question_answering
+from manifest import ProgressManifest
+from reader_service import ReaderError
+
+# Passed down the queues after the last question
+_DONE = object()
+
+# Run one pipeline stage: work(item) yields the items to pass on for every item taken from inbox,
+# and finish() (if given) is called once the inbox is exhausted, unless this or any other stage has failed
+def _run_stage(name, work, inbox, outbox, errors, finish=None):
+    failed = False
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            break
+        if failed:
+            # keep draining so the stage before us never blocks on a full queue
+            continue
+        try:
+            for output in work(item):
+                if outbox is not None:
+                    outbox.put(output)
+        except Exception as e:
+            errors.append((name, e))
+            failed = True
+    try:
+        # after a failure the inbox only held part of the questions, so nothing is finished with them (like sending
+        # the questions that made it this far to the readers); run_streaming_batch raises the error
+        if finish is not None and not failed and not errors:
+            finish()
+    except Exception as e:
+        errors.append((name, e))
+    if outbox is not None:
+        outbox.put(_DONE)
+
+
+# The QA end of the pipeline. Questions are grouped by type into chunks of chunk_size and every full chunk is
+# submitted to the reader service straight away. finish() waits for the readers and merges the chunk predictions
+# into the same <type>/predictions.json and nbest_predictions.json files that run_batch_mode writes.
+# Questions the manifest already holds an answer for, or cache (a cache.AnswerCache) holds one for with the same
+# passages, are not read again, and every answer read is added to cache.
+class StreamingQA:
+    def __init__(self, output_dir, reader=None, chunk_size=32, timeout=None, manifest=None, cache=None):
+        self.output_dir = output_dir
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.manifest = manifest
+        _,_,factoid_path,yesno_path,list_path = question_answering.setup_file_system(output_dir, True)
+        self.type_paths = {'yesno': yesno_path, 'factoid': factoid_path, 'list': list_path}
+        self.type_files = {'yesno': yesno_path + "qa_yesno.json", 'factoid': factoid_path + "qa_factoids.json",
+                           'list': list_path + "qa_list.json"}
+        self.writer = question_answering.QAInputWriter(files=[output_dir + "qa_all.json"] + list(self.type_files.values()))
+        self.answers = question_answering.BatchAnswers(cache=cache, manifest=manifest)
+        self.chunks = {type: [] for type in self.type_paths}
+        self.futures = {type: [] for type in self.type_paths}
+        for type in self.type_paths:
+            shutil.rmtree(f"{self.type_paths[type]}chunks{os.path.sep}", ignore_errors=True)
+
+    # details are what the manifest records about the question besides its answer
+    def add(self, data, pmids=(), details=None):
+        id, type, question, abstracts = data
+        json_data = question_answering.get_json_from_data(data)
+        self.writer.append(self.output_dir + "qa_all.json", json_data)
+        if not abstracts or type not in self.type_paths:
+            if self.manifest is not None and not self.manifest.is_done(id):
+                self.manifest.mark_done(id, details)
+            return
+        if self.answers.lookup(id, type, question, pmids, details):
+            return
+        self.writer.append(self.type_files[type], json_data)
+        if self.reader is not None and self.reader.has_head(type):
+            self.chunks[type].extend(json_data['data'])
+            if len(self.chunks[type]) >= self.chunk_size:
+                self._submit(type)
+
+    def _submit(self, type):
+        chunk_dir = f"{self.type_paths[type]}chunks{os.path.sep}{len(self.futures[type]):05d}{os.path.sep}"
+        os.makedirs(chunk_dir, exist_ok=True)
+        predict_file = chunk_dir + "qa_input.json"
+        question_answering.print_json_to_file(predict_file, {'data': self.chunks[type]})
+        print(f"\033[95mSending {len(self.chunks[type])} {type} questions to the reader\033[0m")
+        future = self.reader.submit(type, predict_file, chunk_dir)
+        # record the chunk's answers as soon as it is read, not when the whole batch is done
+        future.add_done_callback(lambda f: f.exception() is None and self.answers.record(type, f.result()))
+        self.futures[type].append(future)
+        self.chunks[type] = []
+
+    def finish(self):
+        self.writer.flush()
+        if self.reader is None:
+            # each type is read as a single chunk, so the manifest only learns its answers once it is done
+            jobs = {}
+            for type in self.type_paths:
+                predict_files = [self.type_files[type]] if self.writer.paragraphs[self.type_files[type]] else []
+                jobs[type] = (self.type_paths[type], predict_files, self._transform_file(type))
+            question_answering.run_readers_concurrently(jobs, timeout=self.timeout, on_chunk=self.answers.record,
+                                                        on_predictions=self.answers.merge)
+            return
+        for type in self.type_paths:
+            if self.chunks[type]:
+                self._submit(type)
+        for type, futures in self.futures.items():
+            try:
+                results = [future.result(timeout=self.timeout) for future in futures]
+            except concurrent.futures.TimeoutError:
+                raise ReaderError(f"The {type} reader did not finish within {self.timeout} seconds")
+            question_answering.merge_reader_results(results, self.type_paths[type])
+            self.answers.merge(type, self.type_paths[type])
+            print(f"\033[95mMigrating {type} json to correct bioasq format!!\033[0m")
+            question_answering.transform_head_to_bioasq(type, self._transform_file(type))
+
+    # We use predictions instead of nbest for yesno since yesno only has 2 options
+    def _transform_file(self, type):
+        file_name = "predictions.json" if type == 'yesno' else "nbest_predictions.json"
+        return self.type_paths[type] + file_name
+
+
+# Run QU -> IR -> QA over every question in qu_input with the stages overlapping.
+# The questions are classified qu_batch_size at a time and go through one spaCy pipe in batches of at most
+# spacy_batch_size, in spacy_processes processes. The reader scores up to qa_passages of the retrieved abstracts of every question.
+# cascade is passed to question_understanding.predict_types.
+# If ir_output_file is given, the same stage file that batch_search writes is saved there for analysis.py.
+# The IR stage searches on session's searcher, or on one opened for the run, through search_cache if given, and
+# reads the articles from docstore if given. engine (see bm25.py) answers the queries it supports instead of Whoosh,
+# dense (see dense_retrieval.py) searches for the questions by their embeddings as well and reranker (see reranker.py)
+# picks the articles the readers see. Answers are looked up in and added to answer_cache (see StreamingQA).
+def run_streaming_batch(qu_input, output_dir, device, tokenizer, model, nlp, indexer, parser, reader=None,
+                        ir_output_file=None, qu_batch_size=16, qa_chunk_size=32, queue_size=64, timeout=None,
+                        qa_passages=question_answering.PASSAGES_PER_QUESTION, spacy_processes=1, cascade=None,
+                        session=None, search_cache=None, docstore=None, engine=None, dense=None,
+                        reranker=None, spacy_batch_size=256, answer_cache=None):
+    if session is None:
+        with information_retrieval.SearcherSession(indexer) as session:
+            return run_streaming_batch(qu_input, output_dir, device, tokenizer, model, nlp, indexer, parser, reader,
+                                       ir_output_file, qu_batch_size, qa_chunk_size, queue_size, timeout, qa_passages,
+                                       spacy_processes, cascade, session, search_cache, docstore, engine, dense, reranker,
+                                       spacy_batch_size, answer_cache)
+    ir_inbox = queue.Queue(maxsize=queue_size)
+    qa_inbox = queue.Queue(maxsize=queue_size)
+    errors = []
+    manifest = ProgressManifest(output_dir + "pipeline_progress.jsonl")
+    streaming_qa = StreamingQA(output_dir, reader=reader, chunk_size=qa_chunk_size, timeout=timeout, manifest=manifest,
+                               cache=answer_cache)
+    stage_writer = interchange.StageWriter(ir_output_file) if ir_output_file else None
+
+    # The questions of the csv in its order as (id, question, type, done), read and classified qu_batch_size at a
+    # time. done is what the manifest holds for a question answered by an earlier run, which is not classified again.
+    def classified():
+        for chunk in pd.read_csv(qu_input, sep=',', header=0, chunksize=qu_batch_size):
+            if errors:
+                return
+            todo = chunk[[not manifest.is_done(id) for id in chunk['ID']]]
+            types = {}
+            if len(todo):
+                types = dict(zip(todo['ID'], question_understanding.predict_types(todo, device, tokenizer, model,
+                                                                                  cascade=cascade)))
+            for id, question in zip(chunk['ID'], chunk['Question']):
+                yield (id, question, types[id], None) if id in types else (id, question, None, manifest.get(id))
+
+    # The QU records of every question. All of them go through one nlp.pipe, so with spacy_processes > 1 its pool of
+    # processes, each loading the model, is started once for the run and not for every chunk of the csv. nlp.pipe
+    # reads a whole batch before it parses any of it, so its batches are kept to qu_batch_size questions: a batch of
+    # spacy_batch_size would hold every question back from IR and QA until that many had been classified.
+    def understand():
+        # the questions read from the csv that have not been passed on yet, in the csv order
+        pending = collections.deque()
+
+        def questions():
+            for row in classified():
+                pending.append(row)
+                if row[3] is None:
+                    yield row[1]
+
+        # keep the csv order, with the questions answered by an earlier run passed along from the manifest
+        def answered_before():
+            while pending and pending[0][3] is not None:
+                id, _, _, done = pending.popleft()
+                yield (id, done['question'], done['type'], done['entities'], ' '.join(done['entities']))
+
+        for doc in nlp.pipe(questions(), batch_size=min(spacy_batch_size, qu_batch_size), n_process=spacy_processes):
+            yield from answered_before()
+            id, question, type, _ = pending.popleft()
+            entities = [ent.text for ent in doc.ents]
+            print(f"\033[95mQU: {question} <{type}>\033[0m")
+            yield (id, question, type, entities, ' '.join(entities))
+        yield from answered_before()
+
+    def retrieve(record):
+        id, question, type, entities, query = record
+        if manifest.is_done(id):
+            done = manifest.get(id)
+            # the manifest only holds the PMIDs of the results, their text comes from the index
+            pmids = interchange.result_pmids(done)
+            articles = information_retrieval.fetch_articles(indexer, pmids, session=session, docstore=docstore)
+            yield record + (done['ir']['query'], [articles[pmid] for pmid in pmids if pmid in articles])
+            return
+        # safeguard for malformed query
+        if not query:
+            print("\033[95mNo query found, using original question\033[0m")
+            query = question
+        results = information_retrieval.search(indexer, parser, query, batch_mode=True, session=session, cache=search_cache,
+                                               docstore=docstore, engine=engine, dense=dense, question=question,
+                                               reranker=reranker)
+        yield record + (query, results)
+
+    def answer(record):
+        id, question, type, entities, _, query, results = record
+        details = dict(interchange.qu_record(id, question, type, entities), ir=interchange.ir_entry(query, results))
+        if stage_writer is not None:
+            stage_writer.write(details)
+        # If IR was unsuccessful when it came to retrieving documents for the given question there are no passages
+        passages = [result for result in results if result.abstract_text][:qa_passages]
+        streaming_qa.add((str(id), type, question, [result.abstract_text for result in passages]),
+                         pmids=[result.pmid for result in passages], details=details)
+        return ()
+
+    threads = [threading.Thread(target=_run_stage, args=("IR", retrieve, ir_inbox, qa_inbox, errors)),
+               threading.Thread(target=_run_stage, args=("QA", answer, qa_inbox, None, errors, streaming_qa.finish))]
+    for thread in threads:
+        thread.start()
+
+    # The QU stage reads the csv in chunks and runs on this thread, feeding the rest of the pipeline
+    try:
+        for record in understand():
+            if errors:
+                break
+            ir_inbox.put(record)
+    except Exception as e:
+        errors.append(("QU", e))
+    finally:
+        ir_inbox.put(_DONE)
+    for thread in threads:
+        thread.join()
+
+    if stage_writer is not None:
+        if errors:
+            stage_writer.discard()
+        else:
+            stage_writer.close()
+            print(f"\033[95mWrote data to {ir_output_file}\033[0m")
+    if errors:
+        # the manifest is kept, so running the batch again picks up from here
+        manifest.close()
+        stage, error = errors[0]
+        raise RuntimeError(f"The {stage} stage of the pipeline failed: {error}") from error
+    manifest.complete()
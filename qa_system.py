@@ -9,80 +9,111 @@ import warnings
 
 #warnings.simplefilter(action='ignore',category=UserWarning)
 
-import json
-import pandas as pd
-import numpy as np
-import torch
-import torch.nn.functional as F
-from transformers import BertTokenizer,BertForSequenceClassification,AdamW,BertConfig,get_linear_schedule_with_warmup
-from lxml import etree as ET
-import spacy
-import scispacy
-import en_core_sci_lg
-from bs4 import BeautifulSoup as bs
-
-import requests
-import re
+# Only light modules are imported here; startup.py imports torch, transformers, spaCy and whoosh
+# on the threads that load the models that need them.
+import argparse
 import os
 import shutil
-from tqdm import tqdm
-import json
-
-from whoosh import index
-from whoosh.fields import Schema, TEXT, IDLIST, ID, NUMERIC
-from whoosh.analysis import StemmingAnalyzer
-from whoosh.qparser import QueryParser
-
-import setup
-import question_understanding
-import information_retrieval
-import question_answering
+import pandas as pd
 
-import PubmedA
+import startup
+import cache
+import interchange
 
 if __name__ == "__main__":
-    # This ensures that all the packages are installed so that the system can work with the modules
+    arg_parser = argparse.ArgumentParser(description='BioASQ question answering system')
+    arg_parser.add_argument('--serve', action='store_true', help='serve the /answer and /batch HTTP endpoints instead of prompting')
+    arg_parser.add_argument('--port', type=int, default=8000, help='port for --serve')
+    args = arg_parser.parse_args()
     data_folder = 'data_modules'
-    setup.setup_system(data_folder)
-    index_folder_name = 'index'
-    model_folder_name = 'model'
-    pubmed_official_index_name = 'pubmed_articles'
-    # This is for cpu support for non-NVIDEA cuda-capable machines.
-    spacy.prefer_gpu()
-    # initialize model
-    print("\033[95mInitializing model...\033[0m")
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    model = BertForSequenceClassification.from_pretrained(data_folder + os.path.sep + model_folder_name, cache_dir=None)
-    # load in BioBERT
-    print("\033[95mLoading BioBERT...\033[0m")
-    nlp = en_core_sci_lg.load()
-    # load index
+    # Each reader head restores its checkpoint from <reader_model_dir><head>/
+    reader_model_dir = f"tmp{os.path.sep}qa{os.path.sep}"
+    # A sharded index (python build_index.py build --shard-by pmid|year) is searched a shard per worker process, in
+    # shard_processes processes (None for one per shard, 1 to search the shards one after the other)
     index_var = 'full_index'
-    print("\033[95mLoading index...\033[0m")
-    # This is the schema for each query retrieved from 
-    pubmed_article_ix = index.open_dir(data_folder + os.path.sep + index_folder_name + os.path.sep + index_var, indexname=pubmed_official_index_name)
-    qp = QueryParser("abstract_text", schema=Schema(
-        pmid=ID(stored=True),
-        title=TEXT(stored=True),
-        journal=TEXT(stored=True),
-        mesh_major=IDLIST(stored=True),
-        year=NUMERIC(stored=True),
-        abstract_text=TEXT(stored=True, analyzer=StemmingAnalyzer())))
+    shard_processes = None
+    # Torch threads for the question type classifier (None lets torch decide), and whether to run it as a dynamically
+    # quantized int8 model, which is faster on CPU-only hosts (see python benchmark.py classifier)
+    classifier_threads = None
+    quantize_classifier = False
+    # 'torch' or 'onnx'; the onnx backend runs data_modules/model/classifier.onnx (made by export_onnx.py) with ONNX Runtime
+    classifier_backend = 'torch'
+    # Questions the lexical cascade (python question_type_cascade.py) types with at least this probability skip BERT;
+    # None sends every question to BERT
+    cascade_threshold = 0.9
+    # 'whoosh', or 'bm25' to answer plain term queries from the NumPy postings built by python bm25.py
+    retrieval_backend = 'whoosh'
+    # None, or 'fuse' / 'only' to fuse the results with, or replace them by, those of the dense retriever built by
+    # python dense_retrieval.py, which scans dense_nprobe of its IVF lists for every question
+    dense_mode = None
+    dense_nprobe = 16
+    # None, or the number of search results the reranker built by python reranker.py reranks by late interaction
+    # before the readers read the best of them
+    rerank_depth = None
+    # load the classifier, spaCy model, index and readers in parallel and warm them up
+    system = startup.load_system(data_folder, reader_model_dir, index_var=index_var,
+                                 classifier_threads=classifier_threads, quantize_classifier=quantize_classifier,
+                                 classifier_backend=classifier_backend, cascade_threshold=cascade_threshold,
+                                 retrieval_backend=retrieval_backend, dense_mode=dense_mode, dense_nprobe=dense_nprobe,
+                                 rerank_depth=rerank_depth, shard_processes=shard_processes)
+    device, tokenizer, model, nlp, cascade = system.device, system.tokenizer, system.model, system.nlp, system.cascade
+    pubmed_article_ix, qp, reader = system.indexer, system.parser, system.reader
+    # every query, in batch and live mode, runs on this one searcher
+    search_session = system.session
+    docstore = system.docstore
+    engine = system.engine
+    dense = system.dense
+    reranker = system.reranker
+    # Answers are cached on disk across runs and dropped automatically when a checkpoint or the index changes
+    answer_cache = cache.AnswerCache(f"tmp{os.path.sep}cache{os.path.sep}answers.sqlite",
+                                     version_paths=[reader_model_dir, data_folder + os.path.sep + 'model',
+                                                    data_folder + os.path.sep + 'index' + os.path.sep + index_var])
+    # Search results are cached the same way and dropped when the index changes
+    search_cache = cache.SearchCache(f"tmp{os.path.sep}cache{os.path.sep}search.sqlite",
+                                     version_paths=[data_folder + os.path.sep + 'index' + os.path.sep + index_var,
+                                                    data_folder + os.path.sep + 'bm25' + os.path.sep + index_var,
+                                                    data_folder + os.path.sep + 'dense' + os.path.sep + index_var,
+                                                    data_folder + os.path.sep + 'tokens' + os.path.sep + index_var])
+
+    import question_understanding
+    import information_retrieval
+    import question_answering
+
+    if args.serve:
+        import server
+        qa_server = server.QAServer(device, tokenizer, model, nlp, pubmed_article_ix, qp, reader,
+                                    output_dir=f"tmp{os.path.sep}server_qa{os.path.sep}", cascade=cascade,
+                                    session=search_session, search_cache=search_cache,
+                                    docstore=docstore, engine=engine, dense=dense, reranker=reranker)
+        server.serve(qa_server, port=args.port)
+        reader.close()
+        search_session.close()
+        pubmed_article_ix.close()
+        quit()
 
     batch_mode_answer = input("\033[95m Would you like to run batch mode? (y/n): \033[0m")
     is_batch_mode = batch_mode_answer in ['Y','y','Yes','yes','Yep','yep','Yup','yup']
     if is_batch_mode:
         while(True):
             # qu_input = "testing_datasets/input.csv"
-            # ir_input_generated = "tmp/ir/input/bioasq_qa.xml"
-            # ir_output_generated = "tmp/ir/output/bioasq_qa.xml"
+            # ir_input_generated = "tmp/ir/input/bioasq_qa.jsonl"
+            # ir_output_generated = "tmp/ir/output/bioasq_qa.jsonl"
             # qa_output_generated_dir = "tmp/qa/"
             # For evaluation
             qu_input = "testing_datasets/evaluation_input.csv"
-            ir_input_generated = "tmp/ir/input/bioasq_qa_EVAL.xml"
-            ir_output_generated = "tmp/ir/output/bioasq_qa_EVAL.xml"
+            ir_input_generated = "tmp/ir/input/bioasq_qa_EVAL.jsonl"
+            ir_output_generated = "tmp/ir/output/bioasq_qa_EVAL.jsonl"
             qa_output_generated_dir = "tmp/qa_EVAL/"
+            # The whole system option streams questions through QU, IR and QA; the IR stage file is only needed for analysis.py
+            write_intermediate_file = True
+            # The stage files reference abstracts by PMID; this also writes the IR output as the old xml, abstracts included
+            export_ir_xml = False
+            ir_output_xml = "tmp/ir/output/bioasq_qa_EVAL.xml"
+            # nlp.pipe settings for QU entity extraction; extra processes help on CPU-only hosts with large question sets
+            spacy_batch_size = 256
+            spacy_processes = 1
+            # worker processes for batch IR, each with its own searcher; the results are the same as with one
+            search_processes = 1
 
             # User prompt
             batch_options = """\033[95m
@@ -97,39 +128,63 @@ if __name__ == "__main__":
             batch_options_dict = {"0":"Whole system", "1": "Question Understanding", "2": "Information Retrieval", "3": "Question Answering", "4": "QU + IR", "5": "IR + QU"}
             result = input(batch_options)
             if(result):
+                ran_ir = result in ("0", "2", "4", "5")
                 if result in batch_options_dict.keys():
                     print(f"\033[95m{batch_options_dict.get(result)} selected.\033[0m")
                 if (result == "0"):
-                    test_dataframe = pd.read_csv(qu_input,sep=',',header=0)
-                    question_understanding.ask_and_receive(test_dataframe,device,tokenizer,model,nlp,batch_mode=True, output_file=ir_output_generated)
-                    information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp)
-                    question_answering.run_batch_mode(input_file=ir_output_generated,output_dir=qa_output_generated_dir)
+                    import pipeline
+                    pipeline.run_streaming_batch(qu_input, qa_output_generated_dir, device, tokenizer, model, nlp,
+                                                 indexer=pubmed_article_ix, parser=qp, reader=reader,
+                                                 ir_output_file=ir_output_generated if write_intermediate_file or export_ir_xml else None,
+                                                 spacy_processes=spacy_processes, cascade=cascade, session=search_session,
+                                                 search_cache=search_cache, docstore=docstore, engine=engine, dense=dense,
+                                                 reranker=reranker, spacy_batch_size=spacy_batch_size,
+                                                 answer_cache=answer_cache)
                 elif(result == "1"):
                     test_dataframe = pd.read_csv(qu_input,sep=',',header=0)
-                    question_understanding.ask_and_receive(test_dataframe,device,tokenizer,model,nlp,batch_mode=True, output_file=ir_output_generated)
+                    question_understanding.ask_and_receive(test_dataframe,device,tokenizer,model,nlp,batch_mode=True, output_file=ir_input_generated,
+                                                           spacy_batch_size=spacy_batch_size, spacy_processes=spacy_processes, cascade=cascade)
                 elif(result == "2"):
                     if os.path.exists(ir_input_generated):
-                        information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp)
+                        information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp, session=search_session,
+                                                       processes=search_processes, cache=search_cache, engine=engine, dense=dense,
+                                                       reranker=reranker)
                     else:
                         print("\033[91mMake sure you run the QU module before running the IR module.\033[0m")
                 elif(result == "3"):
                     if os.path.exists(ir_output_generated):
-                        question_answering.run_batch_mode(input_file=ir_output_generated,output_dir=qa_output_generated_dir)
+                        question_answering.run_batch_mode(input_file=ir_output_generated,output_dir=qa_output_generated_dir,indexer=pubmed_article_ix,reader=reader,cache=answer_cache,session=search_session,docstore=docstore)
                     else:
                         print("\033[91mMake sure you run both the QU module and the IR module before running the QA module.\033[0m")
                 elif(result == "4"):
                     test_dataframe = pd.read_csv(qu_input,sep=',',header=0)
-                    question_understanding.ask_and_receive(test_dataframe,device,tokenizer,model,nlp,batch_mode=True, output_file=ir_output_generated)
-                    information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp)
+                    question_understanding.ask_and_receive(test_dataframe,device,tokenizer,model,nlp,batch_mode=True, output_file=ir_input_generated,
+                                                           spacy_batch_size=spacy_batch_size, spacy_processes=spacy_processes, cascade=cascade)
+                    information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp, session=search_session,
+                                                       processes=search_processes, cache=search_cache, engine=engine, dense=dense,
+                                                       reranker=reranker)
                 elif(result == "5"):
                     if os.path.exists(ir_input_generated):
-                        information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp)
-                        question_answering.run_batch_mode(input_file=ir_output_generated,output_dir=qa_output_generated_dir)
+                        information_retrieval.batch_search(input_file=ir_input_generated, output_file=ir_output_generated, indexer=pubmed_article_ix, parser=qp, session=search_session,
+                                                       processes=search_processes, cache=search_cache, engine=engine, dense=dense,
+                                                       reranker=reranker)
+                        question_answering.run_batch_mode(input_file=ir_output_generated,output_dir=qa_output_generated_dir,indexer=pubmed_article_ix,reader=reader,cache=answer_cache,session=search_session,docstore=docstore)
                     else:
                         print("\033[91mMake sure you run the QU module before running the IR module.\033[0m")
                 else:
                     print("\033[95mShutting down...\033[0m")
+                    answer_cache.print_stats("Answer cache")
+                    search_cache.print_stats()
+                    if cascade is not None:
+                        cascade.print_stats()
+                    reader.close()
+                    search_session.close()
+                    pubmed_article_ix.close()
                     quit()
+                if ran_ir and export_ir_xml and os.path.exists(ir_output_generated):
+                    interchange.export_xml(ir_output_generated, ir_output_xml,
+                                           fetch_articles=lambda pmids: information_retrieval.fetch_articles(pubmed_article_ix, pmids, session=search_session,
+                                                                                                             docstore=docstore))
     # If the user responds with anything not affirmative, send them to the live question answering
     else:
         n = 0
@@ -137,29 +192,46 @@ if __name__ == "__main__":
             user_question = input("\033[95m:: Please enter your question for the BioASQ QA system or \'quit\' ::\n\033[0m")
             # handle end loop
             if user_question  == 'quit': 
+                answer_cache.print_stats("Answer cache")
+                search_cache.print_stats()
+                if cascade is not None:
+                    cascade.print_stats()
+                reader.close()
+                search_session.close()
+                pubmed_article_ix.close()
                 quit()
             df = pd.DataFrame({'ID':[n],'Question':user_question})
             # Retrieve the id,type, concepts, and query generated by QU module 
-            qu_output = question_understanding.ask_and_receive(df,device,tokenizer,model,nlp)
+            qu_output = question_understanding.ask_and_receive(df,device,tokenizer,model,nlp,cascade=cascade)
             id, question, type, concepts, query = qu_output
             if type == 'summary':
                 print("\u001b[31mSummary type questions are currently not supported. \nPlease try asking a question that can be answered with a list, yes/no, or factoid style answer.\033[0m")
             else:
                 print(f"\033[95m <QU>\nID: {id}\nQuestion: {question}\nType: {type}\nConcepts:{concepts}\nQuery: {query}\n</QU> \033[0m")
-                query_results = information_retrieval.search(pubmed_article_ix,qp,qu_output)
+                query_results = information_retrieval.search(pubmed_article_ix,qp,qu_output,session=search_session,cache=search_cache,docstore=docstore,engine=engine,dense=dense,reranker=reranker)
                 if query_results:
                     top_result = query_results[0]
                     print(f"\033[95m Top result\n{top_result}\033[0m")
-                    # Pass in the question ID, type, user question, and top abstract for the result  
-                    data_for_qa = (n, type, user_question,top_result.abstract_text)
+                    # The reader scores the top abstracts together in one request and their answers are combined
+                    passages = [result for result in query_results if result.abstract_text][:question_answering.PASSAGES_PER_QUESTION]
+                    data_for_qa = (n, type, user_question, [result.abstract_text for result in passages])
                     # all temporary data will be stored in tmp/live_qa/
                     qa_output_generated_dir = f'{os.getcwd()}{os.path.sep}tmp{os.path.sep}live_qa{os.path.sep}'
-                    results = question_answering.get_answer(data_for_qa,output_dir=qa_output_generated_dir)
-                    if results:
+                    answer_key = answer_cache.answer_key(user_question, type, [result.pmid for result in passages])
+                    cached_answer = answer_cache.get(answer_key)
+                    if cached_answer is not None:
+                        print("\033[95mAnswer found in the answer cache\033[0m")
+                        answers = {str(n): cached_answer}
+                    else:
+                        answers = question_answering.get_answer(data_for_qa,output_dir=qa_output_generated_dir,reader=reader)
+                        if answers:
+                            answer_cache.put(answer_key, list(answers.values())[0])
+                    if answers:
+                        results = {id: question_answering.aggregate_answer(type, entry) for id, entry in answers.items()}
                         if type == 'list':
                             # get the first key 
                             index = list(results.keys())[0]
-                            top_three_answers = f"1) {results[index][0]['text']}\n\t 2) {results[index][1]['text']}\n\t 3) {results[index][2]['text']}"
+                            top_three_answers = "\n\t ".join(f"{i}) {candidate['text']}" for i, candidate in enumerate(results[index][:3], 1))
                             results = top_three_answers ## give more answers for list-style questions
                         print(f"\u001b[33m****************************************************************************************\033[0m\n\n \033[92m [<QUESTION>]\033[0m\n\t\033[95m\'{user_question}\' \033[0m \n  \033[92m[<ANSWER>]\033[0m\n\t\033[95m {results} \033[0m \n\n\u001b[33m****************************************************************************************\033[0m")
                         #Cleaning up all generated temp files
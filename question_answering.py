@@ -1,6 +1,8 @@
 """
 question_answering.py handles passing the response from the qu and ir portions of the pipeline into the BioBERT model so that we can preoperly retrieve an answer to the original question
 we utilize run_yesno.py, run_factoid.py, and run_list.py with the proper parameters passed in to accomplish this.
+When a reader_service.ReaderService is passed in, the readers are already loaded and are called in-process instead of
+starting a new python process for every run.
 
 Necessary args = vocab_file, bert_config_file, and output_dir
      
@@ -22,21 +24,48 @@ fields for input json for factoid/list/yesno:
 import warnings
 warnings.filterwarnings('ignore')
 
+import collections
 import json
 from json import loads
 import os
 import shutil
-import time
-from bs4 import BeautifulSoup as bs
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# pass formatted json into file that generates answer
-def run_qa_file(filename, output_dir,predict_file):
+import interchange
+import reader_service
+from reader_service import ReaderError, ReaderResult
+from manifest import ProgressManifest
+
+# pass formatted json into file that generates answer, raising ReaderError if the script fails or runs past the timeout
+def run_qa_file(filename, output_dir,predict_file, timeout=None, threads=None):
     print(f"\033[95mRunning {filename}\033[0m")
-    vocab_file_path = f'data_modules{os.path.sep}model{os.path.sep}vocab.txt'
-    bert_config_file = f'data_modules{os.path.sep}model{os.path.sep}config.json'
-    command = f"python {filename} --do_train=False --do_predict=True --vocab_file={vocab_file_path} --bert_config_file={bert_config_file} --output_dir={output_dir} --predict_file={predict_file}"
-    print(f"\033[95mRunning command: {command}\033[0m")
-    os.system(command)
+    command = [sys.executable, filename] + reader_service.reader_flags(output_dir, predict_file=predict_file)
+    print(f"\033[95mRunning command: {' '.join(command)}\033[0m")
+    env = None
+    if threads:
+        # keep scripts that run side by side from each grabbing every core
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    try:
+        completed = subprocess.run(command, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        raise ReaderError(f"{filename} did not finish {predict_file} within {timeout} seconds")
+    if completed.returncode != 0:
+        raise ReaderError(f"{filename} exited with code {completed.returncode} on {predict_file}")
+
+# Run the reader for the given question type, in-process through the reader service when we have one.
+# Returns a ReaderResult once the prediction files exist, otherwise raises ReaderError.
+def run_reader(type, output_dir, predict_file, reader=None, timeout=None, threads=None):
+    if reader is not None and reader.has_head(type):
+        print(f"\033[95mRunning {type} reader\033[0m")
+        result = reader.predict(type, predict_file, output_dir, timeout=timeout)
+    else:
+        run_qa_file(f'run_{type}.py', output_dir, predict_file=predict_file, timeout=timeout, threads=threads)
+        result = ReaderResult(type, output_dir + "predictions.json", output_dir + "nbest_predictions.json")
+    if not os.path.isfile(result.predictions_file):
+        raise ReaderError(f"The {type} reader finished without writing {result.predictions_file}")
+    return result
 
 # prints json to file ;)
 def print_json_to_file(file, json_data, batch_mode = False):
@@ -56,33 +85,116 @@ def print_json_to_file(file, json_data, batch_mode = False):
         json.dump(json_data,outfile,indent=4)
         outfile.close()
 
-# This is all to get the data in the proper format for the json file
+# Collects the paragraphs for every batch mode json file in memory and writes each file exactly once in flush(),
+# rather than re-reading and re-writing the whole file for every question like print_json_to_file(batch_mode=True)
+class QAInputWriter:
+    def __init__(self, files=()):
+        # files listed here are always written, even if no question of that type was seen
+        self.paragraphs = {file: [] for file in files}
+
+    def append(self, file, json_data):
+        self.paragraphs.setdefault(file, []).extend(json_data['data'])
+
+    def flush(self):
+        for file, data in self.paragraphs.items():
+            print(f"\033[95mWriting {len(data)} questions to {file}\033[0m")
+            print_json_to_file(file, {'data': data})
+
+# How many of the retrieved abstracts the reader scores for every question
+PASSAGES_PER_QUESTION = 5
+
+# Every abstract of a question is its own paragraph with the qas id <id>_<nnn>. This is the multi-passage id
+# convention of BioBERT: the biocodes/transform_n2b_*.py scripts strip the last four characters to group the passages.
+def passage_id(id, n):
+    return f"{id}_{int(n):03d}"
+
+def question_id(passage_id):
+    return passage_id[:-4]
+
+# This is all to get the data in the proper format for the json file.
+# abstracts is the list of passages the reader should score for the question, or a single abstract.
 def get_json_from_data(data):
-    id, type, question, abstract = data
+    id, type, question, abstracts = data
+    if isinstance(abstracts, str):
+        abstracts = [abstracts]
     json_data = {}
-    qas = [{'id':id, 'question':question}]
-    one_item = {'qas':qas,'context':abstract}
     paragraphs = []
-    paragraphs.append(one_item)
+    for n, abstract in enumerate(list(abstracts) or [""]):
+        qas = [{'id':passage_id(id, n), 'question':question}]
+        paragraphs.append({'qas':qas,'context':abstract})
     json_data['data'] = [{'paragraphs':paragraphs}]
     return json_data
 
+# Group passage level reader output by question: {question id: {'predictions': {nnn: ...}, 'nbest': {nnn: ...}}}.
+# This is the form answers are cached and recorded in.
+def group_passages(predictions, nbest):
+    grouped = collections.OrderedDict()
+    for pid, prediction in predictions.items():
+        entry = grouped.setdefault(question_id(pid), {'predictions': collections.OrderedDict(), 'nbest': collections.OrderedDict()})
+        entry['predictions'][pid[-3:]] = prediction
+        if pid in nbest:
+            entry['nbest'][pid[-3:]] = nbest[pid]
+    return grouped
+
+# The grouped answers in the prediction files of a ReaderResult
+def read_reader_answers(result):
+    return group_passages(_load_json_if_exists(result.predictions_file), _load_json_if_exists(result.nbest_predictions_file))
+
+# Combine the passage level answers of one question into the answer to the question, in the form the reader
+# gives for a single passage. The yes/no logits are averaged over the passages; the factoid and list candidates of
+# every passage are pooled, adding up the probabilities of candidates with the same text, as the transform scripts do.
+def aggregate_answer(type, entry):
+    if type == 'yesno':
+        logits = [prediction[1][0] if isinstance(prediction[1], list) else prediction[1] for prediction in entry['predictions'].values()]
+        mean = sum(logits) / len(logits)
+        return ['yes' if mean > 0.5 else 'no', [mean]]
+    pooled = collections.OrderedDict()
+    for nbest in entry['nbest'].values():
+        for candidate in nbest:
+            text = candidate['text'].strip()
+            if not text:
+                continue
+            if text.lower() in pooled:
+                pooled[text.lower()]['probability'] += candidate['probability']
+            else:
+                pooled[text.lower()] = {'text': text, 'probability': candidate['probability']}
+    ranked = sorted(pooled.values(), key=lambda candidate: candidate['probability'], reverse=True)
+    if type == 'list':
+        return ranked
+    return ranked[0]['text'] if ranked else next(iter(entry['predictions'].values()), "")
+
+# Merge the predictions.json / nbest_predictions.json that the reader wrote for each chunk of a batch
+# into a single predictions.json / nbest_predictions.json in output_dir, keeping the chunk order
+def merge_reader_results(results, output_dir):
+    for file_name, field in (("predictions.json", "predictions_file"), ("nbest_predictions.json", "nbest_predictions_file")):
+        chunk_files = [getattr(result, field) for result in results if os.path.isfile(getattr(result, field))]
+        if not chunk_files:
+            # don't leave the output of an earlier run behind
+            if os.path.isfile(output_dir + file_name):
+                os.remove(output_dir + file_name)
+            continue
+        if chunk_files == [output_dir + file_name]:
+            continue
+        merged = collections.OrderedDict()
+        for chunk_file in chunk_files:
+            with open(chunk_file, "r") as j:
+                merged.update(json.load(j, object_pairs_hook=collections.OrderedDict))
+        with open(output_dir + file_name, "w") as outfile:
+            json.dump(merged, outfile, indent=4)
+
+# Transform one reader's nbest_predictions.json / predictions.json into proper format for the Evaluation Measures repository
+def transform_head_to_bioasq(type, prediction_file):
+    command = f"python ./biocodes/transform_n2b_{type}.py --nbest_path={prediction_file} --output_path={os.path.dirname(prediction_file)}"
+    if os.path.exists(prediction_file):
+        print(f"\033[95mChanging {type}!\033[0m")
+        subprocess.run(command, shell=True, check=True)
+
 # Transform the nbest_predictions.json and predictions.json into proper format for the Evaluation Measures repository
 def transform_to_bioasq(file_paths):
     factoid_old, list_old, yesno_old = file_paths
-    factoid_command = f"python ./biocodes/transform_n2b_factoid.py --nbest_path={factoid_old} --output_path={os.path.dirname(factoid_old)}"
-    list_command = f"python ./biocodes/transform_n2b_list.py --nbest_path={list_old} --output_path={os.path.dirname(list_old)}"
-    yesno_command = f"python ./biocodes/transform_n2b_yesno.py --nbest_path={yesno_old} --output_path={os.path.dirname(yesno_old)}"
-    if os.path.exists(factoid_old):
-        print("\033[95mChanging Factoid!\033[0m")
-        os.system(factoid_command)
-    #commenting this out until List question formatting 
-    if os.path.exists(list_old): 
-        print("\033[95mChanging List!\033[0m")
-        os.system(list_command)
-    if os.path.exists(yesno_old):
-        print("\033[95mChanging yesno!\033[0m")
-        os.system(yesno_command)
+    transform_head_to_bioasq('factoid', factoid_old)
+    transform_head_to_bioasq('list', list_old)
+    transform_head_to_bioasq('yesno', yesno_old)
     
 #ensure temp directory and subdirectories exist
 def setup_file_system(output_dir,batch_mode = False):
@@ -106,8 +218,10 @@ def setup_file_system(output_dir,batch_mode = False):
             os.mkdir (list_path)
     return inputfile_path, outfile_path, factoid_path,yesno_path,list_path
 
-def get_answer(json_data, output_dir, batch_mode = False):
-    id, type, question,abstract = json_data
+# json_data is (id, type, question, abstracts). In live mode all passages are read in one reader request and the
+# passage level answers are returned grouped by question.
+def get_answer(json_data, output_dir, batch_mode = False, reader=None, writer=None, timeout=300):
+    id, type, question, abstracts = json_data
     inputfile_path,outfile_path,factoid_path,yesno_path,list_path = setup_file_system(output_dir)
     # list nbest is used to respond with multiple results
     if(batch_mode):
@@ -115,89 +229,199 @@ def get_answer(json_data, output_dir, batch_mode = False):
         yesno_file_path = yesno_path + "qa_yesno.json"
         list_file_path = list_path + "qa_list.json"
         printing_json = get_json_from_data(json_data)
-        if type == 'yesno':
-            print_json_to_file(yesno_file_path, printing_json, batch_mode=True)
-        elif type == 'factoid':
-            print_json_to_file(factoid_file_path, printing_json, batch_mode=True)
-        elif type == 'list':
-            print_json_to_file(list_file_path, printing_json, batch_mode=True)
-        else: # We don't handle the summary case
-            return 
+        type_file_paths = {'yesno': yesno_file_path, 'factoid': factoid_file_path, 'list': list_file_path}
+        if type not in type_file_paths: # We don't handle the summary case
+            return
+        if writer is not None:
+            writer.append(type_file_paths[type], printing_json)
+        else:
+            print_json_to_file(type_file_paths[type], printing_json, batch_mode=True)
     else:
         print(f'\033[95mQuestion answering json: {json_data}\033[0m ')
         # Write data in BioASQ format to json file
         good_json_data = get_json_from_data(json_data)
         print_json_to_file(inputfile_path, good_json_data)
         print(f"\033[95mQuestion type <{type}>\033[0m")
-        if type == 'yesno':
-            run_qa_file('run_yesno.py',output_dir, predict_file=inputfile_path)
-        elif type == 'factoid':
-            run_qa_file('run_factoid.py',output_dir, predict_file=inputfile_path)
-        elif type == 'list':
-            run_qa_file('run_list.py',output_dir, predict_file=inputfile_path)
-            list_nbest = output_dir + "nbest_predictions.json"
-            # allow for getting multiple predictions
-            outfile_path = list_nbest
-        else: # We don't handle the summary case
-            return 
-        while (not os.path.exists(outfile_path)):
-            time.sleep(1)
-        # Wait for qa script to finish to respond with answer if not batch mode
-        if os.path.isfile(outfile_path):
-            with open(outfile_path,'r') as j:
-                results = json.loads(j.read()) 
-                j.close()
-                return results
-
-def run_batch_mode(input_file,output_dir):
+        if type not in ('yesno', 'factoid', 'list'): # We don't handle the summary case
+            return
+        # run_reader only returns once the reader has finished, so there is nothing to wait for
+        try:
+            reader_result = run_reader(type, output_dir, inputfile_path, reader=reader, timeout=timeout)
+        except ReaderError as e:
+            print(f"\033[91m{e}\033[0m")
+            return
+        # {id: {'predictions': ..., 'nbest': ...}} with the answer of every passage; aggregate_answer combines them
+        answers = read_reader_answers(reader_result)
+        if answers:
+            return answers
+
+# Remembers which batch questions are already answered, either by an earlier run of this batch (recorded in a
+# manifest.ProgressManifest) or by the answer cache, so that only the rest go to the readers.
+# record() is called with each chunk the readers finish and stores its answers in the manifest and the cache;
+# merge() then writes a reader's predictions.json and nbest_predictions.json with the new and the known answers
+# together, in the order the questions were looked up.
+class BatchAnswers:
+    def __init__(self, cache=None, manifest=None):
+        self.cache = cache
+        self.manifest = manifest
+        self.known = collections.defaultdict(dict)
+        self.keys = collections.defaultdict(dict)
+        self.details = collections.defaultdict(dict)
+        self.order = collections.defaultdict(list)
+
+    # Returns True if the answer for this question is already known. details are stored in the manifest with the answer.
+    def lookup(self, id, type, question, pmids, details=None):
+        self.order[type].append(id)
+        if self.manifest is not None and self.manifest.is_done(id):
+            print("\033[95mAnswer found in the progress manifest\033[0m")
+            self.known[type][id] = self.manifest.get(id)
+            return True
+        if self.cache is not None:
+            key = self.cache.answer_key(question, type, pmids)
+            entry = self.cache.get(key)
+            if entry is not None:
+                print("\033[95mAnswer found in the answer cache\033[0m")
+                self.known[type][id] = entry
+                return True
+            self.keys[type][id] = key
+        if details is not None:
+            self.details[type][id] = details
+        return False
+
+    def record(self, type, result):
+        for id, entry in read_reader_answers(result).items():
+            if self.manifest is not None:
+                self.manifest.mark_done(id, dict(self.details[type].get(id, {}), **entry))
+            if id in self.keys[type]:
+                self.cache.put(self.keys[type][id], entry)
+
+    def merge(self, type, output_dir):
+        if not self.order[type]:
+            return
+        answers = group_passages(_load_json_if_exists(output_dir + "predictions.json"),
+                                 _load_json_if_exists(output_dir + "nbest_predictions.json"))
+        predictions = collections.OrderedDict()
+        nbest = collections.OrderedDict()
+        for id in self.order[type]:
+            entry = self.known[type].get(id) or answers.get(id)
+            if entry is None:
+                continue
+            for n, prediction in entry['predictions'].items():
+                predictions[passage_id(id, n)] = prediction
+            for n, candidates in entry['nbest'].items():
+                nbest[passage_id(id, n)] = candidates
+        with open(output_dir + "predictions.json", "w") as outfile:
+            json.dump(predictions, outfile, indent=4)
+        if nbest:
+            with open(output_dir + "nbest_predictions.json", "w") as outfile:
+                json.dump(nbest, outfile, indent=4)
+
+def _load_json_if_exists(file):
+    if not os.path.isfile(file):
+        return collections.OrderedDict()
+    with open(file, "r") as j:
+        return json.load(j, object_pairs_hook=collections.OrderedDict)
+
+# Split the paragraphs of a reader input file into chunk files of chunk_size questions under <type_dir>chunks/
+# and return their paths. With no chunk_size the input file is read as a whole, as before.
+def write_reader_chunks(type_dir, predict_file, paragraphs, chunk_size=None):
+    if not paragraphs:
+        return []
+    if not chunk_size:
+        return [predict_file]
+    chunks_dir = f"{type_dir}chunks{os.path.sep}"
+    shutil.rmtree(chunks_dir, ignore_errors=True)
+    chunk_files = []
+    for n, start in enumerate(range(0, len(paragraphs), chunk_size)):
+        chunk_dir = f"{chunks_dir}{n:05d}{os.path.sep}"
+        os.makedirs(chunk_dir, exist_ok=True)
+        print_json_to_file(chunk_dir + "qa_input.json", {'data': paragraphs[start:start + chunk_size]})
+        chunk_files.append(chunk_dir + "qa_input.json")
+    return chunk_files
+
+# The readers run chunk_size questions at a time and every finished chunk is recorded in <output_dir>qa_progress.jsonl,
+# so an interrupted run only reads the questions it had not answered yet when it is started again.
+# Without a reader service every chunk would start the reader scripts again, so each type is read as a single chunk.
+# Every question is read with up to passages of its retrieved abstracts, which are looked up by PMID in indexer since
+# the IR stage file (see interchange.py) only references them, on session's searcher if one is given, or in docstore.
+def run_batch_mode(input_file,output_dir,indexer,reader=None,timeout=None,cache=None,chunk_size=256,passages=PASSAGES_PER_QUESTION,
+                   session=None,docstore=None):
     print(f"\033[95mreading {input_file} for input\033[0m")
-    with open(input_file, "rU") as file:
-        content = file.readlines()
-        content = "".join(content)
-        soup = bs(content,"lxml")
-        result = soup.find_all("q") # get all the questions
-        for item in result:
-            type = item.find("qp").find("type").get_text()
-            id = item.attrs['id']
-            original_question = str(item.find('qp').previousSibling)
-            try:
-                abstract_text = item.find('ir').find('result').find("abstract").get_text()
-            except:
-                # If IR was unsuccessful when it came to retrieving documents for the given question
-                abstract_text = ""
-            data = (id, type, original_question, abstract_text)
-            print(f"\033[95mGetting answer for \'{original_question}\'\033[0m")
-            # write all questions to a general file
-            json_data = get_json_from_data(data)
-            print_json_to_file(output_dir+ "qa_all.json", json_data, batch_mode=True)
-            if abstract_text != "":
-                # get the answers for questions with relevant concepts
-                get_answer(data,output_dir,batch_mode=True)
-    
-    # Now that the intermediary files are generated, pass them into qa scripts. 
     _,_,factoid_path,yesno_path,list_path = setup_file_system(output_dir,True)
 
     factoid_file_path = factoid_path + "qa_factoids.json"
     yesno_file_path = yesno_path + "qa_yesno.json"
     list_file_path = list_path + "qa_list.json"
-    
-    list_nbest = list_path+"nbest_predictions.json"
-    factoid_nbest = factoid_path+"nbest_predictions.json"
-    # We use predictions instead of nbest since yesno only has 2 options
-    yesno_preds = yesno_path+"predictions.json" 
-    # Run the biobert question answering code on our extracted question dataframes
-    run_qa_file('run_yesno.py',yesno_path, predict_file= yesno_file_path)
-    run_qa_file('run_factoid.py',factoid_path, predict_file= factoid_file_path)
-    run_qa_file('run_list.py',list_path, predict_file= list_file_path)
-    
-    # Run the nbest predictions through a file type transformer, then into BioASQ evaluation repo
-    while not os.path.exists(list_nbest):
-        time.sleep(1)
-    if os.path.isfile(list_nbest):
-        print("\033[95mMigrating jsons to correct bioasq format!!\033[0m")
-        file_paths = (factoid_nbest, list_nbest, yesno_preds)
-        transform_to_bioasq(file_paths)
+    # every question is buffered here and each input file is written once after the loop
+    writer = QAInputWriter(files=(output_dir + "qa_all.json", factoid_file_path, yesno_file_path, list_file_path))
+    manifest = ProgressManifest(output_dir + "qa_progress.jsonl")
+    answers = BatchAnswers(cache=cache, manifest=manifest)
+    # only batch mode reads abstracts back from the index, so live mode never pays for importing whoosh here
+    from information_retrieval import fetch_articles
+    for record in interchange.read_records(input_file):
+        type = record['type']
+        id = record['id']
+        original_question = record['question']
+        articles = fetch_articles(indexer, interchange.result_pmids(record), session=session, docstore=docstore)
+        # If IR was unsuccessful when it came to retrieving documents for the given question there are no abstracts
+        pmids = [pmid for pmid in interchange.result_pmids(record)
+                 if pmid in articles and articles[pmid].abstract_text][:passages]
+        abstracts = [articles[pmid].abstract_text for pmid in pmids]
+        data = (id, type, original_question, abstracts)
+        print(f"\033[95mGetting answer for \'{original_question}\'\033[0m")
+        # write all questions to a general file
+        json_data = get_json_from_data(data)
+        writer.append(output_dir + "qa_all.json", json_data)
+        if abstracts:
+            if type in ('yesno', 'factoid', 'list'):
+                if answers.lookup(id, type, original_question, pmids):
+                    continue
+            # get the answers for questions with relevant concepts
+            get_answer(data,output_dir,batch_mode=True,writer=writer)
+    writer.flush()
 
+    # Now that the intermediary files are generated, pass them into qa scripts. 
+    # We use predictions instead of nbest for yesno since yesno only has 2 options
+    if reader is None:
+        chunk_size = None
+    jobs = {}
+    for type, type_path, type_file, transform_file in (('yesno', yesno_path, yesno_file_path, "predictions.json"),
+                                                      ('factoid', factoid_path, factoid_file_path, "nbest_predictions.json"),
+                                                      ('list', list_path, list_file_path, "nbest_predictions.json")):
+        chunk_files = write_reader_chunks(type_path, type_file, writer.paragraphs[type_file], chunk_size)
+        jobs[type] = (type_path, chunk_files, type_path + transform_file)
+    run_readers_concurrently(jobs, reader=reader, timeout=timeout, on_chunk=answers.record, on_predictions=answers.merge)
+    manifest.complete()
+    if cache is not None:
+        cache.print_stats("Answer cache")
 
+# Run the yesno, factoid and list readers side by side, each followed by its BioASQ format transform,
+# and return once all of them are done. jobs maps type -> (output_dir, predict_files, file to transform).
+# Each predict file is read in turn, its predictions written next to it, and the results merged into output_dir.
+# on_chunk(type, result), if given, runs after every predict file, and on_predictions(type, output_dir)
+# between the merge and the transform.
+def run_readers_concurrently(jobs, reader=None, timeout=None, on_chunk=None, on_predictions=None):
+    # only used by the subprocess fallback, the reader service splits its threads when it starts
+    threads, _ = reader_service.split_threads(len(jobs))
 
+    def read_and_transform(type):
+        output_dir, predict_files, transform_file = jobs[type]
+        results = []
+        for predict_file in predict_files:
+            # run_reader raises ReaderError if a reader crashes or times out, instead of leaving us waiting for its output
+            result = run_reader(type, os.path.dirname(predict_file) + os.path.sep, predict_file=predict_file,
+                                reader=reader, timeout=timeout, threads=threads)
+            results.append(result)
+            if on_chunk is not None:
+                on_chunk(type, result)
+        merge_reader_results(results, output_dir)
+        if on_predictions is not None:
+            on_predictions(type, output_dir)
+        print(f"\033[95mMigrating {type} json to correct bioasq format!!\033[0m")
+        transform_head_to_bioasq(type, transform_file)
 
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {type: pool.submit(read_and_transform, type) for type in jobs}
+    # the pool has waited for every job, so a failure in one reader does not cut the others short
+    for type, future in futures.items():
+        future.result()
@@ -3,7 +3,7 @@ Based on code from https://github.com/masonnlp/bioasq_question_processing
 question_understanding.py :
     The Question Understanding (QU) module for the QA pipeline which takes in a query in the form
         [ID, Question]    Example -->  [51406e6223fec90375000009,Does metformin interfere thyroxine absorption?]
-    and outputs an xml file containing the original question as well as relevant snippets, features, and a predicted query
+    and outputs a stage file (see interchange.py) containing the original question as well as relevant snippets, features, and a predicted query
     for use in the Information Retrieval portion of the pipeline.
 """
 
@@ -11,119 +11,189 @@ question_understanding.py :
 import warnings
 #warnings.filterwarnings('ignore')
 
-import json
-import pandas as pd
-import numpy as np
+# The tokenizer, classifier and spaCy model are passed in, so only torch is needed here.
+# startup.py imports the heavy libraries that load them.
 import os
 import torch
-import torch.nn.functional as F
-from transformers import BertTokenizer,BertForSequenceClassification,AdamW,BertConfig,get_linear_schedule_with_warmup
 from lxml import etree as ET
-import spacy
-import scispacy
-import en_core_sci_lg
-from bs4 import BeautifulSoup as bs
 
-#map the original question to tokens utilizing a tokenizer
+import interchange
+from manifest import ProgressManifest
+
+# torch.inference_mode only exists from torch 1.9 on; older versions get no_grad, which is what it improves on
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# Get the question type classifier ready for inference on device. threads caps the cores torch uses on the CPU, and
+# quantize (CPU only) replaces its Linear layers with dynamically quantized int8 ones, which is much faster on
+# CPU-only hosts for a small loss of accuracy (python benchmark.py classifier compares the two).
+def prepare_classifier(model, device, threads=None, quantize=False):
+    if threads:
+        torch.set_num_threads(threads)
+    model.eval()
+    if quantize and device.type == 'cpu':
+        print("\033[95mQuantizing the question type classifier to int8...\033[0m")
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.to(device)
+
+ONNX_CLASSIFIER_FILE = f"data_modules{os.path.sep}model{os.path.sep}classifier.onnx"
+ONNX_INPUT_NAMES = ['input_ids', 'attention_mask']
+
+# The question type classifier exported by export_onnx.py, run with ONNX Runtime.
+# It is called like BertForSequenceClassification, so predict() works with either.
+class OnnxClassifier:
+    def __init__(self, onnx_file=ONNX_CLASSIFIER_FILE, threads=None):
+        # onnxruntime is only needed when this backend is selected
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = [provider for provider in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+                     if provider in onnxruntime.get_available_providers()]
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=providers)
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, token_type_ids=None, attention_mask=None):
+        logits = self.session.run(['logits'], {'input_ids': input_ids.cpu().numpy(),
+                                               'attention_mask': attention_mask.cpu().numpy()})[0]
+        return (torch.from_numpy(logits),)
+
+#map the original question to tokens utilizing a tokenizer.
+# Every question is tokenized once, in a single call, which the fast (Rust) tokenizer runs as one batch.
 def preprocess(df, tokenizer):
-    df.encoded_tokens = [tokenizer.encode_plus(text,add_special_tokens=True)['input_ids'] for text in df['Question']] 
-    df.attention_mask = [tokenizer.encode_plus(text,add_special_tokens=True)['attention_mask'] for text in df['Question']]
-    encoded_tokens = list(df.encoded_tokens)
-    attention_mask = list(df.attention_mask)
+    encoded = tokenizer(list(df['Question']), add_special_tokens=True)
+    encoded_tokens = encoded['input_ids']
+    attention_mask = encoded['attention_mask']
     
     return encoded_tokens,attention_mask
 
-# Convert indices to Torch tensor and dump into cuda
-def feed_generator(device, encoded_tokens,attention_mask):
-    batch_size = 16
-    batch_seq = [x for x in range(int(len(encoded_tokens)/batch_size))]
-    shuffled_encoded_tokens,shuffled_attention_mask = encoded_tokens,attention_mask
-    res = len(encoded_tokens)%batch_size
-    if res != 0:
-        batch_seq = [x for x in range(int(len(encoded_tokens)/batch_size)+1)]
-    shuffled_encoded_tokens = shuffled_encoded_tokens+shuffled_encoded_tokens[:res]
-    shuffled_attention_mask = shuffled_attention_mask+shuffled_attention_mask[:res]
-
-    for batch in batch_seq:
-        maxlen_sent = max([len(i) for i in shuffled_encoded_tokens[batch*batch_size:(batch+1)*batch_size]])
-        token_tensor = torch.tensor([tokens+[0]*(maxlen_sent-len(tokens)) for tokens in shuffled_encoded_tokens[batch*batch_size:(batch+1)*batch_size]])
-        attention_mask = torch.tensor([tokens+[0]*(maxlen_sent-len(tokens)) for tokens in shuffled_attention_mask[batch*batch_size:(batch+1)*batch_size]])        
-        token_tensor = token_tensor.to('cpu')
-        attention_mask = attention_mask.to('cpu')
-        yield token_tensor,attention_mask
-
-# Returns a prediction ( query, snippets, features)
+# Convert indices to Torch tensor and move them to the device the classifier is on.
+# The questions are sorted by length so each batch is padded only to the longest question in it. Every batch comes
+# with the positions of its questions in the input, and the last batch is simply shorter.
+def feed_generator(device, encoded_tokens,attention_mask, batch_size=16):
+    order = sorted(range(len(encoded_tokens)), key=lambda i: len(encoded_tokens[i]))
+    for start in range(0, len(order), batch_size):
+        positions = order[start:start + batch_size]
+        maxlen_sent = len(encoded_tokens[positions[-1]])
+        token_tensor = torch.zeros((len(positions), maxlen_sent), dtype=torch.long)
+        attention_tensor = torch.zeros((len(positions), maxlen_sent), dtype=torch.long)
+        for row, position in enumerate(positions):
+            length = len(encoded_tokens[position])
+            token_tensor[row, :length] = torch.tensor(encoded_tokens[position])
+            attention_tensor[row, :length] = torch.tensor(attention_mask[position])
+        token_tensor = token_tensor.to(device)
+        attention_tensor = attention_tensor.to(device)
+        yield positions,token_tensor,attention_tensor
+
+# Returns a prediction ( query, snippets, features), in the order of the input questions.
+# The model is expected to be on device already (see prepare_classifier).
 def predict(device, model,data):
     model.eval()
-    if device =="cuda:0":
-        model.cuda()
-    preds = []
-    batch_count = 0
-    for token_tensor, attention_mask in data:
-        print(token_tensor.device, attention_mask.device)
-        with torch.no_grad():
+    preds = {}
+    with _inference_mode():
+        for positions, token_tensor, attention_mask in data:
             logits = model(token_tensor,token_type_ids=None,attention_mask=attention_mask)[0]
-            tmp_preds = torch.argmax(logits,-1).detach().cpu().numpy().tolist()
-        preds += tmp_preds             
-    return preds
+            preds.update(zip(positions, torch.argmax(logits,-1).tolist()))
+    return [preds[position] for position in sorted(preds)]
 
-# If we are in batch mode, append all generated queries and concepts to xml file,
-# Otherwise pass QU data (question type, concepts, query) back for transfer to IR module
-def ask_and_receive(testing_df, device, tokenizer, model, nlp , batch_mode = False, output_file=None):
-    encoded_tokens_Test,attention_mask_Test = preprocess(testing_df,tokenizer)
+# Predict the question type label ('factoid', 'list', 'summary' or 'yesno') for every question in the dataframe.
+# With a question_type_cascade.CascadeClassifier, BERT only sees the questions the cascade is not confident about.
+def predict_types(testing_df, device, tokenizer, model, cascade=None):
+    labels = [None] * len(testing_df)
+    if cascade is not None:
+        labels = cascade.predict(list(testing_df['Question']))
+    pending = [i for i, label in enumerate(labels) if label is None]
+    if not pending:
+        return labels
+    encoded_tokens_Test,attention_mask_Test = preprocess(testing_df.iloc[pending],tokenizer)
     data_test = feed_generator(device, encoded_tokens_Test, attention_mask_Test)
     preds_test = predict(device,model,data_test)
     indices_to_label = {0: 'factoid', 1: 'list', 2: 'summary', 3: 'yesno'}
-    predict_label = []
-    for i in preds_test[0:len(testing_df['Question'])]:
-        for j in indices_to_label:
-            if i == j:
-                predict_label.append(indices_to_label[j])
-    testing_df['type'] = predict_label
+    for i, pred in zip(pending, preds_test):
+        labels[i] = indices_to_label[pred]
+    return labels
+
+# If we are in batch mode, append all generated queries and concepts to xml file,
+# Otherwise pass QU data (question type, concepts, query) back for transfer to IR module
+# spacy_batch_size and spacy_processes are passed to nlp.pipe in batch mode, cascade to predict_types
+def ask_and_receive(testing_df, device, tokenizer, model, nlp , batch_mode = False, output_file=None,
+                    spacy_batch_size=256, spacy_processes=1, cascade=None):
     if(batch_mode):
-        print("\033[95mWriting QU results to xml file...\033[0m")
-        xml_tree(testing_df,nlp,output_file)
+        batch_understand(testing_df, device, tokenizer, model, nlp, output_file,
+                         spacy_batch_size=spacy_batch_size, spacy_processes=spacy_processes, cascade=cascade)
     else:
+        testing_df['type'] = predict_types(testing_df, device, tokenizer, model, cascade=cascade)
         return send_qu_data(testing_df,nlp)
 
+# Classify and extract entities for the questions checkpoint_size at a time, recording every finished question in a
+# progress manifest next to output_file. An interrupted run skips the questions the manifest already holds.
+def batch_understand(testing_df, device, tokenizer, model, nlp, output_file, checkpoint_size=256,
+                     spacy_batch_size=256, spacy_processes=1, cascade=None):
+    manifest = ProgressManifest(output_file + ".qu_progress.jsonl")
+    todo = testing_df[[not manifest.is_done(id) for id in testing_df['ID']]]
+    for start in range(0, len(todo), checkpoint_size):
+        chunk = todo.iloc[start:start + checkpoint_size].copy()
+        chunk['type'] = predict_types(chunk, device, tokenizer, model, cascade=cascade)
+        for id, question, qtype, entities, query in qu_records(chunk, nlp, spacy_batch_size, spacy_processes):
+            print(f"\033[95mdoc: {entities}\033[0m")
+            manifest.mark_done(id, {'question': question, 'type': qtype, 'entities': entities})
+    print("\033[95mWriting QU results...\033[0m")
+    write_qu_file(testing_df, manifest, output_file)
+    manifest.complete()
+
+# Only doc.ents is used, so every pipeline component except the entity recognizer and the components it listens to
+# (a shared tok2vec) is switched off. Returns the names of the disabled components.
+def trim_pipeline(nlp):
+    keep = {'ner'}
+    for name, component in nlp.pipeline:
+        if 'ner' in getattr(component, 'listening_components', ()):
+            keep.add(name)
+    disabled = [name for name in nlp.pipe_names if name not in keep]
+    if disabled:
+        nlp.select_pipes(disable=disabled)
+        print(f"\033[95mDisabled spaCy components not needed for entities: {', '.join(disabled)}\033[0m")
+    return disabled
+
+# Yield the QU data (id, question, type, entities, query) for every row of a dataframe that already has its 'type' column.
+# The questions go through spaCy together with nlp.pipe, batch_size at a time and split over n_process worker
+# processes, rather than one nlp() call each. More than one process only pays off on large batches on the CPU.
+def qu_records(df, nlp, batch_size=256, n_process=1):
+    docs = nlp.pipe(df['Question'], batch_size=batch_size, n_process=n_process)
+    for ind, doc in zip(df.index, docs):
+        question = df['Question'][ind]
+        entities = [ent.text for ent in doc.ents]
+        query = str(' '.join(entities))
+        yield (df['ID'][ind], question, df['type'][ind], entities, query)
+
 #instead of using the xml, just pass the data
 def send_qu_data(df,nlp):
     ind = df.first_valid_index()
-    id = df['ID'][ind]
-    question = df['Question'][ind]
-    type = df['type'][ind]
-    doc = nlp(question)
-    entities = []
-    for ent in doc.ents:
-        entities.append(str(ent))
-    query = str(' '.join(entities))
-    return (id, question, type, entities, query)
-
-# Print the extracted information from BioBERT to an xml file we will append to later.
-def xml_tree(df,nlp,output_file):
-    root = ET.Element("Input")
-    for ind in df.index:
-        id = df['ID'][ind]
-        question = df['Question'][ind]
-        qtype = df['type'][ind]
-        q = ET.SubElement(root,"Q")
-        q.set('id',str(id))
-        q.text = question
-        qp = ET.SubElement(q,"QP")
-        qp_type = ET.SubElement(qp,'Type')
-        qp_type.text = qtype
-        doc = nlp(question)
-        print(f"\033[95mdoc: {doc.ents}\033[0m")
-        ent_list = []
-        for ent in doc.ents:
-            ent_list.append(str(ent))
-            qp_en = ET.SubElement(qp,'Entities') 
-            qp_en.text = str(ent)
-        qp_query = ET.SubElement(qp,'Query')
-        qp_query.text = str(' '.join(ent_list))
-        # Create IR tag
-        IR = ET.SubElement(q, "IR")
-    tree = ET.ElementTree(root)
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    tree.write(output_file, pretty_print=True)
-    print(f"writing XML to {output_file}")
+    return next(qu_records(df.loc[[ind]], nlp))
+
+# Add the <Q> element for one question, with its QP tags and an empty IR tag, to the root of the QU xml
+def qu_element(root, id, question, qtype, entities):
+    q = ET.SubElement(root,"Q")
+    q.set('id',str(id))
+    q.text = question
+    qp = ET.SubElement(q,"QP")
+    qp_type = ET.SubElement(qp,'Type')
+    qp_type.text = qtype
+    for ent in entities:
+        qp_en = ET.SubElement(qp,'Entities') 
+        qp_en.text = ent
+    qp_query = ET.SubElement(qp,'Query')
+    qp_query.text = str(' '.join(entities))
+    # Create IR tag
+    ET.SubElement(q, "IR")
+    return q
+
+# Write the extracted information from BioBERT to the QU stage file (see interchange.py) that IR reads.
+# The questions are written in the order of the dataframe from what the manifest recorded for them.
+def write_qu_file(df,manifest,output_file):
+    with interchange.StageWriter(output_file) as writer:
+        for id in df['ID']:
+            done = manifest.get(id)
+            writer.write(interchange.qu_record(id, done['question'], done['type'], done['entities']))
+    print(f"writing QU results to {output_file}")
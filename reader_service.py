@@ -0,0 +1,262 @@
+"""
+reader_service.py keeps the BioBERT yesno, factoid and list readers loaded for the lifetime of the QA system.
+    run_yesno.py, run_factoid.py and run_list.py all register the same tf.flags when they are imported, so each
+    reader head lives in its own worker process. The worker imports its script once, builds the TPUEstimator once
+    and feeds every request through one long-running estimator.predict() generator, which means the graph is built
+    and the checkpoint is restored a single time at startup instead of once per question.
+
+The prediction files written by the service are the same predictions.json / nbest_predictions.json files that the
+run_*.py scripts write, so everything downstream (transform_to_bioasq, the live answer printing) is unchanged.
+"""
+import collections
+import concurrent.futures
+import importlib
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+READER_HEADS = ('yesno', 'factoid', 'list')
+READER_SCRIPTS = {'yesno': 'run_yesno', 'factoid': 'run_factoid', 'list': 'run_list'}
+FEATURE_NAMES = ('unique_ids', 'input_ids', 'input_mask', 'segment_ids')
+# Large enough that the passages of a live question (question_answering.PASSAGES_PER_QUESTION abstracts, a few of
+# them split in two by doc_stride) go through the reader in a single forward pass
+PREDICT_BATCH_SIZE = 16
+
+# The command line flags shared by every reader head, in the --flag=value form the run_*.py scripts expect
+def reader_flags(output_dir, predict_file=None, init_checkpoint=None):
+    vocab_file_path = f'data_modules{os.path.sep}model{os.path.sep}vocab.txt'
+    bert_config_file = f'data_modules{os.path.sep}model{os.path.sep}config.json'
+    flags = ['--do_train=False', '--do_predict=True', f'--vocab_file={vocab_file_path}',
+             f'--bert_config_file={bert_config_file}', f'--output_dir={output_dir}',
+             f'--predict_batch_size={PREDICT_BATCH_SIZE}']
+    if predict_file:
+        flags.append(f'--predict_file={predict_file}')
+    if init_checkpoint:
+        flags.append(f'--init_checkpoint={init_checkpoint}')
+    return flags
+
+# Split the cores of this machine between the reader heads that run side by side.
+# Returns (intra_op_threads, inter_op_threads) for each head.
+def split_threads(num_heads, cpu_count=None):
+    cpu_count = cpu_count or os.cpu_count() or 1
+    intra_op_threads = max(1, cpu_count // max(1, num_heads))
+    # BERT inference is a chain of large matmuls, so a couple of inter-op threads is all it can use
+    inter_op_threads = 2 if intra_op_threads >= 4 else 1
+    return intra_op_threads, inter_op_threads
+
+# Turn a list of InputFeatures into one batch of numpy arrays in the layout of input_fn_builder
+def _feature_batch(features):
+    return {
+        'unique_ids': np.array([f.unique_id for f in features], dtype=np.int32),
+        'input_ids': np.array([f.input_ids for f in features], dtype=np.int32),
+        'input_mask': np.array([f.input_mask for f in features], dtype=np.int32),
+        'segment_ids': np.array([f.segment_ids for f in features], dtype=np.int32),
+    }
+
+# Entry point of a reader worker process. Everything TensorFlow related is imported here so the parent never pays for it.
+def _serve_head(head, model_dir, init_checkpoint, threads, requests, responses):
+    intra_op_threads, inter_op_threads = threads
+    # MKL/OpenMP builds of TensorFlow size their own pools from these before the import
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    os.environ['MKL_NUM_THREADS'] = str(intra_op_threads)
+    script = importlib.import_module(READER_SCRIPTS[head])
+    tf = script.tf
+    FLAGS = script.FLAGS
+    FLAGS(['reader_service'] + reader_flags(model_dir, init_checkpoint=init_checkpoint))
+
+    bert_config = script.modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+    tokenizer = script.tokenization.FullTokenizer(vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                    inter_op_parallelism_threads=inter_op_threads)
+    run_config = tf.contrib.tpu.RunConfig(
+        model_dir=FLAGS.output_dir,
+        session_config=session_config,
+        tpu_config=tf.contrib.tpu.TPUConfig(num_shards=FLAGS.num_tpu_cores))
+    model_fn = script.model_fn_builder(
+        bert_config=bert_config,
+        init_checkpoint=FLAGS.init_checkpoint,
+        learning_rate=FLAGS.learning_rate,
+        num_train_steps=None,
+        num_warmup_steps=None,
+        use_tpu=False,
+        use_one_hot_embeddings=False)
+    estimator = tf.contrib.tpu.TPUEstimator(
+        use_tpu=False,
+        model_fn=model_fn,
+        config=run_config,
+        train_batch_size=FLAGS.train_batch_size,
+        predict_batch_size=FLAGS.predict_batch_size)
+
+    # estimator.predict() only builds the graph and restores the checkpoint once per generator,
+    # so we keep a single generator alive and hand it feature batches through a queue.
+    pending = queue.Queue()
+    def feature_batches():
+        while True:
+            batch = pending.get()
+            if batch is None:
+                return
+            yield batch
+
+    def input_fn(params):
+        seq_length = FLAGS.max_seq_length
+        return tf.data.Dataset.from_generator(
+            feature_batches,
+            output_types={name: tf.int32 for name in FEATURE_NAMES},
+            output_shapes={'unique_ids': [None], 'input_ids': [None, seq_length],
+                           'input_mask': [None, seq_length], 'segment_ids': [None, seq_length]})
+
+    predictions = estimator.predict(input_fn, yield_single_examples=False)
+    result_fields = script.RawResult._fields[1:]
+
+    def run_features(features):
+        results = []
+        for start in range(0, len(features), FLAGS.predict_batch_size):
+            pending.put(_feature_batch(features[start:start + FLAGS.predict_batch_size]))
+            output = next(predictions)
+            for i, unique_id in enumerate(output['unique_ids']):
+                values = {field: [float(x) for x in output[field][i].flat] for field in result_fields}
+                results.append(script.RawResult(unique_id=int(unique_id), **values))
+        return results
+
+    try:
+        # Warm up: build the graph and restore the checkpoint before the first real question arrives
+        warm_up = {name: np.zeros([1, FLAGS.max_seq_length], dtype=np.int32) for name in FEATURE_NAMES}
+        warm_up['unique_ids'] = np.zeros([1], dtype=np.int32)
+        pending.put(warm_up)
+        next(predictions)
+        responses.put((True, head))
+    except Exception:
+        responses.put((False, traceback.format_exc()))
+        return
+
+    while True:
+        request = requests.get()
+        if request is None:
+            pending.put(None)
+            return
+        predict_file, output_dir = request
+        try:
+            examples = script.read_squad_examples(input_file=predict_file, is_training=False)
+            features = []
+            script.convert_examples_to_features(
+                examples=examples,
+                tokenizer=tokenizer,
+                max_seq_length=FLAGS.max_seq_length,
+                doc_stride=FLAGS.doc_stride,
+                max_query_length=FLAGS.max_query_length,
+                is_training=False,
+                output_fn=features.append)
+            results = run_features(features)
+            tf.gfile.MakeDirs(output_dir)
+            script.write_predictions(examples, features, results,
+                                     FLAGS.n_best_size, FLAGS.max_answer_length,
+                                     FLAGS.do_lower_case, os.path.join(output_dir, 'predictions.json'),
+                                     os.path.join(output_dir, 'nbest_predictions.json'),
+                                     os.path.join(output_dir, 'null_odds.json'))
+            responses.put((True, output_dir))
+        except Exception:
+            responses.put((False, traceback.format_exc()))
+
+
+# Raised when a reader fails to start, crashes, returns an error or does not answer in time
+class ReaderError(RuntimeError):
+    pass
+
+# Wait for the next message from a worker, noticing if the worker process has died in the meantime
+def _next_response(head, process, responses, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            return responses.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise ReaderError(f"The {head} reader exited with code {process.exitcode}")
+            if deadline is not None and time.monotonic() > deadline:
+                raise ReaderError(f"The {head} reader did not respond within {timeout} seconds")
+
+# What a finished reader request hands back: the files written by write_predictions()
+ReaderResult = collections.namedtuple('ReaderResult', ['head', 'predictions_file', 'nbest_predictions_file'])
+
+
+class ReaderService:
+    # model_dir is where each head's checkpoint lives, exactly like --output_dir for the run_*.py scripts.
+    # The heads run concurrently, so by default the machine's cores are split evenly between them.
+    def __init__(self, model_dir, heads=READER_HEADS, init_checkpoints=None, startup_timeout=600, threads=None):
+        # TensorFlow is not fork safe, so workers are always spawned
+        context = mp.get_context('spawn')
+        init_checkpoints = init_checkpoints or {}
+        threads = threads or split_threads(len(heads))
+        self.workers = {}
+        for head in heads:
+            requests, responses = context.Queue(), context.Queue()
+            process = context.Process(target=_serve_head, daemon=True,
+                                      args=(head, model_dir + head + os.path.sep, init_checkpoints.get(head), threads, requests, responses))
+            process.start()
+            # futures are resolved in the order their requests were sent, since each worker answers in FIFO order
+            self.workers[head] = (process, requests, responses, threading.Lock(), collections.deque())
+        for head in heads:
+            print(f"\033[95mLoading {head} reader...\033[0m")
+            try:
+                process, _, responses, _, _ = self.workers[head]
+                ok, message = _next_response(head, process, responses, timeout=startup_timeout)
+            except ReaderError:
+                self.close()
+                raise
+            if not ok:
+                self.close()
+                raise ReaderError(f"The {head} reader failed to start:\n{message}")
+        for head in heads:
+            threading.Thread(target=self._collect, args=(head,), daemon=True).start()
+
+    def has_head(self, head):
+        return head in self.workers
+
+    # Background thread that hands every worker response to the future waiting on it
+    def _collect(self, head):
+        process, _, responses, lock, pending = self.workers[head]
+        while True:
+            try:
+                ok, message = _next_response(head, process, responses)
+            except ReaderError as e:
+                with lock:
+                    while pending:
+                        pending.popleft()[0].set_exception(e)
+                return
+            with lock:
+                future, predict_file = pending.popleft()
+            if ok:
+                future.set_result(ReaderResult(head, os.path.join(message, 'predictions.json'),
+                                               os.path.join(message, 'nbest_predictions.json')))
+            else:
+                future.set_exception(ReaderError(f"The {head} reader failed on {predict_file}:\n{message}"))
+
+    # Queue the reader for <head> over a BioASQ formatted json file. The returned future resolves to a ReaderResult
+    # once predictions.json/nbest_predictions.json have been written to output_dir, or raises ReaderError.
+    def submit(self, head, predict_file, output_dir):
+        process, requests, _, lock, pending = self.workers[head]
+        future = concurrent.futures.Future()
+        with lock:
+            if not process.is_alive():
+                raise ReaderError(f"The {head} reader exited with code {process.exitcode}")
+            pending.append((future, predict_file))
+            requests.put((predict_file, output_dir))
+        return future
+
+    def predict(self, head, predict_file, output_dir, timeout=None):
+        try:
+            return self.submit(head, predict_file, output_dir).result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            raise ReaderError(f"The {head} reader did not finish {predict_file} within {timeout} seconds")
+
+    def close(self):
+        for process, requests, _, _, _ in self.workers.values():
+            if process.is_alive():
+                requests.put(None)
+        for process, _, _, _, _ in self.workers.values():
+            process.join(timeout=5)
+        self.workers = {}
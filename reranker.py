@@ -0,0 +1,208 @@
+"""
+reranker.py reranks the articles a search found by late interaction (MaxSim, as in ColBERT), so the BioBERT
+readers only read the few abstracts that match the question best, without running a cross-encoder over every
+candidate. information_retrieval.search retrieves the depth best articles, reranks them here by PMID before any of
+them is read, and returns the best max_results (set rerank_depth in qa_system.py).
+
+    The token embeddings of every abstract are computed offline, projected down to a few dimensions (a PCA of the
+    token embeddings of the first chunk) and stored as float16, so at query time only the question is encoded. The
+    score of an article is the sum, over the tokens of the question, of the best cosine similarity with any of its
+    tokens; all the candidates are scored with one matrix product.
+
+    A token store is a directory of:
+        tokens.f16        the token embeddings of every article, one article after the other
+        entries.bin       (pmid, offset, length) of every article, in the order they were embedded
+        docs.idx.npy      the same, sorted by PMID, written once the embedding is done
+        projection.npy    the projection from the encoder's dimensions to the stored ones
+        progress.json     how far the embedding got, so an interrupted run goes on from there
+        meta.json         the encoder, the dimensions and the number of articles and tokens
+    Articles the store does not have keep their place after the reranked ones.
+
+    python reranker.py [--index data_modules/index/full_index] [--docstore ...] [--output data_modules/tokens/full_index]
+builds the store.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+import dense_retrieval
+from docstore import INDEX_DTYPE
+
+TOKENS_FOLDER = f"data_modules{os.path.sep}tokens"
+
+# The projection onto the dim directions that keep the most of the token embeddings (their top right singular vectors)
+def fit_projection(tokens, dim):
+    if dim is None or dim >= tokens.shape[1]:
+        return np.eye(tokens.shape[1], dtype=np.float32)
+    _, _, vt = np.linalg.svd(tokens, full_matrices=False)
+    return vt[:dim].T.astype(np.float32)
+
+def project(tokens, projection):
+    return dense_retrieval.normalize(tokens @ projection)
+
+# Embed the tokens of documents (dicts of stored fields) into the token store at path, chunk_size documents at a
+# time, keeping the first embedder.max_length tokens of each in dim dimensions. Running it again after an
+# interruption goes on from the last complete chunk. finish() has to be called once every document is embedded.
+def embed_tokens(documents, path, embedder, dim=128, chunk_size=1024):
+    os.makedirs(path, exist_ok=True)
+    tokens_path, entries_path = os.path.join(path, "tokens.f16"), os.path.join(path, "entries.bin")
+    progress_path, projection_path = os.path.join(path, "progress.json"), os.path.join(path, "projection.npy")
+    progress = {'read': 0, 'docs': 0, 'tokens': 0, 'model': embedder.model_name, 'max_tokens': embedder.max_length}
+    projection = None
+    if os.path.isfile(progress_path):
+        with open(progress_path, "r") as progress_file:
+            progress = json.load(progress_file)
+        if progress['model'] != embedder.model_name:
+            raise ValueError(f"{path} was embedded with {progress['model']}, not {embedder.model_name}")
+        projection = np.load(projection_path)
+        print(f"\033[95mGoing on from document {progress['read']}\033[0m")
+    if projection is not None:
+        dim = projection.shape[1]
+    # drop anything written after the last complete chunk
+    for file_path, size in ((tokens_path, progress['tokens'] * (dim or embedder.dim) * 2),
+                            (entries_path, progress['docs'] * INDEX_DTYPE.itemsize)):
+        with open(file_path, "ab") as file:
+            file.truncate(size)
+    started = time.perf_counter()
+    documents = itertools.islice(documents, progress['read'], None)
+    with open(tokens_path, "ab") as tokens_file, open(entries_path, "ab") as entries_file:
+        while True:
+            chunk = list(itertools.islice(documents, chunk_size))
+            if not chunk:
+                break
+            texts = [(int(fields['pmid']), dense_retrieval.document_text(fields)) for fields in chunk]
+            texts = [(pmid, text) for pmid, text in texts if text]
+            if texts:
+                chunk_tokens = embedder.encode_tokens([text for _, text in texts])
+                if projection is None:
+                    projection = fit_projection(np.concatenate(chunk_tokens), dim)
+                    np.save(projection_path, projection)
+                entries = np.zeros(len(texts), dtype=INDEX_DTYPE)
+                offset = progress['tokens']
+                for n, ((pmid, _), tokens) in enumerate(zip(texts, chunk_tokens)):
+                    entries[n] = (pmid, offset, len(tokens))
+                    offset += len(tokens)
+                project(np.concatenate(chunk_tokens), projection).astype('<f2').tofile(tokens_file)
+                entries.tofile(entries_file)
+                tokens_file.flush()
+                entries_file.flush()
+                progress['tokens'] = offset
+            progress['read'] += len(chunk)
+            progress['docs'] += len(texts)
+            with open(progress_path + ".partial", "w") as progress_file:
+                json.dump(progress, progress_file)
+            os.replace(progress_path + ".partial", progress_path)
+            print(f"\033[95m{progress['read']} documents read, {progress['docs']} embedded, {progress['tokens']} tokens "
+                  f"({len(chunk) / (time.perf_counter() - started):.0f} documents/s)\033[0m")
+            started = time.perf_counter()
+    return progress
+
+# Write the PMID index and meta.json of a token store once its articles are embedded. An article embedded twice
+# keeps its last version.
+def finish(path):
+    with open(os.path.join(path, "progress.json"), "r") as progress_file:
+        progress = json.load(progress_file)
+    projection = np.load(os.path.join(path, "projection.npy"))
+    entries = np.fromfile(os.path.join(path, "entries.bin"), dtype=INDEX_DTYPE, count=progress['docs'])
+    entries = entries[np.argsort(entries['pmid'], kind='stable')]
+    if len(entries):
+        entries = entries[np.append(entries['pmid'][1:] != entries['pmid'][:-1], True)]
+    with open(os.path.join(path, "docs.idx.npy.partial"), "wb") as index_file:
+        np.save(index_file, entries)
+    os.replace(os.path.join(path, "docs.idx.npy.partial"), os.path.join(path, "docs.idx.npy"))
+    with open(os.path.join(path, "meta.json"), "w") as meta:
+        json.dump({'model': progress['model'], 'max_tokens': progress['max_tokens'], 'dim': projection.shape[1],
+                   'docs': len(entries), 'tokens': progress['tokens']}, meta)
+    print(f"\033[95mWrote the token embeddings of {len(entries)} articles to {path}\033[0m")
+
+
+class TokenStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as meta:
+            meta = json.load(meta)
+        self.model_name = meta['model']
+        self.max_tokens = meta['max_tokens']
+        self.projection = np.load(os.path.join(path, "projection.npy"))
+        self.index = np.load(os.path.join(path, "docs.idx.npy"), mmap_mode='r')
+        self.pmids = self.index['pmid']
+        self.tokens = np.memmap(os.path.join(path, "tokens.f16"), dtype='<f2', mode='r',
+                                shape=(meta['tokens'], meta['dim']))
+
+    def __len__(self):
+        return len(self.pmids)
+
+    # The (offset, length) of the tokens of every PMID, None for those the store does not have
+    def positions(self, pmids):
+        keys = np.array([int(pmid) for pmid in pmids], dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.pmids, keys), max(len(self.pmids) - 1, 0))
+        return [(int(self.index['offset'][position]), int(self.index['length'][position]))
+                if len(self.pmids) and self.pmids[position] == key else None
+                for key, position in zip(keys, found)]
+
+
+class Reranker:
+    def __init__(self, store, embedder, depth=100):
+        self.store = store
+        self.embedder = embedder
+        self.depth = depth
+        # part of the search cache key, so results reranked from another depth are not reused
+        self.name = f"maxsim:{depth}"
+
+    # The MaxSim score of every article against the token embeddings of a question
+    def scores(self, question_tokens, positions):
+        doc_tokens = np.concatenate([self.store.tokens[offset:offset + length] for offset, length in positions])
+        similarities = question_tokens @ doc_tokens.astype(np.float32).T
+        starts = np.cumsum([0] + [length for _, length in positions[:-1]])
+        return np.maximum.reduceat(similarities, starts, axis=1).sum(axis=0)
+
+    # Rerank hits ([[pmid, score], ...]) for a question and return the k best, with their MaxSim scores
+    def rerank(self, question, hits, k):
+        positions = self.store.positions([pmid for pmid, _ in hits])
+        scored = [(hit, position) for hit, position in zip(hits, positions) if position is not None and position[1]]
+        if not scored:
+            return hits[:k]
+        question_tokens = project(self.embedder.encode_tokens([question])[0], self.store.projection)
+        scores = self.scores(question_tokens, [position for _, position in scored])
+        # the stable sort keeps the search order between articles that score the same
+        order = np.argsort(-scores, kind='stable')
+        reranked = [[scored[n][0][0], float(scores[n])] for n in order]
+        unscored = [hit for hit, position in zip(hits, positions) if position is None or not position[1]]
+        return (reranked + unscored)[:k]
+
+    # What a worker process needs to open the same reranker (see open_reranker)
+    def args(self):
+        return self.store.path, self.depth
+
+# The reranker for an index, or None if its token store has not been built
+def open_reranker(path, depth=100, threads=None):
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    store = TokenStore(path)
+    # questions have to be encoded with the encoder the articles were
+    return Reranker(store, dense_retrieval.Embedder(store.model_name, max_length=store.max_tokens, threads=threads),
+                    depth=depth)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Build the token embedding store of the reranker')
+    arg_parser.add_argument('--index', default=f"data_modules{os.path.sep}index{os.path.sep}full_index")
+    arg_parser.add_argument('--index-name', default='pubmed_articles')
+    arg_parser.add_argument('--docstore', default=None, help='read the articles from this document store')
+    arg_parser.add_argument('--output', default=f"{TOKENS_FOLDER}{os.path.sep}full_index")
+    arg_parser.add_argument('--model', default=dense_retrieval.DEFAULT_MODEL)
+    arg_parser.add_argument('--dim', type=int, default=128, help='dimensions kept of every token embedding')
+    arg_parser.add_argument('--max-tokens', type=int, default=256, help='tokens kept of every abstract')
+    arg_parser.add_argument('--chunk-size', type=int, default=1024)
+    arg_parser.add_argument('--batch-size', type=int, default=32)
+    arg_parser.add_argument('--threads', type=int, default=None)
+    args = arg_parser.parse_args()
+    embedder = dense_retrieval.Embedder(args.model, max_length=args.max_tokens, batch_size=args.batch_size,
+                                        threads=args.threads)
+    embed_tokens(dense_retrieval.source_documents(args.index, args.index_name, args.docstore), args.output, embedder,
+                 dim=args.dim, chunk_size=args.chunk_size)
+    finish(args.output)
@@ -0,0 +1,194 @@
+"""
+server.py exposes the QA pipeline as a local HTTP/JSON answering API.
+    POST /answer  {"question": "..."}          -> one answer
+    POST /batch   {"questions": ["...", ...]}  -> a list of answers, in the order of the questions
+
+Requests that arrive within a short window of each other are coalesced by a MicroBatcher and answered together:
+the question type classifier and spaCy see the whole batch at once and every reader head gets a single json file
+holding all of the batch's questions of its type, with the top retrieved abstracts of each question as separate
+passages, so each model does one batched forward pass per window.
+"""
+import itertools
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import question_understanding
+import information_retrieval
+import question_answering
+
+# Collects items submitted from many threads and hands them to handle_batch together. A batch is closed once
+# window seconds have passed since its first item arrived, or when it holds max_batch_size items.
+class MicroBatcher:
+    def __init__(self, handle_batch, window=0.02, max_batch_size=32):
+        self.handle_batch = handle_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # Returns a future that resolves to handle_batch's result for this item
+    def submit(self, item):
+        future = Future()
+        self.requests.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.handle_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+# Turn the reader output for the passages of one question into the answer we send back
+def format_answer(type, entry):
+    answer = question_answering.aggregate_answer(type, entry)
+    if type == 'yesno':
+        return answer[0]
+    if type == 'list':
+        # give more answers for list-style questions
+        return [candidate['text'] for candidate in answer[:3]]
+    return answer
+
+
+class QAServer:
+    def __init__(self, device, tokenizer, model, nlp, indexer, parser, reader, output_dir,
+                 window=0.02, max_batch_size=32, timeout=300, passages=question_answering.PASSAGES_PER_QUESTION,
+                 cascade=None, session=None, search_cache=None, docstore=None, engine=None,
+                 dense=None, reranker=None):
+        self.device = device
+        self.tokenizer = tokenizer
+        self.model = model
+        self.nlp = nlp
+        self.indexer = indexer
+        self.parser = parser
+        self.reader = reader
+        self.output_dir = output_dir
+        self.timeout = timeout
+        self.passages = passages
+        self.cascade = cascade
+        # one searcher for every request, rather than one per query
+        self.session = session if session is not None else information_retrieval.SearcherSession(indexer)
+        self.search_cache = search_cache
+        self.docstore = docstore
+        self.engine = engine
+        self.dense = dense
+        self.reranker = reranker
+        self.batch_ids = itertools.count()
+        self.batcher = MicroBatcher(self.answer_questions, window=window, max_batch_size=max_batch_size)
+
+    def answer(self, question):
+        return self.batcher.submit(question).result()
+
+    def answer_all(self, questions):
+        futures = [self.batcher.submit(question) for question in questions]
+        return [future.result() for future in futures]
+
+    # Run a batch of questions through QU, IR and QA with one forward pass per model
+    def answer_questions(self, questions):
+        batch_id = next(self.batch_ids)
+        ids = [f"{batch_id}_{n}" for n in range(len(questions))]
+        df = pd.DataFrame({'ID': ids, 'Question': questions})
+        df['type'] = question_understanding.predict_types(df, self.device, self.tokenizer, self.model, cascade=self.cascade)
+
+        answers = {}
+        qa_data = {}
+        for id, question, type, concepts, query in question_understanding.qu_records(df, self.nlp):
+            answer = {'question': question, 'type': type, 'concepts': concepts, 'query': query, 'pmids': [], 'answer': None}
+            answers[id] = answer
+            if type == 'summary':
+                answer['error'] = "Summary type questions are currently not supported."
+                continue
+            results = information_retrieval.search(self.indexer, self.parser, query or question, batch_mode=True,
+                                                   session=self.session, cache=self.search_cache,
+                                                   docstore=self.docstore, engine=self.engine,
+                                                   dense=self.dense, question=question, reranker=self.reranker)
+            answer['pmids'] = [result.pmid for result in results]
+            abstracts = [result.abstract_text for result in results if result.abstract_text][:self.passages]
+            if abstracts:
+                qa_data.setdefault(type, []).append((id, type, question, abstracts))
+            else:
+                answer['error'] = "No relevant articles were found."
+
+        batch_dir = f"{self.output_dir}{batch_id}{os.path.sep}"
+        try:
+            futures = {}
+            for type, data in qa_data.items():
+                type_dir = f"{batch_dir}{type}{os.path.sep}"
+                os.makedirs(type_dir, exist_ok=True)
+                predict_file = type_dir + "qa_input.json"
+                paragraphs = [question_answering.get_json_from_data(d)['data'][0] for d in data]
+                question_answering.print_json_to_file(predict_file, {'data': paragraphs})
+                futures[type] = self.reader.submit(type, predict_file, type_dir)
+            for type, future in futures.items():
+                entries = question_answering.read_reader_answers(future.result(timeout=self.timeout))
+                for id, _, _, _ in qa_data[type]:
+                    if id in entries:
+                        answers[id]['answer'] = format_answer(type, entries[id])
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return [answers[id] for id in ids]
+
+
+def _handler_for(qa_server):
+    class QARequestHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return self._reply(400, {'error': 'The request body must be json.'})
+            if not isinstance(body, dict):
+                return self._reply(400, {'error': 'The request body must be a json object.'})
+            try:
+                if self.path == '/answer' and isinstance(body.get('question'), str):
+                    return self._reply(200, qa_server.answer(body['question']))
+                if self.path == '/batch' and isinstance(body.get('questions'), list):
+                    return self._reply(200, qa_server.answer_all([str(q) for q in body['questions']]))
+            except Exception as e:
+                return self._reply(500, {'error': str(e)})
+            return self._reply(400, {'error': 'POST {"question": ...} to /answer or {"questions": [...]} to /batch.'})
+
+    return QARequestHandler
+
+
+# Serve the QA system on host:port until interrupted
+def serve(qa_server, host='127.0.0.1', port=8000):
+    httpd = ThreadingHTTPServer((host, port), _handler_for(qa_server))
+    print(f"\033[95mServing the BioASQ QA system on http://{host}:{port} (/answer, /batch)\033[0m")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -0,0 +1,291 @@
+"""
+sharded_index.py splits the PubMed index into shards, by PMID range or by year of publication, that are built and
+updated on their own and searched in parallel.
+
+    A sharded index is a directory with shards.json, which says what the shards are split by and where, and one
+    ordinary Whoosh index per shard in shard_000/, shard_001/, ... python build_index.py build --shard-by pmid|year
+    builds one; every place that opens the index (startup.load_index, the batch_search workers) goes through
+    open_index, which returns a ShardedIndex for such a directory. A ShardedIndex has the part of the Whoosh index
+    API the QA system uses, so search, fetch_articles and SearcherSession work on it as they are.
+
+    A query is sent to every shard in a pool of worker processes, each of which keeps its own searchers, and the top
+    results of the shards are merged. To make the scores of different shards comparable they are all scored with the
+    collection statistics of the whole index: the document count, the field lengths and the document frequency of
+    every term of the query are summed over the shards and every shard scores with them (GlobalBM25F), so the articles
+    of a sharded index get the same scores as in the same index in one piece. Only articles with equal scores may come
+    back in another order: they are ordered by shard and then by their order in it, which for shards by year is not
+    the order they were added in (python benchmark.py shards checks this).
+"""
+import bisect
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from math import log
+
+from whoosh import index
+from whoosh.scoring import BM25F, BM25FScorer
+
+SHARDS_FILE = "shards.json"
+
+# Which shard an article goes to: shard n holds the articles whose PMID (or year) is at least bounds[n - 1] and
+# less than bounds[n]. Articles without a year go to the first shard.
+class ShardLayout:
+    def __init__(self, by, bounds):
+        if by not in ('pmid', 'year'):
+            raise ValueError(f"Shards are split by pmid or year, not {by}")
+        self.by = by
+        self.bounds = sorted(bounds)
+
+    def __len__(self):
+        return len(self.bounds) + 1
+
+    def shard_of(self, fields):
+        key = int(fields['pmid']) if self.by == 'pmid' else fields.get('year')
+        if key is None:
+            return 0
+        return bisect.bisect_right(self.bounds, int(key))
+
+    # The shards an article with this PMID may be in
+    def shards_of_pmid(self, pmid):
+        if self.by == 'pmid':
+            return [bisect.bisect_right(self.bounds, int(pmid))]
+        return list(range(len(self)))
+
+    def shard_dirs(self, path):
+        return [os.path.join(path, f"shard_{n:03d}") for n in range(len(self))]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, SHARDS_FILE), "w") as shards_file:
+            json.dump({'by': self.by, 'bounds': self.bounds}, shards_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, SHARDS_FILE), "r") as shards_file:
+            layout = json.load(shards_file)
+        return cls(layout['by'], layout['bounds'])
+
+def is_sharded(path):
+    return os.path.isfile(os.path.join(path, SHARDS_FILE))
+
+# The generation of an index, which every commit to it changes: that of the Whoosh index, or the list of those of the
+# shards of a ShardedIndex
+def index_generation(indexer):
+    if isinstance(indexer, ShardedIndex):
+        return [shard.latest_generation() for shard in indexer.shards]
+    return indexer.latest_generation()
+
+# The index at path: a ShardedIndex if it is sharded, searching its shards in processes worker processes (one per
+# shard by default, serially in this process with processes=1), otherwise the Whoosh index
+def open_index(path, indexname='pubmed_articles', processes=None):
+    if is_sharded(path):
+        return ShardedIndex(path, indexname, processes=processes)
+    return index.open_dir(path, indexname=indexname)
+
+
+# BM25F with the idf and average field length of the whole sharded index instead of those of the shard it scores.
+# stats is set for every query (see ShardedSearcher.stats); without it this is BM25F.
+class GlobalBM25F(BM25F):
+    def __init__(self, B=0.75, K1=1.2, **kwargs):
+        super().__init__(B=B, K1=K1, **kwargs)
+        self.stats = None
+
+    def idf(self, searcher, fieldname, text):
+        if self.stats is None:
+            return super().idf(searcher, fieldname, text)
+        doc_count = self.stats['doc_count']
+        n = self.stats['doc_frequencies'].get((fieldname, text))
+        if n is None:
+            # a term ShardedSearcher.stats did not see, if a shard changed in between: scale the shard's own frequency
+            parent = searcher.get_parent()
+            n = parent.doc_frequency(fieldname, text) * doc_count / (parent.doc_count_all() or 1)
+        return log(doc_count / (n + 1)) + 1
+
+    def scorer(self, searcher, fieldname, text, qf=1):
+        if self.stats is None or not searcher.schema[fieldname].scorable:
+            return super().scorer(searcher, fieldname, text, qf)
+        B = self._field_B.get(fieldname, self.B)
+        avgfl = self.stats['field_lengths'].get(fieldname, 0) / (self.stats['doc_count'] or 1) or 1
+        return _GlobalBM25FScorer(searcher, fieldname, text, B, self.K1, qf, self.idf(searcher, fieldname, text), avgfl)
+
+# BM25FScorer with the idf and average field length given rather than read from the searcher
+class _GlobalBM25FScorer(BM25FScorer):
+    def __init__(self, searcher, fieldname, text, B, K1, qf, idf, avgfl):
+        self.idf = idf
+        self.avgfl = avgfl
+        self.B = B
+        self.K1 = K1
+        self.qf = qf
+        self.setup(searcher, fieldname, text)
+
+
+# A searcher for every shard of a sharded index, as one process keeps them. Each is refreshed when its shard has
+# changed, checked at most every check_interval seconds.
+class _ShardSearchers:
+    def __init__(self, path, indexname, check_interval=1.0):
+        layout = ShardLayout.load(path)
+        self.shards = [index.open_dir(shard_dir, indexname=indexname) for shard_dir in layout.shard_dirs(path)]
+        self.weightings = [GlobalBM25F() for _ in self.shards]
+        self.searchers = [None] * len(self.shards)
+        self.checked = [0.0] * len(self.shards)
+        self.check_interval = check_interval
+
+    def _searcher(self, n):
+        if self.searchers[n] is None:
+            self.searchers[n] = self.shards[n].searcher(weighting=self.weightings[n])
+            self.checked[n] = time.monotonic()
+        elif time.monotonic() - self.checked[n] >= self.check_interval:
+            self.searchers[n] = self.searchers[n].refresh()
+            self.checked[n] = time.monotonic()
+        return self.searchers[n]
+
+    # The top limit results of shard n as [(score, n, docnum, stored fields), ...]
+    def search(self, n, q, limit, stats):
+        searcher = self._searcher(n)
+        self.weightings[n].stats = stats
+        return [(hit.score, n, hit.docnum, hit.fields()) for hit in searcher.search(q, limit=limit)]
+
+    def close(self):
+        for searcher in self.searchers:
+            if searcher is not None:
+                searcher.close()
+
+_worker = {}
+
+def _init_shard_worker(path, indexname, check_interval):
+    _worker['searchers'] = _ShardSearchers(path, indexname, check_interval)
+
+def _search_shard(task):
+    return _worker['searchers'].search(*task)
+
+
+# A result of a sharded search: the stored fields of the article, with its score, like a Whoosh Hit
+class ShardHit(dict):
+    def __init__(self, fields, score, shard, docnum):
+        super().__init__(fields)
+        self.score = score
+        self.shard = shard
+        self.docnum = docnum
+
+    def fields(self):
+        return dict(self)
+
+
+# Searches every shard of a ShardedIndex and merges their results. It also keeps a searcher per shard in this
+# process, for the collection statistics and for looking articles up by PMID.
+class ShardedSearcher:
+    def __init__(self, sharded, searchers=None):
+        self.sharded = sharded
+        self.searchers = searchers or [shard.searcher() for shard in sharded.shards]
+        self.schema = sharded.schema
+        self.doc_count = sum(searcher.doc_count_all() for searcher in self.searchers)
+        self.field_lengths = {name: sum(searcher.reader().field_length(name) for searcher in self.searchers)
+                              for name, field in self.schema.items() if field.scorable}
+
+    # The collection statistics for a query: the document count and field lengths of the whole index and the document
+    # frequency over every shard of each term the query matches on any of them, prefixes and wildcards expanded
+    def stats(self, q):
+        terms = set()
+        for searcher, leaf in itertools.product(self.searchers, q.leaves()):
+            for fieldname, text in leaf.expanded_terms(searcher.reader()):
+                if fieldname not in self.schema:
+                    continue
+                if not isinstance(text, bytes):
+                    try:
+                        text = self.schema[fieldname].to_bytes(text)
+                    except ValueError:
+                        continue
+                terms.add((fieldname, text))
+        doc_frequencies = {(fieldname, text): sum(searcher.doc_frequency(fieldname, text) for searcher in self.searchers)
+                           for fieldname, text in terms}
+        return {'doc_count': self.doc_count, 'field_lengths': self.field_lengths, 'doc_frequencies': doc_frequencies}
+
+    # The top limit results over every shard, best first; ties are broken by shard and then by document, as Whoosh
+    # breaks them by document within a shard
+    def search(self, q, limit=10):
+        stats = self.stats(q)
+        hits = [hit for shard_hits in self.sharded.search_shards(q, limit, stats) for hit in shard_hits]
+        hits.sort(key=lambda hit: (-hit[0], hit[1], hit[2]))
+        return [ShardHit(fields, score, shard, docnum) for score, shard, docnum, fields in hits[:limit]]
+
+    # The stored fields of the first document matching the keyword arguments, like Searcher.document
+    def document(self, **kw):
+        shards = range(len(self.searchers))
+        if list(kw) == ['pmid']:
+            shards = self.sharded.layout.shards_of_pmid(kw['pmid'])
+        for n in shards:
+            fields = self.searchers[n].document(**kw)
+            if fields:
+                return fields
+        return None
+
+    def documents(self, **kw):
+        for searcher in self.searchers:
+            for fields in searcher.documents(**kw):
+                yield fields
+
+    def doc_count_all(self):
+        return self.doc_count
+
+    def up_to_date(self):
+        return all(searcher.up_to_date() for searcher in self.searchers)
+
+    def refresh(self):
+        if self.up_to_date():
+            return self
+        return ShardedSearcher(self.sharded, [searcher.refresh() for searcher in self.searchers])
+
+    def close(self):
+        for searcher in self.searchers:
+            searcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShardedIndex:
+    def __init__(self, path, indexname='pubmed_articles', processes=None, check_interval=1.0):
+        self.path = path
+        self.indexname = indexname
+        self.layout = ShardLayout.load(path)
+        self.shards = [index.open_dir(shard_dir, indexname=indexname) for shard_dir in self.layout.shard_dirs(path)]
+        self.schema = self.shards[0].schema
+        self.processes = min(processes or len(self.shards), len(self.shards))
+        self.check_interval = check_interval
+        self.pool = None
+        self.local = None
+
+    def searcher(self):
+        return ShardedSearcher(self)
+
+    # The results of every shard for a parsed query, scored with stats, as [[(score, shard, docnum, fields), ...], ...]
+    def search_shards(self, q, limit, stats):
+        tasks = [(n, q, limit, stats) for n in range(len(self.shards))]
+        if self.processes <= 1:
+            if self.local is None:
+                self.local = _ShardSearchers(self.path, self.indexname, self.check_interval)
+            return [self.local.search(*task) for task in tasks]
+        if self.pool is None:
+            # the parent may hold TensorFlow and torch threads, which are not fork safe
+            self.pool = multiprocessing.get_context('spawn').Pool(self.processes, initializer=_init_shard_worker,
+                                                                  initargs=(self.path, self.indexname, self.check_interval))
+        return self.pool.map(_search_shard, tasks, chunksize=1)
+
+    def doc_count(self):
+        return sum(shard.doc_count() for shard in self.shards)
+
+    def doc_count_all(self):
+        return sum(shard.doc_count_all() for shard in self.shards)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        if self.local is not None:
+            self.local.close()
+            self.local = None
@@ -0,0 +1,272 @@
+"""
+startup.py loads everything the QA system needs and gets it ready to answer.
+    The three large artifacts (the question type classifier, the scispaCy model and the Whoosh index) and the BioBERT
+    readers are loaded in parallel, each loader importing its own libraries so nothing heavy is imported up front.
+    setup.setup_system, which downloads the classifier model and the prebuilt index, is only run when one of them is
+    missing; any other error while loading is raised as it is. Once everything is loaded a synthetic question is
+    pushed through every stage so the first real question does not pay for graph and allocator warm-up, and a
+    per-phase timing breakdown of the startup is printed.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import setup
+
+WARM_UP_QUESTION = "Is metformin used to treat type 2 diabetes?"
+
+# Records how long each startup phase took. Phases may run on different threads at the same time.
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        print("\033[95mStartup timing:\033[0m")
+        for name, seconds in self.phases:
+            print(f"\033[95m  {name:<28}{seconds:8.2f}s\033[0m")
+        print(f"\033[95m  {'total (wall clock)':<28}{time.perf_counter() - self.started:8.2f}s\033[0m")
+
+
+# The models and index the QA system runs on
+class QASystem:
+    def __init__(self, device, tokenizer, model, nlp, indexer, parser, reader, cascade=None, session=None, docstore=None,
+                 engine=None, dense=None, reranker=None):
+        self.device = device
+        self.tokenizer = tokenizer
+        self.model = model
+        self.nlp = nlp
+        self.indexer = indexer
+        self.parser = parser
+        self.reader = reader
+        self.cascade = cascade
+        # an information_retrieval.SearcherSession kept open over the index for the life of the system
+        self.session = session
+        # a docstore.DocStore with the article text, or None to read it from the index
+        self.docstore = docstore
+        # a bm25.BM25Index that answers the queries it supports instead of Whoosh, or None
+        self.engine = engine
+        # a dense_retrieval.DenseRetriever that searches for questions by their embeddings too, or None
+        self.dense = dense
+        # a reranker.Reranker that picks the articles the readers see from the search results, or None
+        self.reranker = reranker
+
+
+_setup_lock = threading.Lock()
+_setup_done = False
+
+# Download the model and index files, at most once even if both loaders find theirs missing
+def _ensure_setup(data_folder):
+    global _setup_done
+    with _setup_lock:
+        if not _setup_done:
+            # This ensures that all the packages are installed so that the system can work with the modules
+            setup.setup_system(data_folder)
+            _setup_done = True
+
+
+# threads and quantize are passed to question_understanding.prepare_classifier.
+# backend 'onnx' runs the model exported by export_onnx.py with ONNX Runtime instead of PyTorch.
+def load_classifier(data_folder, model_folder_name='model', threads=None, quantize=False, backend='torch'):
+    import torch
+    from transformers import BertTokenizerFast
+    import question_understanding
+    print("\033[95mInitializing model...\033[0m")
+    # the fast tokenizer encodes a whole batch of questions in one call
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    if backend == 'onnx':
+        # ONNX Runtime takes numpy arrays, so the batches are built on the CPU
+        device = torch.device("cpu")
+        model = question_understanding.OnnxClassifier(data_folder + os.path.sep + model_folder_name + os.path.sep + 'classifier.onnx', threads=threads)
+        return device, tokenizer, model
+    from transformers import BertForSequenceClassification
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model_dir = data_folder + os.path.sep + model_folder_name
+    if not all(os.path.isfile(model_dir + os.path.sep + name) for name in ('config.json', 'pytorch_model.bin')):
+        print(f"\033[95mNo model in {model_dir}, running setup\033[0m")
+        _ensure_setup(data_folder)
+    model = BertForSequenceClassification.from_pretrained(model_dir, cache_dir=None)
+    model = question_understanding.prepare_classifier(model, device, threads=threads, quantize=quantize)
+    return device, tokenizer, model
+
+def load_spacy():
+    import spacy
+    import en_core_sci_lg
+    # This is for cpu support for non-NVIDEA cuda-capable machines.
+    spacy.prefer_gpu()
+    import question_understanding
+    print("\033[95mLoading BioBERT...\033[0m")
+    nlp = en_core_sci_lg.load()
+    question_understanding.trim_pipeline(nlp)
+    return nlp
+
+# A sharded index (see sharded_index.py) is searched in shard_processes worker processes, one per shard by default.
+def load_index(data_folder, index_var, index_folder_name='index', index_name='pubmed_articles', shard_processes=None):
+    from whoosh import index
+    from whoosh.qparser import QueryParser
+    import information_retrieval
+    import sharded_index
+    print("\033[95mLoading index...\033[0m")
+    index_dir = data_folder + os.path.sep + index_folder_name + os.path.sep + index_var
+    # an index that is there, built or sharded by build_index.py or not, is never overwritten by the prebuilt one
+    if not sharded_index.is_sharded(index_dir) and not (os.path.isdir(index_dir)
+                                                        and index.exists_in(index_dir, indexname=index_name)):
+        print(f"\033[95mNo index in {index_dir}, running setup\033[0m")
+        _ensure_setup(data_folder)
+    indexer = sharded_index.open_index(index_dir, index_name, processes=shard_processes)
+    parser = QueryParser("abstract_text", schema=information_retrieval.pubmed_schema())
+    session = information_retrieval.SearcherSession(indexer)
+    return indexer, parser, session
+
+# The document store built for the index (python docstore.py), or None if there is none or it was written for another
+# generation of the index than the one there now
+def load_docstore(data_folder, index_var, docstore_folder_name='docstore', index_folder_name='index',
+                  index_name='pubmed_articles'):
+    import docstore
+    import sharded_index
+    store = docstore.open_docstore(data_folder + os.path.sep + docstore_folder_name + os.path.sep + index_var)
+    if store is None:
+        print("\033[95mNo document store, reading articles from the index\033[0m")
+        return None
+    indexer = sharded_index.open_index(data_folder + os.path.sep + index_folder_name + os.path.sep + index_var,
+                                       index_name, processes=1)
+    generation = sharded_index.index_generation(indexer)
+    indexer.close()
+    if store.generation != generation:
+        print(f"\033[91mThe document store in {store.path} was written for generation {store.generation} of the index, "
+              f"which is now at {generation}: reading articles from the index until it is written again by build_index.py "
+              f"--docstore or python docstore.py\033[0m")
+        store.close()
+        return None
+    return store
+
+# The BM25 postings built for the index (python bm25.py), or None if there are none or they were built from another
+# generation of the index than the one there now
+def load_bm25(data_folder, index_var, bm25_folder_name='bm25', index_folder_name='index', index_name='pubmed_articles'):
+    import bm25
+    engine = bm25.open_bm25(data_folder + os.path.sep + bm25_folder_name + os.path.sep + index_var)
+    if engine is None:
+        print("\033[95mNo BM25 postings, searching with Whoosh\033[0m")
+        return None
+    generation = bm25.index_generation(data_folder + os.path.sep + index_folder_name + os.path.sep + index_var, index_name)
+    if generation is None:
+        print("\033[91mThe index is sharded and the BM25 postings only cover an index in one piece, searching with "
+              "Whoosh\033[0m")
+        return None
+    if engine.generation != generation:
+        print(f"\033[91mThe BM25 postings in {engine.path} were built from generation {engine.generation} of the index, "
+              f"which is now at {generation}: searching with Whoosh until they are built again with python bm25.py\033[0m")
+        return None
+    return engine
+
+# The dense retriever built for the index (python dense_retrieval.py), or None if there is none.
+# mode 'fuse' fuses its results with the lexical ones and 'only' uses them instead.
+def load_dense(data_folder, index_var, mode='fuse', nprobe=16, dense_folder_name='dense'):
+    import dense_retrieval
+    dense = dense_retrieval.open_dense(data_folder + os.path.sep + dense_folder_name + os.path.sep + index_var,
+                                       nprobe=nprobe, fuse=mode == 'fuse')
+    if dense is None:
+        print("\033[95mNo dense index, searching by keywords only\033[0m")
+    return dense
+
+# The reranker built for the index (python reranker.py), or None if there is none. It reranks the depth best articles.
+def load_reranker(data_folder, index_var, depth=100, tokens_folder_name='tokens'):
+    import reranker
+    ranker = reranker.open_reranker(data_folder + os.path.sep + tokens_folder_name + os.path.sep + index_var, depth=depth)
+    if ranker is None:
+        print("\033[95mNo token store, the search results are not reranked\033[0m")
+    return ranker
+
+def load_reader(reader_model_dir):
+    import reader_service
+    # load the yesno, factoid and list readers once, rather than once per question
+    print("\033[95mLoading BioBERT readers...\033[0m")
+    return reader_service.ReaderService(reader_model_dir)
+
+
+# Run a synthetic question through every stage of the pipeline
+def warm_up(system, timer, output_dir):
+    import pandas as pd
+    import question_understanding
+    import information_retrieval
+    import question_answering
+    df = pd.DataFrame({'ID': ['warm_up'], 'Question': [WARM_UP_QUESTION]})
+    with timer.phase("warm-up: question type"):
+        df['type'] = question_understanding.predict_types(df, system.device, system.tokenizer, system.model, cascade=system.cascade)
+    with timer.phase("warm-up: entities"):
+        id, question, type, entities, query = next(question_understanding.qu_records(df, system.nlp))
+    with timer.phase("warm-up: search"):
+        results = information_retrieval.search(system.indexer, system.parser, query or question, batch_mode=True,
+                                               session=system.session, docstore=system.docstore, engine=system.engine,
+                                               dense=system.dense, question=question, reranker=system.reranker)
+    if system.reader is None:
+        return
+    with timer.phase("warm-up: readers"):
+        # read as many passages as a real question so the reader warms up on the batch shapes it will see
+        abstracts = [result.abstract_text for result in results if result.abstract_text][:question_answering.PASSAGES_PER_QUESTION]
+        os.makedirs(output_dir, exist_ok=True)
+        predict_file = output_dir + "qa_input.json"
+        question_answering.print_json_to_file(predict_file, question_answering.get_json_from_data(('warm_up', type, question, abstracts or [WARM_UP_QUESTION])))
+        futures = [system.reader.submit(head, predict_file, f"{output_dir}{head}{os.path.sep}") for head in ('yesno', 'factoid', 'list')]
+        for future in futures:
+            future.result()
+
+
+# Load the classifier, spaCy model, index and readers in parallel, warm them up and report the timings
+# classifier_threads, quantize_classifier and classifier_backend are passed to load_classifier.
+# With a cascade_threshold the question type cascade is loaded too, if one has been trained.
+# retrieval_backend 'bm25' searches with the NumPy BM25 postings where they exist, 'whoosh' with the index alone.
+# dense_mode 'fuse' or 'only' loads the dense retriever too, with dense_nprobe IVF lists scanned per question.
+# With a rerank_depth the reranker is loaded too, and reranks that many search results. shard_processes is passed to
+# load_index.
+def load_system(data_folder, reader_model_dir, index_var='full_index', with_reader=True, run_warm_up=True,
+                classifier_threads=None, quantize_classifier=False, classifier_backend='torch', cascade_threshold=None,
+                retrieval_backend='whoosh', dense_mode=None, dense_nprobe=16,
+                rerank_depth=None, shard_processes=None):
+    timer = StartupTimer()
+
+    def timed(name, loader):
+        def run():
+            with timer.phase(name):
+                return loader()
+        return run
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        reader_future = pool.submit(timed("BioBERT readers", lambda: load_reader(reader_model_dir))) if with_reader else None
+        classifier_future = pool.submit(timed("question type classifier", lambda: load_classifier(
+            data_folder, threads=classifier_threads, quantize=quantize_classifier, backend=classifier_backend)))
+        spacy_future = pool.submit(timed("scispaCy model", load_spacy))
+        index_future = pool.submit(timed("Whoosh index", lambda: load_index(data_folder, index_var, shard_processes=shard_processes)))
+        docstore_future = pool.submit(timed("document store", lambda: load_docstore(data_folder, index_var)))
+        engine_future = pool.submit(timed("BM25 postings", lambda: load_bm25(data_folder, index_var))) \
+            if retrieval_backend == 'bm25' else None
+        dense_future = pool.submit(timed("dense retriever", lambda: load_dense(data_folder, index_var, dense_mode, dense_nprobe))) \
+            if dense_mode is not None else None
+        reranker_future = pool.submit(timed("reranker", lambda: load_reranker(data_folder, index_var, rerank_depth))) \
+            if rerank_depth is not None else None
+        device, tokenizer, model = classifier_future.result()
+        indexer, parser, session = index_future.result()
+        cascade = None
+        if cascade_threshold is not None:
+            import question_type_cascade
+            with timer.phase("question type cascade"):
+                cascade = question_type_cascade.load_cascade(threshold=cascade_threshold)
+        system = QASystem(device, tokenizer, model, spacy_future.result(), indexer, parser,
+                          reader_future.result() if reader_future else None, cascade=cascade, session=session,
+                          docstore=docstore_future.result(), engine=engine_future.result() if engine_future else None,
+                          dense=dense_future.result() if dense_future else None,
+                          reranker=reranker_future.result() if reranker_future else None)
+    if run_warm_up:
+        warm_up(system, timer, f"tmp{os.path.sep}warm_up{os.path.sep}")
+    timer.report()
+    return system